@@ -12,7 +12,7 @@ import pathlib
 
 import glob
 
-def ingest_calibrate_mpl(date_string, dir_data, dir_out):
+def ingest_calibrate_mpl(date_string, dir_data, dir_out, encoding='archive', zarr_store=None, zarr_first_day=None, fname_save_fmt='smtmplpolX1.a1.{:04}{:02}{:02}.000000.cdf'):
     '''Function to ingest a month of hourly .mpl.gz files, and store them as hourly .cdf files that can be loaded in an mf dataset call.
     
     INPUTS:
@@ -24,6 +24,18 @@ def ingest_calibrate_mpl(date_string, dir_data, dir_out):
             
         dir_out: pathib.Path
             The path in which to store the output daily .cdf files        
+
+        encoding: None, string
+            The encoding profile of the output file, see mplgz2ingested.steps.output_encoding.
+
+        zarr_store: None, string
+            If given, the day is written into this Zarr store (see mplgz2ingested.steps.ZarrArchive) instead of a daily .cdf file in dir_out.
+
+        zarr_first_day: None, datetime.date
+            The first day of the Zarr store, used if it is created. If None, the date being ingested is used.
+
+        fname_save_fmt: string
+            The format of the output filename, with the year, month and day imposed in order.
     '''
 
     file_list = [f for f in dir_data.glob(f'{date_string}*.mpl.gz')]
@@ -48,7 +60,7 @@ def ingest_calibrate_mpl(date_string, dir_data, dir_out):
 
     print(f'{file_list=}')
 
-    ds = mplgz.load_fromlist(file_list, dir_root='')
+    ds = mplgz.load_fromlist(file_list, dir_root='', **mplgz.ingest_projection())
     ds = mplgz.raw_to_ingested(ds)
 
     # load the overlap, afterpulse, ready for calibration
@@ -58,13 +70,26 @@ def ingest_calibrate_mpl(date_string, dir_data, dir_out):
 
     ds = mplgz.calibrate_ingested(ds, overlap=o, afterpulse=a, sources=sources)
 
-    save_fname = f'smtmplpolX1.a1.{date_string}.000000.cdf'
+    if zarr_store is not None:
+        print(f'Writing {date_string} to {zarr_store} | ',end='')
+        date = dt.datetime.strptime(date_string, '%Y%m%d').date()
+        mplgz.ZarrArchive(zarr_store, encoding=encoding, first_day=date if zarr_first_day is None else zarr_first_day).write_day(ds, date)
+        print('success')
+        return
+
+    date = dt.datetime.strptime(date_string, '%Y%m%d').date()
+    save_fname = fname_save_fmt.format(date.year, date.month, date.day)
     print(f'Saving {dir_out / save_fname} | ',end='')
     
-    ds.to_netcdf(dir_out / save_fname)
+    ds.to_netcdf(dir_out / save_fname, encoding=mplgz.output_encoding(ds, encoding))
     print('success')
 
 
+def ingest_calibrate_task_day(date, dir_target, dir_mpl, encoding='archive', fname_save_fmt='smtmplpolX1.a1.{:04}{:02}{:02}.000000.cdf', overwrite=True):
+    '''Function to ingest and calibrate a day of a task written by mplgz2ingested.workflows.schedule_catchup, as the calibrate function given to run_task. The output is always overwritten.'''
+    ingest_calibrate_mpl(date.strftime('%Y%m%d'), pathlib.Path(dir_mpl), pathlib.Path(dir_target), encoding=encoding, fname_save_fmt=fname_save_fmt)
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Ingest a month of hourly .mpl.gz files in the .cdf format.')
@@ -74,10 +99,23 @@ if __name__ == '__main__':
 
     parser.add_argument('-d', '--data', default=dir_data)
     parser.add_argument('-t', '--target', default=dir_target)
-    parser.add_argument('-m', '--month', required=True)
+    parser.add_argument('-m', '--month')
+    parser.add_argument('--task', nargs=2, metavar=('MANIFEST', 'TASK_ID'), help='Run the days of a task of a manifest written by mplgz2ingested.workflows.schedule_catchup, instead of a single date.')
+    parser.add_argument('-e', '--encoding', default='archive', choices=['archive', 'fast-read', 'minimal'])
+    parser.add_argument('-z', '--zarr')
+    parser.add_argument('--zarr-first-day', type=dt.date.fromisoformat)
 
     args = parser.parse_args()
 
+    if args.task is not None:
+        from mplgz2ingested.workflows import run_task
+        report = run_task(args.task[0], int(args.task[1]), calibrate=ingest_calibrate_task_day)
+        if any(result.status == 'failed' for result in report):
+            raise SystemExit(1)
+        raise SystemExit(0)
+    if args.month is None:
+        parser.error('one of --month or --task is required')
+
     dir_data = args.data
     dir_target = args.target
     date_string = args.month
@@ -86,4 +124,4 @@ if __name__ == '__main__':
     dir_target = pathlib.Path(dir_target)
 
     print(f'Running ingest_calibrate_mpl( {date_string=} , {dir_data=}, {dir_target=})')
-    ingest_calibrate_mpl(date_string, dir_data, dir_target)
\ No newline at end of file
+    ingest_calibrate_mpl(date_string, dir_data, dir_target, encoding=args.encoding, zarr_store=args.zarr, zarr_first_day=args.zarr_first_day)
\ No newline at end of file
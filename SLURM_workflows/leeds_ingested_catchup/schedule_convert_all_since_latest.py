@@ -1,43 +1,51 @@
 '''Author: Andrew Martin
 Creation Date: 20/9/23
 
-Script to schedule SLURM jobs on JASMIN to ingest raw data and create daily .cdf files for every day since the last daily file present in leeds_ingested on the ICECAPS archive on JASMIN.
+Script to schedule SLURM jobs on JASMIN to ingest raw data and create daily .cdf files for every day missing from leeds_ingested on the ICECAPS archive on JASMIN, or whose raw files have changed since its .cdf file was written.
+
+The days are packed into tasks of days_per_task days and submitted as a single SLURM job array (see mplgz2ingested.workflows.schedule_catchup). Set local = True to run the tasks as local processes instead. Each task runs the days through ingest_calibrate_day.py, so they are calibrated exactly as when it is run by hand for a single day, including its selection of the calibration files.
 '''
 
 import os
-import glob
+import sys
 import datetime as dt
 
+from mplgz2ingested.workflows import schedule_catchup, collect_reports, SlurmExecutor, LocalExecutor
+
 dir_data = '/gws/nopw/j04/icecaps/ICECAPSarchive/mpl/raw'
 dir_target = '/gws/nopw/j04/icecaps/ICECAPSarchive/mpl/leeds_ingested'
+fname_save_fmt = 'smtmplpolX1.a1.{:04}{:02}{:02}.000000.cdf'
+# local SQLite index of dir_data (see mplgz2ingested.steps.ArchiveIndex), used instead of listing dir_data. Set to None to list dir_data.
+index_db = os.path.expanduser('~/.mplgz2ingested_raw_index.sqlite')
 
 queue = 'short-serial'
-timemax = '00:05:00' # in hh:mm:ss format
+days_per_task = 7
+timemax = '00:40:00' # in hh:mm:ss format, for days_per_task days
 outdir = '/work/scratch-nopw2/eeasm'
 memreq = '5G'
-#ncores = 4
-
-
-# determine the latest file in the leeds_ingested archive
-glob_str = '*.000000.cdf'
-existing_file_list = glob.glob(os.path.join(dir_target,glob_str))
-
-latest = sorted(existing_file_list)[-1][-19:-11]
-
-latest_date = dt.datetime.strptime(latest, '%Y%m%d').date()
-one_day = dt.timedelta(days=1)
-today = dt.date.today()
-
-iter_date = latest_date + one_day
-
-while iter_date < today:
-    date_str = iter_date.strftime('%Y%m%d')
-    iter_date += one_day
-
-    jobname = 'mpl_raw_to_cdf'
-    jobid = f'mpl_raw_to_cdf_{date_str}'
-
-    cmd = f'sbatch -p {queue} -t {timemax} --mem={memreq} --job-name={jobname} -o {outdir}/{jobid}.out -e {outdir}/{jobid}.err runjob.sh {dir_data} {dir_target} {date_str}'
-
-    print(cmd)
-    os.system(cmd)
+setup = '. "$(conda info --base)/etc/profile.d/conda.sh" && conda activate mplgz2ingested' # run by sh in each task
+local = False
+
+# today's files are still arriving, so it is left to the next run
+end = dt.date.today() - dt.timedelta(days=1)
+
+index = None
+if index_db is not None:
+    from mplgz2ingested.steps import ArchiveIndex
+    index = ArchiveIndex(index_db, dir_data)
+    index.refresh()
+
+# each task runs ingest_calibrate_day.py --task <manifest> <task id>
+task = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ingest_calibrate_day.py'), '--task']
+if local:
+    executor = LocalExecutor(command=task)
+else:
+    executor = SlurmExecutor(queue, timemax, memreq, setup=setup, job_name='mpl_raw_to_cdf', command=task)
+
+work_dir = os.path.join(outdir, 'mpl_raw_to_cdf')
+job_id, manifest = schedule_catchup(dir_data, dir_target, executor, work_dir, days_per_task=days_per_task, fname_save_fmt=fname_save_fmt, end=end, index=index, encoding='archive')
+print(f'{job_id=}, {manifest=}')
+
+if local and manifest is not None:
+    for task_id, report in collect_reports(manifest).items():
+        print(task_id, report)
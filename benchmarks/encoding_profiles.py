@@ -0,0 +1,88 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Benchmark of the netcdf encoding profiles (see mplgz2ingested.steps.output_encoding). A calibrated day is written with each profile, and the file size, the write time, and the time to read a full calibrated variable and an hour of it are printed, along with the largest relative difference of the read values from the uncompressed file.
+
+Usage:
+    python encoding_profiles.py <calibrated .nc file> [--dir_tmp DIR] [--repeats N]
+'''
+
+import os
+import time
+import tempfile
+
+import numpy as np
+import xarray as xr
+
+from mplgz2ingested import steps
+from mplgz2ingested.steps.encoding import ENCODING_PROFILES
+
+def benchmark_profiles(fname, dir_tmp=None, repeats=3, variable='NRB_1'):
+    '''Function to write a calibrated dataset with each encoding profile and time the writing and reading of it.
+
+    INPUTS:
+        fname : string
+            Full filename of a calibrated netcdf file, as written by calibrate_day.
+
+        dir_tmp : None, string ; default=None
+            Directory the benchmark files are written to. If None, a temporary directory is used.
+
+        repeats : int ; default=3
+            The number of times each read is repeated. The fastest is reported.
+
+        variable : string ; default='NRB_1'
+            The variable that is read back.
+
+    OUTPUTS:
+        results : dict
+            For each profile (and None for no encoding), a dict of the size [MB], write time, full read time and hour read time [s], and the maximum relative difference of the variable from the uncompressed values.
+    '''
+    ds = xr.open_dataset(fname).load()
+    for v in ds.variables.values(): # so that the source file's compression isn't reused, and None is a true uncompressed baseline
+        v.encoding = {}
+    reference = ds[variable].values
+    hour = slice(ds.time.size//2, ds.time.size//2 + 720)
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=dir_tmp) as tmp:
+        for profile in [None] + list(ENCODING_PROFILES):
+            fname_out = os.path.join(tmp, f'{profile}.nc')
+            t0 = time.perf_counter()
+            ds.to_netcdf(fname_out, encoding=steps.output_encoding(ds, profile))
+            t_write = time.perf_counter() - t0
+
+            t_full, t_hour = np.inf, np.inf
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                with xr.open_dataset(fname_out) as f:
+                    values = f[variable].values
+                t_full = min(t_full, time.perf_counter() - t0)
+
+                t0 = time.perf_counter()
+                with xr.open_dataset(fname_out) as f:
+                    f[variable].isel(time=hour).values
+                t_hour = min(t_hour, time.perf_counter() - t0)
+
+            valid = np.isfinite(reference) & (reference != 0)
+            results[profile] = {
+                'size': os.path.getsize(fname_out) / 2**20,
+                'write': t_write,
+                'read_full': t_full,
+                'read_hour': t_hour,
+                'max_rel_diff': np.nanmax(np.abs(values[valid] / reference[valid] - 1)),
+            }
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the netcdf encoding profiles on a calibrated day.')
+    parser.add_argument('fname', help='Full filename of a calibrated netcdf file.')
+    parser.add_argument('--dir_tmp', help='Optional, the directory the benchmark files are written to.')
+    parser.add_argument('--repeats', type=int, default=3, help='Optional, the number of repeats of each read. Defaults to 3.')
+    args = parser.parse_args()
+
+    results = benchmark_profiles(args.fname, dir_tmp=args.dir_tmp, repeats=args.repeats)
+    print(f'{"profile":>10} {"size [MB]":>10} {"write [s]":>10} {"read [s]":>10} {"hour [s]":>10} {"max rel diff":>13}')
+    for profile, r in results.items():
+        print(f'{str(profile):>10} {r["size"]:10.1f} {r["write"]:10.2f} {r["read_full"]:10.3f} {r["read_hour"]:10.4f} {r["max_rel_diff"]:13.1e}')
@@ -74,17 +74,23 @@ def get_all_from_catalogue(catalogue, fname_fmt='%Y%m%d%H%M.mpl.gz'):
     return fnames, datelist
 
 
-def get_all_afterpulse_candidates(dir_root):
+def get_all_afterpulse_candidates(dir_root, index=None):
     '''Function to get all of the candidate afterpulse files from a directory of .mpl.gz files
     
     INPUTS:
         dir_root : string
             Root directory containing all the .mpl.gz files.
 
+        index : None, steps.ArchiveIndex ; default=None
+            If given, the candidates are the .mpl.gz files in the archive index of dir_root that aren't hourly files, rather than being found by listing dir_root.
+
     OUTPUTS:
         calibration_files : list [string]
             List of strinbgs for valid filenames that are candidates for afterpulse files
     '''
+    if index is not None:
+        return index.names(pattern='*.mpl.gz', role=['calibration', 'afterpulse'])
+
     # faster to use os.listdir than os.walk
     calibration_files = []
 
@@ -1,5 +1,14 @@
-from .load_raw import load_raw, load_fromlist, load_fromglob, load_fromdate
-from .raw_to_ingested import raw_to_ingested
+from .load_raw import load_raw, load_fromlist, load_fromglob, load_fromdate, select_fromdate, scan_headers
+from .raw_to_ingested import raw_to_ingested, ingest_projection
 from .load_afterpulse import load_afterpulse
 from .load_overlap import load_overlap
-from .calibrate_ingested import calibrate_ingested
\ No newline at end of file
+from .load_deadtime import load_deadtime
+from .deadtime import DeadtimeLUT
+from .calibrate_ingested import calibrate_ingested
+from .background import BackgroundEstimator
+from .calibration_context import CalibrationContext, calibration_context
+from .write_netcdf import write_netcdf, append_netcdf, describe_sources, read_sources
+from .encoding import output_encoding
+from .zarr_archive import ZarrArchive, day_slot_size
+from .decode_cache import DecodeCache
+from .archive_index import ArchiveIndex
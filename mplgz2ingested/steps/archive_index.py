@@ -0,0 +1,210 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Incrementally updated index of the raw .mpl.gz archive, stored as a local SQLite file, so that the files for a date range can be found without globbing the archive directory.
+'''
+
+import contextlib
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from .load_raw import scan_headers, file_role
+
+class ArchiveIndex:
+    '''Index of the raw .mpl.gz (and .mpl) files in an archive directory.
+
+    For each file the index holds its name, the times of its first and last profiles, the number of profiles, its size and mtime, and its role (see file_role). The profile times and counts come from scan_headers, so the files are only read when they are first indexed.
+
+    The index is brought up to date with refresh. Files that may still be growing (those with profiles in, or modified in, the last recent_days days) are stat-ed on every refresh, and read again if their size or mtime has changed, so a file indexed while it was being written doesn't keep its truncated description. If the modification time of the directory hasn't changed since the last refresh, the directory isn't listed; otherwise it is listed, the files that are new are read, and files that have been removed are dropped.
+
+    INPUTS:
+        db_path : string
+            Full filename of the SQLite database holding the index. It is created if it doesn't exist.
+
+        dir_root : string
+            The archive directory containing the .mpl.gz files.
+
+        afterpulse_catalogue : None, string ; default=None
+            Filename of a catalogue of afterpulse files (a ', ' separated list of filenames, as read by afterpulse.get_all_from_catalogue). Files listed in it are given the role 'afterpulse'.
+    '''
+
+    def __init__(self, db_path, dir_root, afterpulse_catalogue=None):
+        self.db_path = db_path
+        self.dir_root = dir_root
+        self.afterpulse_catalogue = afterpulse_catalogue
+        with self._connect() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, start_time INTEGER, end_time INTEGER, n_profiles INTEGER, size INTEGER, mtime_ns INTEGER, role TEXT)')
+            con.execute('CREATE INDEX IF NOT EXISTS files_start_time ON files (start_time)')
+            con.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)')
+
+    def refresh(self, full=False, recent_days=2, verbose=False):
+        '''Function to bring the index up to date with the archive directory.
+
+        INPUTS:
+            full : bool ; default=False
+                If True, the directory is always listed and every file is stat-ed, so that any file modified in place is re-read. Otherwise new and removed files are detected, and only the files that may still be growing are stat-ed.
+
+            recent_days : float ; default=2
+                Files with profiles in, or modified in, this many days before now are stat-ed by every refresh, as they may still be being written. Older files are only stat-ed by a full refresh. This doesn't depend on the number of profiles in a file, so the resolution of the raw data can change.
+
+            verbose : bool ; default=False
+                Flag for printing the files as they are indexed.
+
+        OUTPUTS:
+            n_scanned : int
+                The number of files that were read.
+        '''
+        dir_mtime = os.stat(self.dir_root).st_mtime_ns # taken before listing, so later changes are seen by the next refresh
+        with self._connect() as con:
+            row = con.execute("SELECT value FROM state WHERE key='dir_mtime_ns'").fetchone()
+            known = {name: (size, mtime_ns) for name, size, mtime_ns in con.execute('SELECT name, size, mtime_ns FROM files')}
+            if full or row is None or row[0] != dir_mtime:
+                names = {e.name for e in os.scandir(self.dir_root) if '.mpl' in e.name and e.is_file()}
+            else:
+                names = set(known)
+
+            if full:
+                to_check = names & known.keys()
+            else:
+                since = int(time.time() - recent_days*86400)
+                to_check = names & {name for name, in con.execute('SELECT name FROM files WHERE end_time >= ? OR mtime_ns >= ?', (since, since*10**9))}
+            to_scan = sorted(names - known.keys())
+            for name in sorted(to_check):
+                try:
+                    st = os.stat(os.path.join(self.dir_root, name))
+                except FileNotFoundError: # removed since the directory was last listed, so dropped by the next refresh
+                    continue
+                if (st.st_size, st.st_mtime_ns) != known[name]:
+                    to_scan.append(name)
+
+            afterpulse = self._afterpulse_names()
+            for name in to_scan:
+                if verbose: print(f'ArchiveIndex: indexing {name}')
+                con.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?)', self._describe(name, afterpulse))
+            con.executemany('DELETE FROM files WHERE name=?', [(name,) for name in known.keys() - names])
+            if afterpulse:
+                con.executemany("UPDATE files SET role='afterpulse' WHERE name=?", [(name,) for name in afterpulse])
+            con.execute("INSERT OR REPLACE INTO state VALUES ('dir_mtime_ns', ?)", (dir_mtime,))
+        return len(to_scan)
+
+    def names(self, pattern=None, role=None, start=None, end=None):
+        '''Function to query the filenames in the index.
+
+        INPUTS:
+            pattern : None, string ; default=None
+                If given, only names matching the glob pattern are returned (e.g. '20210211*.mpl*').
+
+            role : None, string, list [string] ; default=None
+                If given, only files with this role (or one of these roles) are returned.
+
+            start, end : None, np.datetime64, datetime.datetime ; default=None
+                If given, only files with profiles in the time range [start, end) are returned.
+
+        OUTPUTS:
+            names : list [string]
+                Sorted list of filenames, relative to dir_root.
+        '''
+        query, args = ['SELECT name FROM files WHERE 1'], []
+        if pattern is not None:
+            query.append('AND name GLOB ?')
+            args.append(pattern)
+        if role is not None:
+            role = [role] if isinstance(role, str) else list(role)
+            query.append(f'AND role IN ({",".join("?"*len(role))})')
+            args.extend(role)
+        if start is not None:
+            query.append('AND end_time >= ?')
+            args.append(_to_seconds(start))
+        if end is not None:
+            query.append('AND start_time < ?')
+            args.append(_to_seconds(end))
+        query.append('ORDER BY name')
+        with self._connect() as con:
+            names = [row[0] for row in con.execute(' '.join(query), args)]
+        return names
+
+    def table(self, names=None):
+        '''Function to get the indexed information for files.
+
+        INPUTS:
+            names : None, list [string] ; default=None
+                The filenames to get. If None, all of the files in the index are returned.
+
+        OUTPUTS:
+            table : np.ndarray
+                Structured array with the fields name, start_time, end_time (datetime64[s], NaT for files without profiles), n_profiles, size, mtime_ns and role, sorted by name.
+        '''
+        with self._connect() as con:
+            rows = con.execute('SELECT * FROM files ORDER BY name').fetchall()
+        if names is not None:
+            names = set(names)
+            rows = [row for row in rows if row[0] in names]
+        dtype = [('name', object), ('start_time', 'datetime64[s]'), ('end_time', 'datetime64[s]'), ('n_profiles', np.int64), ('size', np.int64), ('mtime_ns', np.int64), ('role', object)]
+        table = np.empty(len(rows), dtype=dtype)
+        for i, (name, start_time, end_time, n_profiles, size, mtime_ns, role) in enumerate(rows):
+            table[i] = (name, _from_seconds(start_time), _from_seconds(end_time), n_profiles, size, mtime_ns, role)
+        return table
+
+    def record_counts(self, names):
+        '''Function to get the number of records in files from the index, so that they don't need to be decompressed to count them (see load_raw.assemble_mpl).
+
+        INPUTS:
+            names : list [string]
+                The filenames, relative to dir_root.
+
+        OUTPUTS:
+            counts : list [None, int]
+                The number of records in each file. None for a file that isn't in the index, couldn't be read when it was indexed, or whose size or mtime has changed since.
+        '''
+        rows = {row['name']: row for row in self.table(names)}
+        counts = []
+        for name in names:
+            row = rows.get(name)
+            try:
+                st = os.stat(os.path.join(self.dir_root, name))
+            except OSError:
+                st = None
+            if row is None or st is None or row['size'] != st.st_size or row['mtime_ns'] != st.st_mtime_ns or (row['n_profiles'] == 0 and st.st_size > 0):
+                counts.append(None)
+            else:
+                counts.append(int(row['n_profiles']))
+        return counts
+
+    @contextlib.contextmanager
+    def _connect(self):
+        con = sqlite3.connect(self.db_path)
+        try:
+            with con: # commits on success
+                yield con
+        finally:
+            con.close()
+
+    def _describe(self, name, afterpulse=()):
+        path = os.path.join(self.dir_root, name)
+        st = os.stat(path)
+        role = 'afterpulse' if name in afterpulse else file_role(name)
+        try:
+            times = scan_headers(path)[0]['time']
+        except (IOError, EOFError, ValueError) as err:
+            print(f'ArchiveIndex: unable to read {name}: {err}')
+            times = np.array([], dtype='datetime64[s]')
+        if times.size == 0:
+            return (name, None, None, 0, st.st_size, st.st_mtime_ns, role)
+        return (name, _to_seconds(times.min()), _to_seconds(times.max()), int(times.size), st.st_size, st.st_mtime_ns, role)
+
+    def _afterpulse_names(self):
+        if self.afterpulse_catalogue is None:
+            return set()
+        with open(self.afterpulse_catalogue) as f:
+            return {fn.strip() for fn in f.read().split(', ')}
+
+
+def _to_seconds(t):
+    return int(np.datetime64(t, 's').astype(np.int64))
+
+
+def _from_seconds(s):
+    return np.datetime64('NaT', 's') if s is None else np.datetime64(s, 's')
@@ -0,0 +1,160 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Estimators of the background signal of each profile, for the background subtraction in calibrate_ingested. The range bins used by each estimator are found once from the height grid, and are read as contiguous slices of the backscatter, without copying them.
+'''
+
+import numpy as np
+
+# the methods of BackgroundEstimator
+BACKGROUND_METHODS = ['below_ground', 'header', 'high_altitude']
+
+# number of profiles sorted at a time by the high_altitude method
+BACKGROUND_BLOCK_SIZE = 1024
+
+class BackgroundEstimator:
+    '''Estimator of the background of each profile, in counts per second, from the backscatter in counts per microsecond.
+
+    The methods are:
+        'below_ground' : the mean of the signal in the bins beneath the ground (height < 0), as in Von Walden's code.
+        'header' : the mean of the signal in the background bins given in the raw headers (first_background_bin and num_background_bins, as given by scan_headers). These bins are usually at the far end of the profile, beyond the LIMIT_HEIGHT_BINS bins kept by raw_to_ingested by default, so this method needs data ingested with limit_height=False (and loaded with ingest_projection(limit_height=False)).
+        'high_altitude' : a quantile of the signal in the bins above min_height. The quantile is found by a partial sort (np.partition) of the bins, so is robust to clouds and noise spikes in those bins. quantile=1 gives the maximum above min_height, which was previously used.
+
+    The mean is accumulated in float64, ignoring NaN bins (e.g. masked fill values). If smooth is given, the background of each profile is replaced by its running mean over smooth profiles, found from a cumulative sum so that its cost doesn't depend on smooth. Profiles with a NaN background are left out of the running mean.
+
+    INPUTS:
+        height : np.ndarray
+            The height grid of the backscatter [m]. The bins used by the estimator must be contiguous in it.
+
+        method : string ; default='below_ground'
+            The method, one of BACKGROUND_METHODS.
+
+        first_bin : None, int ; default=None
+            For the 'header' method, the first background bin. The ingested data starts from the first bin of the raw data, so the bin numbers are the same.
+
+        num_bins : None, int ; default=None
+            For the 'header' method, the number of background bins.
+
+        min_height : float ; default=10000
+            For the 'high_altitude' method, the height above which the bins are used [m].
+
+        quantile : float ; default=0.5
+            For the 'high_altitude' method, the quantile of the signal used, between 0 and 1. Defaults to the median.
+
+        smooth : None, int ; default=None
+            If given, the number of profiles in the centred running mean applied to the background. At the start and end of the data the window is truncated.
+    '''
+
+    def __init__(self, height, method='below_ground', first_bin=None, num_bins=None, min_height=10000, quantile=0.5, smooth=None):
+        height = np.asarray(height)
+        if method == 'below_ground':
+            bins = np.flatnonzero(height < 0)
+        elif method == 'header':
+            if first_bin is None or num_bins is None:
+                err_msg = "first_bin and num_bins are required for the 'header' method"
+                raise ValueError(err_msg)
+            bins = np.arange(first_bin, first_bin + num_bins)
+            if bins.size > 0 and bins[-1] >= height.size:
+                err_msg = f"background bins {first_bin}-{first_bin + num_bins - 1} are outside of the {height.size} height bins of the data; the 'header' method needs data ingested with limit_height=False"
+                raise ValueError(err_msg)
+        elif method == 'high_altitude':
+            if not 0 <= quantile <= 1:
+                err_msg = 'quantile must be between 0 and 1'
+                raise ValueError(err_msg)
+            bins = np.flatnonzero(height > min_height)
+        else:
+            err_msg = f'method must be one of {BACKGROUND_METHODS}, not {method!r}'
+            raise ValueError(err_msg)
+
+        if bins.size == 0:
+            err_msg = f'no height bins are used by the {method!r} background'
+            raise ValueError(err_msg)
+        if bins[-1] - bins[0] + 1 != bins.size:
+            err_msg = f'the height bins used by the {method!r} background must be contiguous'
+            raise ValueError(err_msg)
+
+        self.method = method
+        self.bins = slice(int(bins[0]), int(bins[-1]) + 1)
+        self.quantile = quantile
+        self.smooth = smooth
+
+    def __call__(self, backscatter):
+        '''Function to estimate the background of each profile, including any smoothing.
+
+        INPUTS:
+            backscatter : np.ndarray
+                The (time, height) backscatter, in counts per microsecond.
+
+        OUTPUTS:
+            background : np.ndarray
+                The (time,) background, in counts per second.
+        '''
+        return self.smooth_background(self.profile_background(backscatter))
+
+    def profile_background(self, backscatter):
+        '''Function to estimate the background of each profile separately, without smoothing.
+
+        INPUTS:
+            backscatter : np.ndarray
+                The (time, height) backscatter, in counts per microsecond.
+
+        OUTPUTS:
+            background : np.ndarray
+                The (time,) background, in counts per second.
+        '''
+        bins = backscatter[:, self.bins] # a view, not a copy
+        if self.method == 'high_altitude':
+            background = np.empty(bins.shape[0], dtype=np.float64)
+            for i0 in range(0, bins.shape[0], BACKGROUND_BLOCK_SIZE):
+                rows = slice(i0, i0 + BACKGROUND_BLOCK_SIZE)
+                background[rows] = _partition_quantile(bins[rows], self.quantile)
+        else:
+            background = np.nanmean(bins, axis=1, dtype=np.float64)
+        return background * 1e6 # counts per second (from per microsecond)
+
+    def smooth_background(self, background):
+        '''Function to apply the running mean over smooth profiles to a (time,) background, if smooth is set.'''
+        if self.smooth is None or self.smooth <= 1:
+            return background
+        return running_mean(background, self.smooth)
+
+
+def running_mean(x, window):
+    '''Function to calculate the centred running mean of a 1D array using a cumulative sum, so that the cost is independent of the window length.
+
+    INPUTS:
+        x : np.ndarray
+            The (n,) array to be smoothed.
+
+        window : int
+            The number of elements averaged. Even windows extend one element further before each element than after it. At the ends of x, the window is truncated.
+
+    OUTPUTS:
+        mean : np.ndarray
+            The (n,) running mean, in float64. NaN elements (e.g. a profile whose background bins are all NaN) are left out of the mean of each window, so they don't spread to the rest of x, and the mean is NaN only where the whole window is NaN.
+    '''
+    n = x.size
+    finite = np.isfinite(x)
+    csum = np.zeros(n + 1, dtype=np.float64)
+    np.cumsum(np.where(finite, x, 0), out=csum[1:])
+    ccount = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(finite, out=ccount[1:])
+    i = np.arange(n)
+    lo = np.maximum(i - window//2, 0)
+    hi = np.minimum(i - window//2 + window, n)
+    count = ccount[hi] - ccount[lo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, (csum[hi] - csum[lo]) / count, np.nan)
+
+
+def _partition_quantile(a, q):
+    '''The q-quantile along axis 1 of a, with linear interpolation as np.quantile, using a partial sort of each row.'''
+    n = a.shape[1]
+    pos = q * (n - 1)
+    k = int(np.floor(pos))
+    kth = [k] if k + 1 >= n else [k, k + 1]
+    part = np.partition(a, kth, axis=1)
+    lower = part[:, k].astype(np.float64)
+    if len(kth) == 1:
+        return lower
+    return lower + (pos - k) * (part[:, k + 1] - lower)
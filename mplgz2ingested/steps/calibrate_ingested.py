@@ -7,8 +7,12 @@ Script to calibrate the ingested data format.
 import xarray as xr
 import numpy as np
 import copy
+from concurrent.futures import ThreadPoolExecutor
 
-def calibrate_ingested(ds, overlap=None, afterpulse=None, deadtime=None, c=299792458, sources=None):
+from .calibration_context import calibration_context
+from .background import BackgroundEstimator
+
+def calibrate_ingested(ds, overlap=None, afterpulse=None, deadtime=None, c=299792458, sources=None, context=None, precision='float64', threads=None, background=None):
     '''Function to produce calibrated variables for the ingested MPL data format.
     
     The base function used can be found at https://www.orau.gov/support_files/2021ARMASR/posters/P002714.pdf although it should be noted that it uses inconsistent units and doesn't use the available variables derived from the data.
@@ -28,131 +32,88 @@ def calibrate_ingested(ds, overlap=None, afterpulse=None, deadtime=None, c=29979
         afterpulse : xr.Dataset
             Dataset containing the afterpulse profile in both channels for a given height coordinate.
 
-        deadtime : xr.DataArray | 2xj np.ndarray
-            An xr.DataArray containing the deadtime correction factor as a function of signal counts (coordinate);
-            OR a 2xj np.ndarray where [0,:] contains the signal counts and [1,:] contains the deadtime correction factors for the corresponding signals.
+        deadtime : DeadtimeLUT | xr.DataArray | 2xj np.ndarray | 1D np.ndarray
+            A DeadtimeLUT, as given by load_deadtime;
+            OR an xr.DataArray containing the deadtime correction factor as a function of signal counts [counts per microsecond] (coordinate);
+            OR a 2xj np.ndarray where [0,:] contains the signal counts [counts per microsecond] and [1,:] contains the deadtime correction factors for the corresponding signals;
+            OR the coefficients of a deadtime correction polynomial in the mpl2nc convention, as a 1D np.ndarray or an xr.DataArray with the dimension dt_coeff_degree.
+            The correction is applied to the backscatter, the afterpulse and the background, as in mpl2nc's calc_nrb, through a lookup table (see deadtime.DeadtimeLUT) built once for each table. The table's source (the factors or polynomial coefficients it was built from) is stored in ds as deadtime.
 
         c : float
             The speed of light in [m/s]
 
         sources : dict
             Dictionary with the keys being 'afterpulse', 'overlap' and 'deadtime', and their values being strings containing information about the source of the values used.
+
+        context : None, CalibrationContext ; default=None
+            The height-dependent parts of the calibration, built from the height grid of ds and the afterpulse and overlap. If given, overlap, afterpulse and deadtime are taken from the context rather than the arguments. If None, the context is looked up (or built) by calibration_context, so days that share a height grid, afterpulse, overlap and deadtime reuse the same context.
+
+        precision : string ; default='float64'
+            The floating point type NRB_1, NRB_2, depol_mpl, depol_linear and NRB_total are calculated and stored in, 'float64' or 'float32'.
+            With 'float32', the data stays in the 4-byte floats of the raw files from decoding to writing, halving the memory use and output size. Writing S = backscatter*1e6 + afterpulse*energy/E0*1e6 + background for each bin (the sum of the magnitudes of the terms in the background-subtracted signal), the float32 NRB differs from the float64 NRB by at most 8 * 2^-24 * S * height_factor * time_factor (the combined range2, overlap, scaling, pulse energy and pulse frequency factors). Relative to the NRB this is 4.8e-7 * S / (S - 2*(afterpulse + background)), so is small except where the signal is close to the afterpulse and background; bins within this bound of zero may be NaN in one precision but not the other. The ratios depol_mpl and depol_linear are accurate to the sum of the relative errors of NRB_1 and NRB_2. For typical bins the relative error is around 1e-7.
+
+        threads : None, int ; default=None
+            If None or 1, the calibrated variables are calculated in a single thread. Otherwise, the number of threads the blocks of profiles are shared between (see fused_calibration). The output is bit-identical in both cases. Not used if ds is backed by dask arrays.
+
+        background : None, string, BackgroundEstimator ; default=None
+            The estimator of the background of each profile (see background.BackgroundEstimator). If a string, an estimator with that method and its default settings is used. If None, the mean signal beneath the ground is used, with the estimator held by the context.
+            The mean is accumulated in float64 (ignoring NaN bins), where it was previously the float32 mean calculated by xarray (see xarray_calibration). The two differ by around 1e-7 of the background, which changes the NRB by that amount times height_factor * time_factor. This is negligible for most bins, but is a large relative change where the signal is close to the background, e.g. relative differences of several percent in a small fraction of the bins of NRB_1.
     
     OUTPUTS:
         ds : xr.Dataset
             The ingested dataset, now with additional variables accounting for the calibration.
+
+    If ds is backed by dask arrays (e.g. opened with xr.open_mfdataset, chunked along time), nothing is loaded: the calibrated variables are returned as dask arrays, calculated chunk by chunk by fused_calibration when they are computed or written. The height dimension of the backscatter is rechunked to a single chunk if it isn't one already. The values are identical to those of the eager calculation.
     '''
     # variables are given as counts / micro-s, so an additional conversion factor is required. ALSO microjoules to joules
     micro_conv = 1e6
 
-    # boolean flags for if corrections have been given
-    used_a = False
-    used_o = False
-    used_d = False
-    # the correction factors may be given on different coordinate scales to the required values for the corrections. In this case, we will linearly interpolate between height/signal values
-    if overlap is not None:
-        used_o = True
-        if type(overlap) == xr.DataArray:
-            o = np.interp(ds.height.values, overlap.height.values, overlap.values)
-        elif type(overlap) == np.ndarray:
-            o = np.interp(ds.height.values, overlap[0,:], overlap[1,:])
-        else:
-            err_msg = 'overlap must be of type xr.DataArray or of type np.ndarray'
-            raise TypeError(err_msg)
-        overlap = xr.ones_like(ds.height) * o
-    else:
-        overlap = xr.ones_like(ds.height)
+    # the parts of the calibration that only depend on the height grid, afterpulse and overlap
+    if context is None:
+        context = calibration_context(ds['height'].values, overlap=overlap, afterpulse=afterpulse, c=c, deadtime=deadtime)
+    elif not context.matches(ds['height'].values):
+        err_msg = 'context was built for a different height grid to ds'
+        raise ValueError(err_msg)
 
-    if afterpulse is not None:
-        used_a = True
-        af1 = xr.ones_like(ds.height) * np.interp(ds.height.values, afterpulse.height.values, afterpulse.channel_1.values)
-        af2 = xr.ones_like(ds.height) * np.interp(ds.height.values, afterpulse.height.values, afterpulse.channel_2.values)
-        E0 = afterpulse.E0
-        afterpulse = xr.Dataset()
-        afterpulse['channel_1'] = af1 #* 2 / c * micro_conv
-        afterpulse['channel_2'] = af2 #* 2 / c * micro_conv
-        afterpulse['E0'] = E0
-    else:
-        afterpulse = xr.Dataset()
-        afterpulse['channel_1'] = xr.zeros_like(ds.height)
-        afterpulse['channel_2'] = xr.zeros_like(ds.height)
-        afterpulse['E0'] = 1
+    if precision not in PRECISIONS:
+        err_msg = f'precision must be one of {list(PRECISIONS)}, not {precision!r}'
+        raise ValueError(err_msg)
 
-    # TODO: implement deadtime
-    if deadtime is not None:
-        used_d = True
-        raise NotImplementedError('deadtime is not yet implemented.')
+    # boolean flags for if corrections have been given
+    used_a = context.afterpulse is not None
+    used_o = context.overlap is not None
+    used_d = context.deadtime is not None
+
+    if sources is None:
+        sources = {}
+
+    ##### NRB CALCULATION #####
+    # This will be according to the Chu Lidar textbook pg192, and my subsequent derivation considering the integration time of the instrument.
+    # NRB = (P*1e6 - afterpulse*energy/E0*1e6 - background) * height^2 / overlap / (energy/1e6) * E_photon / dz / A_det / rep_rate, with P in counts per microsecond and NRB<=0 removed.
+    # The factors applied after the background subtraction only depend on height or on time, so are folded into one vector each, and the whole calculation is done by fused_calibration in blocks of profiles.
+
+    A_det, dz, E_photon = context.A_det, context.dz, context.E_photon
+    time_factor = 1 / (ds['energy'] / np.float32(micro_conv)).astype(np.float64) # this gets us to the formula in Campbell 2002
+    time_factor = time_factor / ds['rep_rate'] # division by pulse frequency
+
+    # the background is estimated from the signal beneath the ground by default, as in Von Walden's code. A max above 10km was used previously, which is the 'high_altitude' method with quantile=1
+    if background is None:
+        background = context.background
+        if background is None:
+            err_msg = 'ds has no height bins beneath the ground, so a background estimator must be given'
+            raise ValueError(err_msg)
+    elif isinstance(background, str):
+        background = BackgroundEstimator(ds['height'].values, method=background)
+
+    if ds['backscatter_1'].chunks is not None: # dask-backed, so calculated lazily chunk by chunk
+        out = _calibrate_lazy(ds, time_factor, context, background, PRECISIONS[precision])
     else:
-        deadtime = xr.ones_like(ds.backscatter_1)
+        backscatter = {channel: ds[f'backscatter_{channel}'].transpose('time', 'height').values for channel in [1,2]}
+        out = fused_calibration(backscatter, {channel: background(backscatter[channel]) for channel in [1,2]}, context.height_factor, time_factor.values, afterpulse=context.afterpulse, energy=ds['energy'].values, E0=context.E0, deadtime=context.deadtime, dtype=PRECISIONS[precision], threads=threads)
 
-    
-    # for both channels
     for channel in [1,2]:
-        
-        '''# INITIAL form of NRB calculation
-        # start with a conversion to counts per meter
-        backscatter_h = ds[f'backscatter_{channel}'] * 2 / c * micro_conv # backscatter
-        background_h = ds[f'mn_background_{channel}'] * 2 / c * micro_conv # background
-        background_sd_h = ds[f'sd_background_{channel}'] * 2 / c * micro_conv # sd of background
-        ##### NRB CALCULATION #####
-        NRB = backscatter_h
-        if used_d: NRB = NRB * deadtime # apply deadtime correction
-        NRB = NRB - background_h # subtract background
-        if used_a: NRB = NRB - afterpulse[f'channel_{channel}'] * ds['energy'] / afterpulse['E0'] # subtract afterpulse
-        NRB = NRB * np.power(ds.height,2) # range^2 correction
-        if used_o: NRB = NRB / overlap # apply overlap correction
-        # not applying energy correction as I believe we don't have power as our stored variable...
-        #NRB = NRB / ds.energy * micro_conv # # apply energy conversion
-
-        # only interested in NRB above ground [201:] height bin
-        NRB = NRB.where(NRB.height > 0)
-        '''
-        '''
-        ##### NRB CALCULATION #####
-        # https://journals.ametsoc.org/view/journals/atot/19/4/1520-0426_2002_019_0431_ftesca_2_0_co_2.xml Campbell 2002
-
-        NRB = ds[f'backscatter_{channel}']
-        if used_d: NRB = NRB * deadtime # deadtime correction
-        NRB = NRB - ds[f'mn_background_{channel}'] # subtract background
-        if used_a: NRB = NRB - (afterpulse[f'channel_{channel}'] * ds['energy'] / afterpulse['E0']) # afterpulse correction
-        NRB = NRB * np.power(ds.height,2) # range^2 correction
-        if used_o: NRB = NRB / overlap # overlap correction
-        NRB = NRB / ds['energy'] * micro_conv # pulse energy correction
-        '''
-
-        ##### NRB CALCULATION #####
-        # This will be according to the Chu Lidar textbook pg192, and my subsequent derivation considering the integration time of the instrument.
-        
-        '''
-        # new way of calulcating background:
-        # background = ds[f'mn_background_{channel}']
-        bkg_height = 10000 # background height [m]
-        background = ds[f'backscatter_{channel}'].where(ds.height > bkg_height,drop=True)
-        background = background.max(dim='height') * 1e6 # counts per second (from per microsecond)
-        '''# Another way of calculating backgorund, taken from Von Walden's code
-        background = ds[f'backscatter_{channel}'].where(ds.height < 0,drop=True).mean(dim='height') * 1e6 # taking the signal beneath the ground, in counts per second.
-
-        # start with the initial backscatter, in counts/s
-        NRB = ds[f'backscatter_{channel}'] * 1e6 # counts per second (from per microsecond)
-        if used_d: NRB = NRB * deadtime # deadtime correction
-        if used_a: NRB = NRB - (afterpulse[f'channel_{channel}'] * ds['energy'] / afterpulse['E0'])*1e6 # afterpulse correction, conversion of per microsecond to per second.
-        NRB = NRB - background # background subtraction
-        NRB = NRB.where(NRB>0) # remove negative NRB values...
-
-        NRB = NRB * np.power(ds['height'],2) # range back in km # range2 correction
-        if used_o: NRB = NRB / overlap # overlap correction
-        NRB = NRB / (ds['energy'] / 1e6) # this gets us to the formula in Campbell 2002
-
-        # the next few calculations concern getting the answer into the units sr^-1 m^-1:
-        # The scaling factor is (E_photon) / (pulse frequency) / (detector area) / (dz for range bin)
-        A_det = np.pi/4 * (0.2032)**2 # 8-inch diameter aperture [m^2]
-        dz = np.ediff1d(ds['height']).mean() # difference between succesive elements should be uniform, but mean taken just in case... [m]
-        E_photon = (6.62607e-34)*c / (532e-9) # energy of the photon in [J]
-        NRB = NRB * E_photon / dz / A_det
-        NRB = NRB / ds['rep_rate'] # division by pulse frequency
-
         # generate attributes for the new variables
-        attrs_NRB = ATTRIBUTES_CALIBRATION['NRB']
+        attrs_NRB = copy.copy(ATTRIBUTES_CALIBRATION['NRB'])
         attrs_NRB_fmt = ['NOT ']*3
         
         if used_a: # if an afterpulse was given, store it in the dataset
@@ -162,9 +123,8 @@ def calibrate_ingested(ds, overlap=None, afterpulse=None, deadtime=None, c=29979
             if 'afterpulse' in sources:
                 attrs_aft['source'] = sources['afterpulse']
 
-            afterpulse[f'channel_{channel}'] = afterpulse[f'channel_{channel}'].assign_attrs(attrs_aft)
-            ds[f'afterpulse_{channel}'] = afterpulse[f'channel_{channel}']
-            ds['afterpulse_E0'] = afterpulse['E0'].assign_attrs(ATTRIBUTES_CALIBRATION['afterpulse_E0'])
+            ds[f'afterpulse_{channel}'] = xr.DataArray(context.afterpulse[channel], coords={'height': ds['height']}, dims=('height',), attrs=attrs_aft)
+            ds['afterpulse_E0'] = xr.DataArray(context.E0, attrs=copy.copy(ATTRIBUTES_CALIBRATION['afterpulse_E0']))
 
         if used_o: # if an overlap function was given, store it in the dataset
             attrs_NRB_fmt[1] = ''
@@ -172,8 +132,7 @@ def calibrate_ingested(ds, overlap=None, afterpulse=None, deadtime=None, c=29979
             if 'overlap' in sources:
                 attrs_overlap['source'] = sources['overlap']
             
-            overlap = overlap.assign_attrs(attrs_overlap)
-            ds['overlap'] = overlap
+            ds['overlap'] = xr.DataArray(context.overlap, coords={'height': ds['height']}, dims=('height',), attrs=attrs_overlap)
 
         if used_d: # if the deadtime correction was used, store it in the dataset
             attrs_NRB_fmt[2] = ''
@@ -181,13 +140,11 @@ def calibrate_ingested(ds, overlap=None, afterpulse=None, deadtime=None, c=29979
             if 'deadtime' in sources:
                 attrs_deadtime['source'] = sources['deadtime']
             
-            deadtime = deadtime.assign_attrs(attrs_deadtime)
-            ds['deadtime'] = deadtime
+            ds['deadtime'] = context.deadtime.to_xarray().assign_attrs(attrs_deadtime)
 
         # assign NRB with correct attributes to dataset
         attrs_NRB['comment'] = attrs_NRB['comment'].format(channel, *attrs_NRB_fmt)
-        NRB = NRB.assign_attrs(attrs_NRB)
-        ds[f'NRB_{channel}'] = NRB
+        ds[f'NRB_{channel}'] = _profile_variable(ds, out[f'NRB_{channel}'], attrs_NRB, channel=channel)
 
         # assign variables for the scaling constants
         ds['A_det'] = xr.DataArray(A_det, attrs={'long_name': 'detector area', 'units': 'm^2', 'comment': 'The detector area for a circular 8" aperture, see https://www.arm.gov/publications/tech_reports/handbooks/mpl_handbook.pdf'})
@@ -207,24 +164,209 @@ def calibrate_ingested(ds, overlap=None, afterpulse=None, deadtime=None, c=29979
         ds[f'NRB_{channel}_background_sd'] = background_sd_h
         '''
 
-    # calculate linear depolarisation ratio
+    # linear depolarisation ratio and total backscatter, calculated in fused_calibration
     # These formula are taken from Flynn et al (2007) Novel polarization-sensitive micropulse lidar measurement technique. Optics Express 15:6
-    dpol_mpl = ds['NRB_1'] / ds['NRB_2']
-    dpol_mpl = dpol_mpl.fillna(0)
-    dpol_linear = dpol_mpl / (1+ dpol_mpl)
-    
-    NRB_total = 2*ds['NRB_1'] + ds['NRB_2']
-
-    dpol_mpl = dpol_mpl.assign_attrs(ATTRIBUTES_CALIBRATION['depol_mpl'])
-    dpol_linear = dpol_linear.assign_attrs(ATTRIBUTES_CALIBRATION['depol_linear'])
-    NRB_total = NRB_total.assign_attrs(ATTRIBUTES_CALIBRATION['NRB_total'])
-    ds['depol_mpl'] = dpol_mpl
-    ds['depol_linear'] = dpol_linear
-    ds['NRB_total'] = NRB_total
+    for k in ['depol_mpl', 'depol_linear', 'NRB_total']:
+        ds[k] = _profile_variable(ds, out[k], ATTRIBUTES_CALIBRATION[k])
 
     return ds
 
 
+# the floating point types that the calibrated variables can be calculated in
+PRECISIONS = {'float64': np.float64, 'float32': np.float32}
+
+# number of profiles calibrated at a time by fused_calibration, so that the temporaries for a block stay in the cpu cache
+CALIBRATION_BLOCK_SIZE = 64
+
+def fused_calibration(backscatter, background, height_factor, time_factor, afterpulse=None, energy=None, E0=1, deadtime=None, out=None, block_size=CALIBRATION_BLOCK_SIZE, dtype=np.float64, threads=None):
+    '''Function to calculate the calibrated variables from the backscatter in both channels, in blocks of profiles written into preallocated outputs.
+
+    For each channel, NRB = (backscatter*1e6*deadtime - afterpulse*deadtime*energy/E0*1e6 - background*deadtime), with values <= 0 set to NaN, multiplied by height_factor and time_factor. The depolarisation ratios and total backscatter are then calculated from NRB_1 and NRB_2 for the same block, so that only block-sized temporaries are created.
+
+    Each block only reads its own profiles and writes to its own rows of the outputs, so the blocks can be calculated in any order. With threads, they are shared between a pool of threads; numpy releases the GIL within the arithmetic on each block. As every element is calculated by the same operations either way, the output doesn't depend on threads or block_size.
+
+    INPUTS:
+        backscatter : dict {int: np.ndarray}
+            The (time, height) backscatter for channels 1 and 2, in counts per microsecond.
+
+        background : dict {int: np.ndarray}
+            The (time,) background for channels 1 and 2, in counts per second.
+
+        height_factor : np.ndarray
+            The (height,) factor applied to the background-subtracted signal, combining the range2, overlap and scaling corrections.
+
+        time_factor : np.ndarray
+            The (time,) factor applied to the background-subtracted signal, combining the pulse energy and pulse frequency corrections.
+
+        afterpulse : None, dict {int: np.ndarray} ; default=None
+            The (height,) afterpulse profiles for channels 1 and 2, in counts per microsecond. If None, no afterpulse correction is applied.
+
+        energy : None, np.ndarray ; default=None
+            The (time,) pulse energy, required if afterpulse is given.
+
+        E0 : float ; default=1
+            The pulse energy of the afterpulse profiles.
+
+        deadtime : None, DeadtimeLUT ; default=None
+            The deadtime correction, applied to the backscatter, afterpulse and background, each at its own signal. If None, no deadtime correction is applied.
+
+        out : None, dict {string: np.ndarray} ; default=None
+            Preallocated (time, height) arrays of type dtype for any of NRB_1, NRB_2, depol_mpl, depol_linear and NRB_total. Those not given are allocated.
+
+        block_size : int ; default=CALIBRATION_BLOCK_SIZE
+            The number of profiles calculated at a time.
+
+        dtype : np.dtype ; default=np.float64
+            The floating point type the calculation is done in. The backscatter is always scaled to counts per second in float32, as it is stored.
+
+        threads : None, int ; default=None
+            If None or 1, the blocks are calculated one after another. Otherwise, the number of threads used to calculate the blocks.
+
+    OUTPUTS:
+        out : dict {string: np.ndarray}
+            The (time, height) arrays NRB_1, NRB_2, depol_mpl, depol_linear and NRB_total.
+    '''
+    shape = backscatter[1].shape
+    out = {} if out is None else dict(out)
+    for k in ['NRB_1', 'NRB_2', 'depol_mpl', 'depol_linear', 'NRB_total']:
+        if k not in out:
+            out[k] = np.empty(shape, dtype=dtype)
+    height_factor = height_factor.astype(dtype, copy=False)
+    time_factor = time_factor.astype(dtype, copy=False)
+    if deadtime is not None:
+        background = {channel: bg * deadtime.factor(bg / 1e6) for channel, bg in background.items()}
+        if afterpulse is not None:
+            afterpulse = {channel: af * deadtime.factor(af) for channel, af in afterpulse.items()}
+    if afterpulse is not None:
+        afterpulse = {channel: af.astype(dtype, copy=False) for channel, af in afterpulse.items()}
+        energy = energy.astype(dtype, copy=False)
+        E0 = np.asarray(E0).astype(dtype)
+    blocks = [slice(i0, min(i0+block_size, shape[0])) for i0 in range(0, shape[0], block_size)]
+    calibrate_block = lambda rows: _calibrate_block(rows, backscatter, background, height_factor, time_factor, afterpulse, energy, E0, deadtime, out)
+    if threads is not None and threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for _ in executor.map(calibrate_block, blocks): # raises any exception from the threads
+                pass
+    else:
+        for rows in blocks:
+            calibrate_block(rows)
+    return out
+
+
+def _calibrate_block(rows, backscatter, background, height_factor, time_factor, afterpulse, energy, E0, deadtime, out):
+    for channel in [1,2]:
+        NRB = out[f'NRB_{channel}'][rows]
+        np.multiply(backscatter[channel][rows], np.float32(1e6), out=NRB, dtype=np.float32) # counts per second (from per microsecond)
+        if deadtime is not None:
+            NRB *= deadtime.factor(backscatter[channel][rows]) # deadtime correction
+        if afterpulse is not None:
+            afterpulse_term = np.multiply.outer(energy[rows], afterpulse[channel])
+            afterpulse_term /= E0
+            afterpulse_term *= 1e6 # conversion of per microsecond to per second.
+            NRB -= afterpulse_term
+        NRB -= background[channel][rows, None] # background subtraction
+        np.copyto(NRB, np.nan, where=~(NRB > 0)) # remove negative NRB values...
+        NRB *= height_factor
+        NRB *= time_factor[rows, None]
+
+    NRB_1, NRB_2 = out['NRB_1'][rows], out['NRB_2'][rows]
+    depol_mpl, depol_linear, NRB_total = out['depol_mpl'][rows], out['depol_linear'][rows], out['NRB_total'][rows]
+    np.divide(NRB_1, NRB_2, out=depol_mpl)
+    np.copyto(depol_mpl, 0, where=np.isnan(depol_mpl))
+    np.add(depol_mpl, 1, out=depol_linear)
+    np.divide(depol_mpl, depol_linear, out=depol_linear)
+    np.multiply(NRB_1, 2, out=NRB_total)
+    NRB_total += NRB_2
+
+
+def _calibrate_lazy(ds, time_factor, context, estimator, dtype):
+    '''Function to apply fused_calibration to each time chunk of a dask-backed dataset, giving dask-backed DataArrays for the calibrated variables.
+
+    The background of each profile is found chunk by chunk. If the estimator smooths the background in time, the (time,) background is gathered into a single chunk to be smoothed.'''
+    names = ['NRB_1', 'NRB_2', 'depol_mpl', 'depol_linear', 'NRB_total']
+    def calibrate_chunk(backscatter_1, backscatter_2, background_1, background_2, time_factor, energy):
+        out = fused_calibration({1: backscatter_1, 2: backscatter_2}, {1: background_1, 2: background_2}, context.height_factor, time_factor, afterpulse=context.afterpulse, energy=energy, E0=context.E0, deadtime=context.deadtime, dtype=dtype)
+        return tuple(out[k] for k in names)
+
+    backscatter = [ds[f'backscatter_{channel}'].chunk({'height': -1}) for channel in [1,2]]
+    background = [xr.apply_ufunc(estimator.profile_background, b, input_core_dims=[['height']], dask='parallelized', output_dtypes=[np.float64]) for b in backscatter]
+    if estimator.smooth is not None and estimator.smooth > 1:
+        background = [xr.apply_ufunc(estimator.smooth_background, b.chunk({'time': -1}), input_core_dims=[['time']], output_core_dims=[['time']], dask='parallelized', output_dtypes=[np.float64]).chunk({'time': backscatter[0].chunks[0]}) for b in background]
+
+    out = xr.apply_ufunc(calibrate_chunk, *backscatter, *background, time_factor, ds['energy'],
+        input_core_dims=[['height'], ['height'], [], [], [], []],
+        output_core_dims=[['height']]*len(names),
+        dask='parallelized',
+        output_dtypes=[dtype]*len(names),
+    )
+    return {k: v.transpose('time', 'height').data for k, v in zip(names, out)}
+
+
+def _profile_variable(ds, values, attrs, channel=None):
+    '''Function to wrap a (time, height) output of fused_calibration as a DataArray with the coordinates of ds. The channel_interpretation of the backscatter is kept for the NRB of each channel.'''
+    attrs = dict(attrs)
+    if channel is not None and 'channel_interpretation' in ds[f'backscatter_{channel}'].attrs:
+        attrs = {'channel_interpretation': ds[f'backscatter_{channel}'].attrs['channel_interpretation'], **attrs}
+    return xr.DataArray(values, coords={'time': ds['time'], 'height': ds['height']}, dims=('time', 'height'), attrs=attrs)
+
+
+
+def xarray_calibration(ds, overlap=None, afterpulse=None, c=299792458):
+    '''Function to calculate the calibrated variables with whole-array xarray operations, as calibrate_ingested did before fused_calibration.
+
+    NOTE: superseded by fused_calibration. Kept as the reference that calibrate_ingested is tested against (tests/test_calibrate_ingested.py). The background here is the float32 mean of the bins beneath the ground, as calculated by xarray, rather than the float64 mean of BackgroundEstimator, and no deadtime correction is applied.
+
+    INPUTS:
+        ds : xr.Dataset
+            The dataset containing the ingested data format.
+
+        overlap : None, xr.DataArray, 2xk np.ndarray ; default=None
+            The overlap function, as for calibrate_ingested.
+
+        afterpulse : None, xr.Dataset ; default=None
+            The afterpulse profiles, as for calibrate_ingested.
+
+        c : float ; default=299792458
+            The speed of light in [m/s]
+
+    OUTPUTS:
+        out : dict {string: xr.DataArray}
+            NRB_1, NRB_2, depol_mpl, depol_linear and NRB_total, and the background of each channel (background_1, background_2) in counts per second.
+    '''
+    if overlap is not None:
+        if type(overlap) == xr.DataArray:
+            overlap = xr.ones_like(ds.height) * np.interp(ds.height.values, overlap.height.values, overlap.values)
+        else:
+            overlap = xr.ones_like(ds.height) * np.interp(ds.height.values, overlap[0,:], overlap[1,:])
+    if afterpulse is not None:
+        E0 = afterpulse.E0
+        afterpulse = {channel: xr.ones_like(ds.height) * np.interp(ds.height.values, afterpulse.height.values, afterpulse[f'channel_{channel}'].values) for channel in [1,2]}
+
+    out = {}
+    for channel in [1,2]:
+        background = ds[f'backscatter_{channel}'].where(ds.height < 0,drop=True).mean(dim='height') * 1e6 # taking the signal beneath the ground, in counts per second.
+
+        NRB = ds[f'backscatter_{channel}'] * 1e6 # counts per second (from per microsecond)
+        if afterpulse is not None: NRB = NRB - (afterpulse[channel] * ds['energy'] / E0)*1e6 # afterpulse correction, conversion of per microsecond to per second.
+        NRB = NRB - background # background subtraction
+        NRB = NRB.where(NRB>0) # remove negative NRB values...
+
+        NRB = NRB * np.power(ds['height'],2) # range2 correction
+        if overlap is not None: NRB = NRB / overlap # overlap correction
+        NRB = NRB / (ds['energy'] / 1e6) # this gets us to the formula in Campbell 2002
+
+        A_det = np.pi/4 * (0.2032)**2 # 8-inch diameter aperture [m^2]
+        dz = np.ediff1d(ds['height']).mean() # [m]
+        E_photon = (6.62607e-34)*c / (532e-9) # energy of the photon in [J]
+        NRB = NRB * E_photon / dz / A_det
+        out[f'NRB_{channel}'] = NRB / ds['rep_rate'] # division by pulse frequency
+        out[f'background_{channel}'] = background
+
+    out['depol_mpl'] = (out['NRB_1'] / out['NRB_2']).fillna(0)
+    out['depol_linear'] = out['depol_mpl'] / (1 + out['depol_mpl'])
+    out['NRB_total'] = 2*out['NRB_1'] + out['NRB_2']
+    return out
+
 
 ATTRIBUTES_CALIBRATION = {
     'NRB': {'long_name': 'attenuated backscatter', 'units': 'sr^-1 m^-1', 'comment': 'The backscatter signal for channel {} that has been range-corrected, background corrected, {}corrected for afterpulse, {}corrected for overlap and {}corrected for deadtime effects. Has also been corrected for the detector aperture, pulse energy, etc.'},
@@ -235,7 +377,7 @@ ATTRIBUTES_CALIBRATION = {
 
     'overlap': {'long_name': 'overlap correction factor', 'units': '1', 'comment': 'The overlap correction as a function of height.'},
 
-    'deadtime': {'long_name': 'deadtime correction factor', 'units': '1', 'comment': 'The deadtime correction factor as a function of received signal in counts/m.'},
+    'deadtime': {'long_name': 'deadtime correction factor', 'units': '1', 'comment': 'The source of the deadtime correction: the correction factor as a function of received signal in counts per microsecond (deadtime_signal), or the coefficients of the correction polynomial (dt_coeff_degree, highest degree first, evaluated at the signal in counts per millisecond). Applied to the backscatter, afterpulse and background.'},
 
     'NRB_background': {'long_name': 'Normalised relative backscatter background count', 'units': 'counts m^-1', 'comment': 'The background for the NRB in channel {}. Calculated from the field mn_background_{} * 2 / c * 1e6.'},
 
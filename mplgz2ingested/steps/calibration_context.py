@@ -0,0 +1,170 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+The parts of the calibration that only depend on the height grid and the afterpulse and overlap profiles, computed once and reused by calibrate_ingested for every day that shares them.
+'''
+
+import collections
+import hashlib
+import threading
+
+import numpy as np
+import xarray as xr
+
+from .deadtime import deadtime_lut, DeadtimeLUT
+from .background import BackgroundEstimator
+
+# the number of contexts kept by calibration_context
+CONTEXT_CACHE_SIZE = 8
+_CONTEXT_CACHE = collections.OrderedDict()
+_CONTEXT_CACHE_LOCK = threading.Lock()
+
+class CalibrationContext:
+    '''The height-dependent parts of the calibration for a given height grid, afterpulse and overlap.
+
+    Holds the afterpulse and overlap profiles interpolated to the height grid, the deadtime correction lookup table, the scaling constants A_det, dz and E_photon, the combined per-height factor applied to the NRB (range2, overlap and scaling corrections), and the default background estimator, which uses the range bins beneath the ground.
+
+    INPUTS:
+        height : np.ndarray
+            The height grid of the data being calibrated [m].
+
+        overlap : None, xr.DataArray, 2xk np.ndarray ; default=None
+            The overlap function, as for calibrate_ingested. If None, no overlap correction is applied.
+
+        afterpulse : None, xr.Dataset ; default=None
+            The afterpulse profiles, as for calibrate_ingested. If None, no afterpulse correction is applied.
+
+        c : float ; default=299792458
+            The speed of light in [m/s]
+
+        deadtime : None, DeadtimeLUT, xr.DataArray, np.ndarray ; default=None
+            The deadtime correction, as for calibrate_ingested. It is held as a DeadtimeLUT. If None, no deadtime correction is applied.
+    '''
+
+    def __init__(self, height, overlap=None, afterpulse=None, c=299792458, deadtime=None):
+        self.height = np.asarray(height)
+        self.key = context_key(self.height, overlap, afterpulse, c, deadtime)
+
+        # the correction factors may be given on different coordinate scales to the required values for the corrections. In this case, we will linearly interpolate between height values
+        self.overlap = None
+        if overlap is not None:
+            if type(overlap) == xr.DataArray:
+                self.overlap = np.interp(self.height, overlap.height.values, overlap.values)
+            elif type(overlap) == np.ndarray:
+                self.overlap = np.interp(self.height, overlap[0,:], overlap[1,:])
+            else:
+                err_msg = 'overlap must be of type xr.DataArray or of type np.ndarray'
+                raise TypeError(err_msg)
+
+        self.afterpulse = None
+        self.E0 = None
+        if afterpulse is not None:
+            self.afterpulse = {channel: np.interp(self.height, afterpulse.height.values, afterpulse[f'channel_{channel}'].values) for channel in [1,2]}
+            self.E0 = afterpulse['E0'].values
+
+        self.deadtime = None if deadtime is None else deadtime_lut(deadtime)
+
+        # The scaling factor is (E_photon) / (pulse frequency) / (detector area) / (dz for range bin)
+        self.A_det = np.pi/4 * (0.2032)**2 # 8-inch diameter aperture [m^2]
+        self.dz = np.ediff1d(self.height).mean() # difference between succesive elements should be uniform, but mean taken just in case... [m]
+        self.E_photon = (6.62607e-34)*c / (532e-9) # energy of the photon in [J]
+
+        height_factor = np.power(self.height, 2).astype(np.float64) # range2 correction
+        if self.overlap is not None: height_factor = height_factor / self.overlap # overlap correction
+        self.height_factor = height_factor * self.E_photon / self.dz / self.A_det
+
+        # the default background estimator, from the bins beneath the ground (if there are any)
+        try:
+            self.background = BackgroundEstimator(self.height, method='below_ground')
+        except ValueError:
+            self.background = None
+
+    def matches(self, height):
+        '''Function to check whether the context was built for a height grid.'''
+        height = np.asarray(height)
+        return height.shape == self.height.shape and np.array_equal(height, self.height)
+
+
+def calibration_context(height, overlap=None, afterpulse=None, c=299792458, deadtime=None):
+    '''Function to get the CalibrationContext for a height grid, afterpulse and overlap, reusing a previously built context if one exists for the same inputs.
+
+    INPUTS:
+        height : np.ndarray
+            The height grid of the data being calibrated [m].
+
+        overlap : None, xr.DataArray, 2xk np.ndarray ; default=None
+            The overlap function, as for calibrate_ingested.
+
+        afterpulse : None, xr.Dataset ; default=None
+            The afterpulse profiles, as for calibrate_ingested.
+
+        c : float ; default=299792458
+            The speed of light in [m/s]
+
+        deadtime : None, DeadtimeLUT, xr.DataArray, np.ndarray ; default=None
+            The deadtime correction, as for calibrate_ingested.
+
+    OUTPUTS:
+        context : CalibrationContext
+            The context for these inputs. The last CONTEXT_CACHE_SIZE contexts are kept. Contexts are shared between threads, and aren't modified after they are built.
+    '''
+    key = context_key(height, overlap, afterpulse, c, deadtime)
+    with _CONTEXT_CACHE_LOCK:
+        context = _CONTEXT_CACHE.get(key)
+        if context is None:
+            context = CalibrationContext(height, overlap=overlap, afterpulse=afterpulse, c=c, deadtime=deadtime)
+            _CONTEXT_CACHE[key] = context
+            while len(_CONTEXT_CACHE) > CONTEXT_CACHE_SIZE:
+                _CONTEXT_CACHE.popitem(last=False)
+        else:
+            _CONTEXT_CACHE.move_to_end(key)
+    return context
+
+
+def context_key(height, overlap=None, afterpulse=None, c=299792458, deadtime=None):
+    '''Function to compute the key identifying a CalibrationContext, from a hash of the height grid and of the afterpulse, overlap and deadtime values.
+
+    The values are hashed rather than their sources, so that profiles loaded from the same source are recognised without relying on the source strings being unique.
+
+    INPUTS:
+        height : np.ndarray
+            The height grid of the data being calibrated [m].
+
+        overlap : None, xr.DataArray, 2xk np.ndarray ; default=None
+            The overlap function.
+
+        afterpulse : None, xr.Dataset ; default=None
+            The afterpulse profiles.
+
+        c : float ; default=299792458
+            The speed of light in [m/s]
+
+        deadtime : None, DeadtimeLUT, xr.DataArray, np.ndarray ; default=None
+            The deadtime correction.
+
+    OUTPUTS:
+        key : tuple
+            Hexadecimal digests of the height grid, afterpulse and overlap, c, and a digest of the deadtime.
+    '''
+    if afterpulse is not None:
+        afterpulse = [afterpulse.height.values, afterpulse.channel_1.values, afterpulse.channel_2.values, afterpulse.E0.values]
+    if type(overlap) == xr.DataArray:
+        overlap = [overlap.height.values, overlap.values]
+    if isinstance(deadtime, DeadtimeLUT):
+        deadtime = [deadtime.signal, deadtime.table]
+    elif type(deadtime) == xr.DataArray:
+        deadtime = [deadtime[deadtime.dims[0]].values, deadtime.values]
+    return (_hash_arrays([height]), _hash_arrays(afterpulse), _hash_arrays(overlap), c, _hash_arrays(deadtime))
+
+
+def _hash_arrays(arrays):
+    if arrays is None:
+        return None
+    if isinstance(arrays, np.ndarray):
+        arrays = [arrays]
+    h = hashlib.blake2b(digest_size=16)
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(f'{a.dtype.str}{a.shape}'.encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
@@ -0,0 +1,138 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Deadtime correction for the MPL detectors, as a dense lookup table that is built once per detector table and applied to the (time, height) backscatter by indexing.
+'''
+
+import warnings
+
+import numpy as np
+import xarray as xr
+
+# the number of entries in a DeadtimeLUT
+DEADTIME_LUT_SIZE = 2**16
+
+# the largest signal covered by a DeadtimeLUT built from polynomial coefficients, in counts per microsecond
+DEADTIME_MAX_SIGNAL = 50.
+
+class DeadtimeLUT:
+    '''Deadtime correction factor as a function of signal, tabulated on a uniform grid.
+
+    The factor for a signal x is the entry of the table nearest to x, so the correction of a whole array is a single index-and-multiply. With the default size of 2^16 entries, the error from using the nearest entry is at most half of the grid spacing times the slope of the correction factor.
+
+    Signals outside of the grid are given the factor at its nearest end, and a warning is given for signals above it. This differs from mpl2nc, which warns and uses a factor of 1 for signals above its table (a factor of 1 would make the correction drop as the detector saturates, rather than staying at its largest value).
+
+    The signals and factors (or polynomial coefficients) the table was built from are kept, and are what is stored in the calibrated datasets (see to_xarray), rather than the table itself.
+
+    INPUTS:
+        signal : np.ndarray
+            The signal values [counts per microsecond] that the correction factors are given for, in increasing order.
+
+        factor : np.ndarray
+            The deadtime correction factors for the corresponding signal values. The table is linearly interpolated between them.
+
+        size : int ; default=DEADTIME_LUT_SIZE
+            The number of entries in the table.
+    '''
+
+    def __init__(self, signal, factor, size=DEADTIME_LUT_SIZE):
+        signal = np.asarray(signal, dtype=np.float64)
+        factor = np.asarray(factor, dtype=np.float64)
+        if signal.ndim != 1 or signal.shape != factor.shape or signal.size < 2:
+            err_msg = 'signal and factor must be 1D arrays of the same length, with at least 2 values'
+            raise ValueError(err_msg)
+        if np.any(np.diff(signal) <= 0):
+            err_msg = 'signal must be strictly increasing'
+            raise ValueError(err_msg)
+        self.source_signal = signal
+        self.source_factor = factor
+        self.coeff = None
+        self.x0 = signal[0]
+        self.dx = (signal[-1] - signal[0]) / (size - 1)
+        self.signal = self.x0 + self.dx * np.arange(size)
+        self.table = np.interp(self.signal, signal, factor)
+
+    @classmethod
+    def from_coefficients(cls, coeff, max_signal=DEADTIME_MAX_SIGNAL, size=DEADTIME_LUT_SIZE):
+        '''Function to build a DeadtimeLUT from the coefficients of a deadtime correction polynomial, as read by mpl2nc from the .bin files supplied with the instrument.
+
+        As in mpl2nc, the polynomial is evaluated at the signal in counts per millisecond (the signal in counts per microsecond * 1e3), with the coefficients ordered from the highest degree (see dt_coeff_degree).
+
+        INPUTS:
+            coeff : np.ndarray
+                The polynomial coefficients, highest degree first.
+
+            max_signal : float ; default=DEADTIME_MAX_SIGNAL
+                The largest signal covered by the table [counts per microsecond].
+
+            size : int ; default=DEADTIME_LUT_SIZE
+                The number of entries in the table.
+
+        OUTPUTS:
+            lut : DeadtimeLUT
+        '''
+        coeff = np.asarray(coeff, dtype=np.float64)
+        signal = np.linspace(0, max_signal, size)
+        lut = cls(signal, np.polyval(coeff, signal*1e3), size=size)
+        lut.coeff = coeff
+        return lut
+
+    def factor(self, signal):
+        '''Function to get the deadtime correction factors for an array of signals.
+
+        INPUTS:
+            signal : np.ndarray
+                The signal [counts per microsecond].
+
+        OUTPUTS:
+            factor : np.ndarray
+                The correction factors, with the same shape as signal. The factor of a NaN signal (e.g. a masked fill value) is NaN.
+        '''
+        index = (signal - self.x0) * (1 / self.dx) + 0.5
+        nan = np.isnan(index) # NaN can't be cast to an index
+        has_nan = nan.any()
+        if has_nan:
+            index[nan] = 0
+        if index.size > 0 and index.max() > self.table.size:
+            warnings.warn(f'signals above the largest signal of the deadtime correction table ({self.signal[-1]:.4g} counts per microsecond) are given the factor at its end')
+        np.clip(index, 0, self.table.size - 1, out=index)
+        factor = self.table.take(index.astype(np.intp))
+        if has_nan:
+            factor[nan] = np.nan
+        return factor
+
+    def to_xarray(self):
+        '''Function to get the source of the table as a DataArray, which can be given to deadtime_lut to build the table again.
+
+        If the table was built from polynomial coefficients, they are given along the dimension dt_coeff_degree (as read by mpl2nc). Otherwise, the factors it was built from are given, with the signal as the coordinate deadtime_signal.'''
+        if self.coeff is not None:
+            return xr.DataArray(self.coeff, coords={'dt_coeff_degree': np.arange(self.coeff.size)[::-1]}, dims='dt_coeff_degree')
+        return xr.DataArray(self.source_factor, coords={'deadtime_signal': xr.DataArray(self.source_signal, dims='deadtime_signal', attrs={'long_name': 'signal', 'units': 'counts / microsecond'})}, dims='deadtime_signal')
+
+
+def deadtime_lut(deadtime):
+    '''Function to build a DeadtimeLUT from any of the forms of deadtime correction accepted by calibrate_ingested.
+
+    INPUTS:
+        deadtime : DeadtimeLUT, xr.DataArray, np.ndarray
+            If a DeadtimeLUT, it is returned unchanged.
+            If a xr.DataArray with the dimension dt_coeff_degree, or a 1D np.ndarray, the coefficients of a deadtime correction polynomial, highest degree first (see DeadtimeLUT.from_coefficients).
+            If any other xr.DataArray, the correction factor as a function of its coordinate, the signal in counts per microsecond.
+            If a 2xj np.ndarray, [0,:] contains the signal in counts per microsecond and [1,:] contains the correction factors for the corresponding signals.
+
+    OUTPUTS:
+        lut : DeadtimeLUT
+    '''
+    if isinstance(deadtime, DeadtimeLUT):
+        return deadtime
+    if type(deadtime) == xr.DataArray:
+        if 'dt_coeff_degree' in deadtime.dims:
+            coeff = deadtime.sortby('dt_coeff_degree', ascending=False).values if 'dt_coeff_degree' in deadtime.coords else deadtime.values
+            return DeadtimeLUT.from_coefficients(coeff)
+        return DeadtimeLUT(deadtime[deadtime.dims[0]].values, deadtime.values)
+    if type(deadtime) == np.ndarray:
+        if deadtime.ndim == 1:
+            return DeadtimeLUT.from_coefficients(deadtime)
+        return DeadtimeLUT(deadtime[0,:], deadtime[1,:])
+    err_msg = 'deadtime must be of type DeadtimeLUT, xr.DataArray or np.ndarray'
+    raise TypeError(err_msg)
@@ -0,0 +1,238 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+On-disk cache of decoded .mpl.gz files, so that reprocessing the raw archive can skip the decompression and decoding of every file.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+# environment variables used to configure the default cache, see resolve_cache
+CACHE_DIR_ENV = 'MPLGZ2INGESTED_CACHE_DIR'
+CACHE_SIZE_ENV = 'MPLGZ2INGESTED_CACHE_MAX_BYTES'
+
+class DecodeCache:
+    '''Cache of decoded .mpl files, stored as one uncompressed .npy file per variable.
+
+    Each decoded file is stored in an entry directory named by a hash of the file contents. Small key files map the (path, size, mtime) of a source file to its content hash, so that unchanged files are found without being read; a file that has been touched or moved is hashed and still found if its contents are already cached.
+
+    Entries are written to a temporary directory and renamed into place, so several processes can share a cache. When the total size exceeds max_bytes, the least recently used entries are removed.
+
+    INPUTS:
+        directory : string
+            The directory the cache is stored in. It is created if it doesn't exist.
+
+        max_bytes : float ; default=20e9
+            The maximum total size of the cached entries, in bytes.
+    '''
+
+    def __init__(self, directory, max_bytes=20e9):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self._total_bytes = None
+        for sub in ['entries', 'keys', 'tmp']:
+            os.makedirs(os.path.join(self.directory, sub), exist_ok=True)
+
+    def get(self, fname):
+        '''Function to get the decoded contents of a file from the cache.
+
+        INPUTS:
+            fname : string
+                Full filename of the .mpl.gz or .mpl file.
+
+        OUTPUTS:
+            mpl : dictionary, None
+                The decoded mpl dictionary, with the arrays memory-mapped from the cache. None if the file isn't cached.
+        '''
+        return self.lookup(fname)[0]
+
+    def lookup(self, fname):
+        '''Function to get the decoded contents of a file from the cache, along with the content hash of the file.
+
+        The content hash can be passed to put after a miss, so that the file isn't hashed a second time.
+
+        INPUTS:
+            fname : string
+                Full filename of the .mpl.gz or .mpl file.
+
+        OUTPUTS:
+            mpl : dictionary, None
+                The decoded mpl dictionary, with the arrays memory-mapped from the cache. None if the file isn't cached.
+
+            content_hash : string
+                The content hash of the file (see file_hash).
+        '''
+        key_path = self._key_path(fname)
+        content_hash = None
+        if os.path.isfile(key_path):
+            with open(key_path) as f:
+                content_hash = f.read().strip()
+            if not os.path.isdir(self._entry_path(content_hash)): # entry has since been evicted
+                content_hash = None
+        if content_hash is None:
+            content_hash = file_hash(fname)
+            if not os.path.isdir(self._entry_path(content_hash)):
+                return None, content_hash
+            self._write_key(key_path, content_hash)
+
+        entry = self._entry_path(content_hash)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+            mpl = {k: np.load(os.path.join(entry, f'{k}.npy'), mmap_mode='r' if meta['shapes'][k] else None) for k in meta['shapes']}
+        except (OSError, ValueError): # entry removed by another process part way through
+            return None, content_hash
+        mpl = {k: v[()] if v.ndim == 0 else v for k, v in mpl.items()}
+        os.utime(os.path.join(entry, 'meta.json')) # mark as recently used
+        return mpl, content_hash
+
+    def n_records(self, fname):
+        '''Function to get the number of records of a cached file, without hashing the file or reading the cached arrays.
+
+        INPUTS:
+            fname : string
+                Full filename of the .mpl.gz or .mpl file.
+
+        OUTPUTS:
+            n_records : int, None
+                The number of records in the file. None if the file isn't cached under its current path, size and mtime.
+        '''
+        try:
+            with open(self._key_path(fname)) as f:
+                content_hash = f.read().strip()
+            with open(os.path.join(self._entry_path(content_hash), 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError): # not cached, or the entry has since been evicted
+            return None
+        return int(meta['shapes']['time'][0])
+
+    def put(self, fname, mpl, content=None, content_hash=None):
+        '''Function to store the decoded contents of a file in the cache.
+
+        INPUTS:
+            fname : string
+                Full filename of the .mpl.gz or .mpl file that was decoded.
+
+            mpl : dictionary
+                The decoded mpl dictionary, as given by load_raw.read_mpl.
+
+            content : None, bytes ; default=None
+                The raw contents of fname, if already read, to avoid reading the file again to hash it.
+
+            content_hash : None, string ; default=None
+                The content hash of fname, if already known (e.g. from lookup), to avoid hashing it again.
+        '''
+        if content_hash is None:
+            content_hash = file_hash(fname) if content is None else hashlib.blake2b(content, digest_size=16).hexdigest()
+        entry = self._entry_path(content_hash)
+        if not os.path.isdir(entry):
+            tmp = os.path.join(self.directory, 'tmp', uuid.uuid4().hex)
+            os.makedirs(tmp)
+            shapes = {}
+            for k, v in mpl.items():
+                v = np.asarray(v)
+                np.save(os.path.join(tmp, f'{k}.npy'), v)
+                shapes[k] = v.shape
+            nbytes = sum(os.path.getsize(os.path.join(tmp, f'{k}.npy')) for k in shapes)
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({'source': os.path.abspath(fname), 'shapes': shapes, 'nbytes': nbytes}, f)
+            try:
+                os.rename(tmp, entry)
+            except OSError: # another process cached the same contents first
+                shutil.rmtree(tmp, ignore_errors=True)
+            else:
+                if self._total_bytes is not None:
+                    self._total_bytes += nbytes
+        self._write_key(self._key_path(fname), content_hash)
+        self.evict()
+
+    def evict(self):
+        '''Function to remove the least recently used entries until the cache is no larger than max_bytes.'''
+        if self._total_bytes is not None and self._total_bytes <= self.max_bytes:
+            return
+        entries = []
+        for e in os.scandir(os.path.join(self.directory, 'entries')):
+            try:
+                meta_path = os.path.join(e.path, 'meta.json')
+                with open(meta_path) as f:
+                    nbytes = json.load(f)['nbytes']
+                entries.append((os.path.getmtime(meta_path), nbytes, e.path))
+            except (OSError, ValueError):
+                continue
+        entries.sort()
+        self._total_bytes = sum(e[1] for e in entries)
+        for _, nbytes, path in entries:
+            if self._total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            self._total_bytes -= nbytes
+
+    def _key_path(self, fname):
+        st = os.stat(fname)
+        key = f'{os.path.abspath(fname)}|{st.st_size}|{st.st_mtime_ns}'
+        return os.path.join(self.directory, 'keys', hashlib.sha1(key.encode()).hexdigest())
+
+    def _entry_path(self, content_hash):
+        return os.path.join(self.directory, 'entries', content_hash)
+
+    def _write_key(self, key_path, content_hash):
+        tmp = f'{key_path}.{uuid.uuid4().hex}'
+        with open(tmp, 'w') as f:
+            f.write(content_hash)
+        os.replace(tmp, key_path)
+
+
+def file_hash(fname):
+    '''Function to compute the content hash of a file used to identify cache entries.
+
+    INPUTS:
+        fname : string
+            Full filename of the file to be hashed.
+
+    OUTPUTS:
+        content_hash : string
+            Hexadecimal blake2b digest of the file contents.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def resolve_cache(cache):
+    '''Function to determine the decode cache to use in the load_raw functions.
+
+    INPUTS:
+        cache : None, False, string, DecodeCache
+            If a DecodeCache, it is used directly. If a string, a DecodeCache is created in that directory. If False, no cache is used. If None, a DecodeCache is created in the directory given by the MPLGZ2INGESTED_CACHE_DIR environment variable (with the size limit from MPLGZ2INGESTED_CACHE_MAX_BYTES), or no cache is used if it isn't set.
+
+    OUTPUTS:
+        cache : DecodeCache, None
+            The cache to be used, or None. The DecodeCache for a directory (and size limit) is created once and reused by later calls, so that its record of the total size of the entries is kept between files.
+    '''
+    if cache is False:
+        return None
+    max_bytes = None
+    if cache is None:
+        directory = os.environ.get(CACHE_DIR_ENV)
+        if not directory:
+            return None
+        cache = directory
+        if os.environ.get(CACHE_SIZE_ENV):
+            max_bytes = float(os.environ[CACHE_SIZE_ENV])
+    if isinstance(cache, str):
+        key = (os.path.abspath(cache), max_bytes)
+        if key not in _CACHES:
+            _CACHES[key] = DecodeCache(cache) if max_bytes is None else DecodeCache(cache, max_bytes=max_bytes)
+        return _CACHES[key]
+    return cache
+
+
+# the caches created by resolve_cache, by directory and size limit
+_CACHES = {}
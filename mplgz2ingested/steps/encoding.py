@@ -0,0 +1,87 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Named netcdf encoding profiles for the ingested and calibrated datasets, setting the compression, packing and chunk shapes of the variables when they are written.
+'''
+
+import numpy as np
+
+# the calibrated variables, which are stored as floats in the profile's dtype
+CALIBRATED_VARIABLES = ['NRB_1', 'NRB_2', 'NRB_total', 'depol_mpl', 'depol_linear']
+
+# The encoding profiles:
+#   complevel : the zlib compression level (with the shuffle filter) of every variable with the time dimension.
+#   time_chunk : the number of profiles in a chunk. Chunks always contain the full height column. The chunks are a number of profiles, not a length of time: 720 profiles is an hour at the default 5 second resolution of the raw data, and longer at lower resolutions.
+#   dtype : the floating point type the calibrated variables are stored in.
+#   significant_digits : if not None, the calibrated variables are quantized to this many significant decimal digits with netCDF-c's BitGroom quantization, so that they compress better.
+#   packed : calibrated variables stored as int16, as {name: (scale_factor, add_offset)}.
+ENCODING_PROFILES = {
+    'archive': {'complevel': 4, 'time_chunk': 720, 'dtype': 'float32', 'significant_digits': None, 'packed': {}},
+    'fast-read': {'complevel': 1, 'time_chunk': 720, 'dtype': 'float32', 'significant_digits': None, 'packed': {}},
+    'minimal': {'complevel': 6, 'time_chunk': 720, 'dtype': 'float32', 'significant_digits': 3, 'packed': {'depol_linear': (1/32000, 0.)}},
+}
+
+# the _FillValue of the int16 packed variables
+PACKED_FILL_VALUE = np.int16(-32768)
+
+def output_encoding(ds, profile='archive', dim='time', unlimited=False, backend='netcdf'):
+    '''Function to build the encoding argument of xr.Dataset.to_netcdf for a dataset, from a named encoding profile.
+
+    The profiles are:
+        'archive' : every variable with the time dimension is compressed with zlib (level 4) and the shuffle filter, and the calibrated variables are stored as float32. The raw backscatter is stored exactly. Storing the calibrated variables as float32 rounds them to a relative error of at most 6e-8.
+        'fast-read' : as 'archive', but with zlib level 1, so the files are slightly larger but are written and read faster. The differences depend on the data; benchmarks/encoding_profiles.py measures them for a calibrated day.
+        'minimal' : zlib level 6, with the calibrated variables quantized to 3 significant decimal digits (BitGroom) and depol_linear (which is between 0 and 1) packed into int16 with a resolution of 1/32000. For quicklooks and transfers, not for further analysis.
+    In every profile, the chunks of the variables with the time dimension are a block of profiles (see ENCODING_PROFILES) by the full height column, so reading a time range only decompresses the chunks it covers.
+
+    For the 'zarr' backend, the chunks, dtypes and packing of the profile are used, but the arrays are compressed with the zarr default compressor and the quantization of 'minimal' isn't applied, as it is done by the netcdf library.
+
+    INPUTS:
+        ds : xr.Dataset
+            The dataset to be written.
+
+        profile : None, string ; default='archive'
+            The name of the encoding profile, one of ENCODING_PROFILES. If None, no encoding is given, so the variables are written uncompressed and unchunked, in the dtypes of ds.
+
+        dim : string ; default='time'
+            The time dimension that the chunks are blocks of.
+
+        unlimited : bool ; default=False
+            Whether dim will be an unlimited dimension of the file, as for write_netcdf. If so, the chunks are a full block of profiles even if ds has fewer, so that profiles appended later fill them.
+
+        backend : string ; default='netcdf'
+            The format being written, 'netcdf' (xr.Dataset.to_netcdf) or 'zarr' (xr.Dataset.to_zarr).
+
+    OUTPUTS:
+        encoding : dict
+            The encoding for each variable, to be passed to xr.Dataset.to_netcdf or xr.Dataset.to_zarr.
+    '''
+    if profile is None:
+        return {}
+    if profile not in ENCODING_PROFILES:
+        err_msg = f'profile must be one of {list(ENCODING_PROFILES)}, not {profile!r}'
+        raise ValueError(err_msg)
+    if backend not in ['netcdf', 'zarr']:
+        err_msg = f"backend must be 'netcdf' or 'zarr', not {backend!r}"
+        raise ValueError(err_msg)
+    settings = ENCODING_PROFILES[profile]
+
+    time_chunk = settings['time_chunk'] if unlimited else max(1, min(settings['time_chunk'], ds.sizes.get(dim, 0)))
+    encoding = {}
+    for k, variable in ds.variables.items():
+        if dim not in variable.dims:
+            continue
+        chunks = tuple(time_chunk if d == dim else ds.sizes[d] for d in variable.dims)
+        if backend == 'zarr':
+            enc = {'chunks': chunks}
+        else:
+            enc = {'zlib': True, 'complevel': settings['complevel'], 'shuffle': True, 'chunksizes': chunks}
+        if k in CALIBRATED_VARIABLES:
+            if k in settings['packed']:
+                scale_factor, add_offset = settings['packed'][k]
+                enc.update({'dtype': 'int16', 'scale_factor': scale_factor, 'add_offset': add_offset, '_FillValue': PACKED_FILL_VALUE})
+            else:
+                enc['dtype'] = settings['dtype']
+                if settings['significant_digits'] is not None and backend == 'netcdf':
+                    enc.update({'significant_digits': settings['significant_digits'], 'quantize_mode': 'BitGroom'})
+        encoding[k] = enc
+    return encoding
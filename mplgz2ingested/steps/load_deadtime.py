@@ -0,0 +1,34 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Function to load a deadtime correction file for use in steps.calibrate_ingested()
+'''
+
+import mpl2nc
+
+from .deadtime import deadtime_lut, DeadtimeLUT
+
+def load_deadtime(fname_deadtime):
+    '''Function to load the deadtime correction for the calibration process, from either of the file formats read by mpl2nc.
+
+    INPUTS:
+        fname_deadtime : string, None
+            Full filename for the deadtime correction. A .csv file must contain the columns "count" (the signal in counts per microsecond) and "factor". Any other file is read as the binary polynomial coefficients supplied with the instrument. If None, returns None values (no deadtime correction).
+
+    OUTPUTS:
+        deadtime : DeadtimeLUT, None
+            Lookup table of the deadtime correction factors, for use in calibrate_ingested.
+
+        source : string, None
+            String describing where the deadtime correction has come from.
+    '''
+    if fname_deadtime is None:
+        return None, None
+    if fname_deadtime.lower().endswith('.csv'):
+        d = mpl2nc.read_dt_csv(fname_deadtime)
+        deadtime = DeadtimeLUT(d['dt_count']*1e-3, d['dt_factor'])
+    else:
+        with open(fname_deadtime, 'rb') as f:
+            d = mpl2nc.read_dt(f)
+        deadtime = deadtime_lut(d['dt_coeff'])
+    return deadtime, fname_deadtime
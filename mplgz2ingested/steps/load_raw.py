@@ -5,15 +5,23 @@ Script to allow for the loading of .mpl.gz files without having to explicitly un
 '''
 import mpl2nc
 import gzip
+import zlib
 import os
 import datetime as dt
+import numpy as np
 import xarray as xr
-import netCDF4
 import glob
 
-from contextlib import nullcontext
+import mmap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-def load_raw(fname, dir='/', verbose=False):
+from .decode_cache import resolve_cache
+
+# size in bytes of the standard .mpl record header, before any secondary (weather station) header
+MPL_HEADER_SIZE = 128
+
+def load_raw(fname, dir='/', verbose=False, cache=None, fields=None, bins=None):
     '''Function to load raw mpl data into an xarray format.
     
     INPUTS:
@@ -26,6 +34,15 @@ def load_raw(fname, dir='/', verbose=False):
         verbose : bool ; default=False
             Flag for printing debug statements.
 
+        cache : None, False, string, DecodeCache ; default=None
+            The decode cache to use, see decode_cache.resolve_cache.
+
+        fields : None, list [string] ; default=None
+            If given, only these variables are loaded and the mpl2nc NRB processing is skipped, see raw_to_ingested.ingest_projection. 'time' is always loaded.
+
+        bins : None, slice ; default=None
+            If given, only these range bins of the channel data are loaded.
+
     OUTPUTS:
         ds : xarray.Dataset
             The loaded MPL data as an xarray dataset format. This will be accepted by raw_to_ingested
@@ -34,16 +51,16 @@ def load_raw(fname, dir='/', verbose=False):
     try:
         if os.path.isfile(os.path.join(dir,fname)):# in this instance, single file loading.
             if verbose: print('loading single file')
-            return load_mplgz(os.path.join(dir,fname))
+            return load_mplgz(os.path.join(dir,fname), cache=cache, fields=fields, bins=bins)
         else:
             if verbose: print('loading from globstring')
-            return load_fromglob(fname,dir)
+            return load_fromglob(fname,dir,cache=cache,fields=fields,bins=bins)
     except TypeError as err:
         if verbose: print('fname not string, attempting mfload')
-        return load_fromlist(fname,dir)
+        return load_fromlist(fname,dir,cache=cache,fields=fields,bins=bins)
 
 
-def load_mplgz(fname):
+def load_mplgz(fname, cache=None, fields=None, bins=None):
     '''Function to load .mpl.gz files from the archive without the need to create additional files.
     
     This will work by opening the .gz file in a binary read mode, and then using functions from mpl2nc to read the binary format.
@@ -54,22 +71,258 @@ def load_mplgz(fname):
         fname : string
             Full filename of the .mpl.gz file to be opened, including the file extension.
 
+        cache : None, False, string, DecodeCache ; default=None
+            The decode cache to use, see decode_cache.resolve_cache.
+
+        fields : None, list [string] ; default=None
+            If given, only these variables are loaded and the mpl2nc NRB processing is skipped, see raw_to_ingested.ingest_projection. 'time' is always loaded.
+
+        bins : None, slice ; default=None
+            If given, only these range bins of the channel data are loaded.
+
     OUTPUTS:
         ds : xr.Dataset
             The loaded mpl data as an xarray dataset, which can be accepted by raw_to_ingested.py
     '''
-    # same method as extract_mpl2nc, except utilising gzip.open().
-    mpl = mpl2nc_read_mpl_gzip(fname)
-    mpl = mpl2nc.process_nrb(mpl)
+    # decode the whole file in bulk rather than profile-by-profile through mpl2nc
+    mpl = read_mpl(fname, cache=cache, bins=bins)
+    if fields is None:
+        mpl = mpl2nc.process_nrb(mpl)
+    else:
+        mpl = {k: v for k, v in mpl.items() if k in fields or k == 'time'}
     # convert mpl to xr.Dataset format
     ds = mpl_dict_to_xarray(mpl)
     return ds
 
 
+def read_mpl(fname, cache=None, profiles=None, bins=None):
+    '''Function to read a .mpl.gz or .mpl file into the mpl2nc dictionary format, decoding all of the records at once.
+
+    A .gz file is decompressed in a single call, and the fixed-size records are then interpreted in bulk with a numpy structured dtype (see mpl_record_dtype), rather than reading each profile with mpl2nc.read_mpl_profile. An uncompressed .mpl file is instead memory-mapped (see memmap_mpl_records), so that only the parts of the file that are used are read from disk.
+
+    If a decode cache is in use and already holds a .gz file, the decoded arrays are instead memory-mapped from the cache. Uncompressed files are never cached, as they can already be mapped directly.
+
+    The channel data are returned as views into the decoded (or mapped) records; selecting profiles and bins as slices keeps them as views, so the data are only copied when they are used.
+
+    INPUTS:
+        fname : string
+            Full filename of the .mpl.gz or .mpl file to be opened, including the file extension.
+
+        cache : None, False, string, DecodeCache ; default=None
+            The decode cache to use, see decode_cache.resolve_cache.
+
+        profiles : None, slice, np.ndarray ; default=None
+            If given, the profiles (records) to be returned. None returns all of the profiles.
+
+        bins : None, slice ; default=None
+            If given, the range bins of the channel data to be returned. None returns all of the bins.
+
+    OUTPUTS:
+        mpl : dictionary
+            Dictionary containing the same variables as mpl2nc.process_mpl would produce.
+    '''
+    if fname[-3:] != '.gz':
+        mpl = mpl_records_to_dict(memmap_mpl_records(fname))
+        return select_mpl(mpl, profiles, bins)
+
+    cache = resolve_cache(cache)
+    if cache is not None:
+        mpl, content_hash = cache.lookup(fname)
+        if mpl is not None:
+            return select_mpl(mpl, profiles, bins)
+
+    with open(fname, 'rb') as f:
+        content = f.read()
+    mpl = decode_mpl_buffer(gzip.decompress(content))
+    if cache is not None:
+        cache.put(fname, mpl, content_hash=content_hash)
+    return select_mpl(mpl, profiles, bins)
+
+
+def memmap_mpl_records(fname):
+    '''Function to memory-map the records of an uncompressed .mpl file as a numpy structured array.
+
+    The layout is found from the first header (see scan_layout), and the file is then mapped read-only with np.memmap. Indexing the result gives zero-copy views of the headers and channel data, and only the pages of the file that are accessed are read from disk.
+
+    INPUTS:
+        fname : string
+            Full filename of the .mpl file.
+
+    OUTPUTS:
+        rec : np.memmap (profile,)
+            Structured array of the records in the file, with a dtype created by mpl_record_dtype.
+    '''
+    n_records, rec_dtype = scan_layout(fname)
+    if rec_dtype is None:
+        raise IOError('incomplete header')
+    rec = np.memmap(fname, dtype=rec_dtype, mode='r', shape=(n_records,))
+    if np.any(rec['number_bins'] != rec_dtype['channel_1'].shape[0]):
+        raise IOError('number_bins is not constant between records')
+    return rec
+
+
+def select_mpl(mpl, profiles=None, bins=None):
+    '''Function to select a subset of the profiles and range bins from an mpl2nc dictionary.
+
+    INPUTS:
+        mpl : dictionary
+            Dictionary in the format produced by mpl2nc.process_mpl.
+
+        profiles : None, slice, np.ndarray ; default=None
+            The profiles to be selected. None selects all of the profiles.
+
+        bins : None, slice ; default=None
+            The range bins of the channel data to be selected. None selects all of the bins.
+
+    OUTPUTS:
+        mpl : dictionary
+            Dictionary containing the selected profiles and bins. Selections by slice are views of the input arrays.
+    '''
+    if profiles is None and bins is None:
+        return mpl
+    profiles = slice(None) if profiles is None else profiles
+    bins = slice(None) if bins is None else bins
+    out = {}
+    for k, v in mpl.items():
+        if not isinstance(v, np.ndarray) or v.ndim == 0:
+            out[k] = v
+        elif v.ndim == 2:
+            out[k] = v[profiles, bins]
+        else:
+            out[k] = v[profiles]
+    return out
+
+
+def mpl_record_dtype(header_size, number_bins, number_channels=2):
+    '''Function to create the numpy structured dtype describing a single record of a raw .mpl file.
+
+    Each record is a header, described by the fields of mpl2nc.HEADER_MPL, followed by number_channels blocks of number_bins little-endian 4-byte floats. Only the header fields that fit within header_size bytes are included, so that both the 128-byte header and the extended (weather station) header are supported.
+
+    INPUTS:
+        header_size : int
+            The size of the record header in bytes. A value of 0 (as written by older units) is interpreted as the standard 128 bytes.
+
+        number_bins : int
+            The number of range bins recorded in each channel.
+
+        number_channels : int ; default=2
+            The number of channels recorded in each record.
+
+    OUTPUTS:
+        dtype : np.dtype
+            Structured dtype with one field per header variable, and the fields 'channel_1' (and 'channel_2') containing the (number_bins,) channel data.
+    '''
+    if header_size == 0:
+        header_size = MPL_HEADER_SIZE
+    names, formats, offsets = [], [], []
+    offset = 0
+    for x in mpl2nc.HEADER_MPL:
+        field_dtype = np.dtype(x[1]).newbyteorder('<')
+        if offset + field_dtype.itemsize > header_size:
+            break
+        names.append(x[0])
+        formats.append(field_dtype)
+        offsets.append(offset)
+        offset += field_dtype.itemsize
+    for channel in range(1, number_channels+1):
+        names.append(f'channel_{channel}')
+        formats.append((np.dtype('<f4'), number_bins))
+        offsets.append(header_size + (channel-1)*number_bins*4)
+    itemsize = header_size + number_channels*number_bins*4
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': itemsize})
+
+
+def header_layout(header):
+    '''Function to determine the record layout of a raw .mpl file from its first header.
+
+    INPUTS:
+        header : bytes
+            At least the first 128 bytes of the uncompressed .mpl file.
+
+    OUTPUTS:
+        rec_dtype : np.dtype
+            The structured dtype of the records, see mpl_record_dtype.
+    '''
+    if len(header) < MPL_HEADER_SIZE:
+        raise IOError('incomplete header')
+    number_channels = int(np.frombuffer(header, dtype='<u2', count=1, offset=56)[0])
+    number_bins = int(np.frombuffer(header, dtype='<u4', count=1, offset=58)[0])
+    header_size = int(np.frombuffer(header, dtype='<u2', count=1, offset=126)[0])
+    return mpl_record_dtype(header_size, number_bins, number_channels)
+
+
+def decode_mpl_buffer(buf):
+    '''Function to decode the contents of a raw .mpl file held in memory.
+
+    The record layout is determined from the first header, after which all records are viewed with np.frombuffer. The channel data are returned as views into buf, so no further copies of the backscatter are made.
+
+    INPUTS:
+        buf : bytes
+            The uncompressed contents of a .mpl file.
+
+    OUTPUTS:
+        mpl : dictionary
+            Dictionary containing the same variables as mpl2nc.process_mpl would produce.
+    '''
+    rec_dtype = header_layout(buf)
+    number_bins = rec_dtype['channel_1'].shape[0]
+
+    n_records, remainder = divmod(len(buf), rec_dtype.itemsize)
+    if remainder != 0:
+        raise IOError(f'incomplete record: {remainder} trailing bytes for a record size of {rec_dtype.itemsize}')
+    rec = np.frombuffer(buf, dtype=rec_dtype, count=n_records)
+    if np.any(rec['number_bins'] != number_bins):
+        raise IOError('number_bins is not constant between records')
+    return mpl_records_to_dict(rec)
+
+
+def mpl_records_to_dict(rec):
+    '''Function to convert an array of decoded .mpl records into the mpl2nc dictionary format.
+    
+    INPUTS:
+        rec : np.ndarray
+            Structured array with a dtype created by mpl_record_dtype.
+
+    OUTPUTS:
+        mpl : dictionary
+            Dictionary containing the same variables as mpl2nc.process_mpl would produce.
+    '''
+    mpl = {k: rec[k].astype(mpl2nc.HEADER_TYPES[k]) for k in mpl2nc.FIELDS if k in rec.dtype.names}
+    for channel in ['channel_1', 'channel_2']:
+        if channel in rec.dtype.names:
+            mpl[channel] = rec[channel]
+
+    times = header_times(rec['year'], rec['month'], rec['day'], rec['hours'], rec['minutes'], rec['seconds'])
+    mpl['time_utc'] = np.datetime_as_string(times, unit='s')
+    mpl['time'] = times.astype(np.int64).astype(np.uint64)
+    mpl['c'] = mpl2nc.C
+    return mpl
+
+
+def header_times(year, month, day, hours, minutes, seconds):
+    '''Function to convert the date and time fields of the .mpl headers to np.datetime64 values.
+
+    INPUTS:
+        year, month, day, hours, minutes, seconds : np.ndarray (profile,)
+            The integer time fields from the .mpl record headers.
+
+    OUTPUTS:
+        times : np.ndarray (profile,) ; dtype datetime64[s]
+            The record collection times.
+    '''
+    times = (year.astype(np.int64) - 1970).astype('datetime64[Y]')
+    times = times.astype('datetime64[M]') + (month.astype(np.int64) - 1).astype('timedelta64[M]')
+    times = times.astype('datetime64[D]') + (day.astype(np.int64) - 1).astype('timedelta64[D]')
+    times = times.astype('datetime64[s]') + (hours.astype(np.int64)*3600 + minutes.astype(np.int64)*60 + seconds.astype(np.int64)).astype('timedelta64[s]')
+    return times
+
+
 def mpl2nc_read_mpl_gzip(fname):
     '''Effective rewriting of mpl2nc.read_mpl to use gzip.open() rather than open().
 
     7/8/23: changed function to allow loading of non .gz files, for the case of accessing raw .mpl archive data.
+
+    NOTE: superseded by read_mpl, which decodes all of the profiles at once. Kept as the reference that read_mpl is tested against (tests/test_load_raw.py).
     
     INPUTS:
         fname : string
@@ -94,7 +347,9 @@ def mpl2nc_read_mpl_gzip(fname):
 
 def mpl_dict_to_xarray(d):
     '''Convert the mpl2nc mpl dictionary to an xr.Dataset format.
-    Rewrites the mpl2nc.write() function, except that the Dataset isn't saved to memory.
+    Builds the Dataset that mpl2nc.write() would produce, without writing it to (or reading it back from) a netCDF file.
+
+    The dimensions and attributes are taken from mpl2nc.NC_HEADER, and the numpy arrays in d are wrapped without being copied. Fill values are masked as they would be when reading the netCDF file: a variable containing its fill value has it replaced by NaN (or NaT), with integer variables promoted to floating point as xarray does. The time variable is decoded to datetime64.
     
     INPUTS:
         d : dict
@@ -104,66 +359,388 @@ def mpl_dict_to_xarray(d):
         ds : xr.Dataset
             The xarray dataset created from the mpl dictionary.
     '''
-    f = netCDF4.Dataset('diskless.nc','w',diskless=True)
-    f.createDimension('profile', None)
-    f.createDimension('range', None)
-    f.createDimension('ap_range', None)
-    f.createDimension('ol_range', None)
-    f.createDimension('dt_coeff_degree', None)
+    data_vars = {}
     for k, v in d.items():
         h = mpl2nc.NC_HEADER[k]
-        var = f.createVariable(k, mpl2nc.NC_TYPE[h['dtype']], h['dims'],
-            fill_value=mpl2nc.FILL_VALUE[h['dtype']])
-        var[::] = v
-        if h['units'] is not None: var.units = h['units']
-        if h['long_name'] is not None: var.long_name = h['long_name']
-        if h['comment'] is not None: var.comment = h['comment']
-    f.created = dt.datetime.utcnow().strftime('%Y-%m-%dT:%H:%M:%SZ')
-    f.software = 'mpl2nc (https://github.com/peterkuma/mpl2nc) ; mplgz2ingested (https://github.com/DAndrewA/mplgz2ingested)'
-    f.version = mpl2nc.__version__
-
-    ds = xr.open_dataset(xr.backends.NetCDF4DataStore(f)).load()
-    f.close()
+        attrs = {a: h[a] for a in ['units', 'long_name', 'comment'] if h[a] is not None}
+        data = mask_fill_value(np.asarray(v), mpl2nc.FILL_VALUE[h['dtype']])
+        encoding = {}
+        if k == 'time': # decoded from seconds since 1970-01-01 00:00:00
+            encoding['units'] = attrs.pop('units')
+            data = data.astype('datetime64[s]').astype('datetime64[ns]') if data.dtype.kind == 'u' else (data * 1e9).astype('datetime64[ns]')
+        data_vars[k] = xr.Variable(h['dims'], data, attrs=attrs, encoding=encoding)
+
+    attrs = {
+        'created': dt.datetime.utcnow().strftime('%Y-%m-%dT:%H:%M:%SZ'),
+        'software': 'mpl2nc (https://github.com/peterkuma/mpl2nc) ; mplgz2ingested (https://github.com/DAndrewA/mplgz2ingested)',
+        'version': mpl2nc.__version__
+    }
+    ds = xr.Dataset(data_vars, attrs=attrs)
     return ds
 
 
-def load_fromlist(fnames, dir_root):
+def mask_fill_value(data, fill_value):
+    '''Function to mask the fill values in an array, in the same way as xarray does when decoding a netCDF variable.
+
+    If the fill value isn't present, data is returned unchanged (and uncopied).
+
+    INPUTS:
+        data : np.ndarray
+            The array to be masked.
+
+        fill_value : scalar
+            The fill value for the array, as given by mpl2nc.FILL_VALUE.
+
+    OUTPUTS:
+        data : np.ndarray
+            The array with the fill values replaced by NaN (or NaT). Integer arrays are promoted to float32 (2-byte integers and smaller) or float64.
+    '''
+    if data.dtype.kind not in 'iuf':
+        return data
+    fill = data == fill_value
+    if not np.any(fill):
+        return data
+    if data.dtype.kind == 'u' and data.dtype.itemsize == 8: # the uint64 time variable is masked as NaT
+        data = data.astype(np.float64)
+    elif data.dtype.kind in 'iu':
+        data = data.astype(np.float32 if data.dtype.itemsize <= 2 else np.float64)
+    else:
+        data = data.copy()
+    data[fill] = np.nan
+    return data
+
+
+def load_fromlist(fnames, dir_root, workers=None, cache=None, fields=None, bins=None, duplicates='hourly', counts=None):
     '''Function to load multiple .mpl.gz files from a list of filenames.
     
     This function assumes that all of the strings in fnames end in '.mpl.gz'
 
+    The files are decoded directly into arrays sized for all of the files and merged into time order (see assemble_mpl), and the Dataset is built once at the end, rather than concatenating a Dataset per file.
+
     INPUTS:
         fnames : list [string]
             List of strings that are valid filenames to be loaded.
 
         dir_root : string
             path to the root directory containing the .mpl.gz files
+
+        workers : None, int ; default=None
+            If None or 1, the files are decoded one after another. Otherwise, the number of processes used to decode the files in parallel. The profile order of the output is the same in both cases.
+
+        cache : None, False, string, DecodeCache ; default=None
+            The decode cache to use, see decode_cache.resolve_cache.
+
+        fields : None, list [string] ; default=None
+            If given, only these variables are loaded and the mpl2nc NRB processing is skipped, see raw_to_ingested.ingest_projection. 'time' is always loaded.
+
+        bins : None, slice ; default=None
+            If given, only these range bins of the channel data are loaded.
+
+        duplicates : string ; default='hourly'
+            The policy for profiles with the same time in more than one file, see merge_profiles.
+
+        counts : None, list [None, int] ; default=None
+            The number of records in each file, if known, see assemble_mpl.
     
     OUTPUTS:
         ds : xr.Dataset
             xarray dataset containing the data from the mpl files.
     '''
-    ds = []
     if fnames == []:
         print(f'fnames is empty, returning None')
         return None
 
+    paths = [os.path.join(dir_root,fname) for fname in fnames]
     print('Loading: |',end='')
-    for fname in fnames:
-        n = os.path.join(dir_root,fname)
-        print(f'{fname[8:12]}|',end='')
-        #print(f'loading {fname}')
-        ds.append(load_mplgz(n))
-    print('')
-    try:
-        ds = xr.combine_nested(datasets=ds, concat_dim='profile', combine_attrs='override')
-    except Exception as err: # if the exception is raised, we need to know whether it was duplicate time coordinate, etc...
-        print('load_fromlist: uh oh spaghettio in the combine nested')
-        raise err
+    mpl = assemble_mpl(paths, workers=workers, cache=cache, progress=lambda i: print(f'{os.path.basename(fnames[i])[8:12]}|',end='' if i+1 < len(fnames) else '\n'), fields=fields, bins=bins, duplicates=duplicates, counts=counts)
+    if fields is None:
+        mpl = mpl2nc.process_nrb(mpl)
+    ds = mpl_dict_to_xarray(mpl)
     return ds
 
 
-def load_fromglob(globstr, dir_root):
+def scan_layout(fname, cache=None, n_records=None):
+    '''Function to determine the record layout and number of records in a .mpl.gz or .mpl file, without decoding it.
+
+    The layout is found from the first header. For .mpl files, the number of records is found from the file size. For .gz files, it is taken from the decode cache if the file is cached, and otherwise the file is decompressed as a stream, through every gzip member to the end of each, keeping none of the output. The ISIZE field of the gzip trailer isn't used, as it only gives the size of the last member, and the members of a file that has been appended to can't be found without decompressing it. To skip the decompression, the number of records can be given, e.g. from an ArchiveIndex (see ArchiveIndex.record_counts).
+
+    INPUTS:
+        fname : string
+            Full filename of the .mpl.gz or .mpl file.
+
+        cache : None, False, string, DecodeCache ; default=None
+            The decode cache to take the number of records of a .gz file from, see decode_cache.resolve_cache.
+
+        n_records : None, int ; default=None
+            If given, the number of records in the file, which is then not counted.
+
+    OUTPUTS:
+        n_records : int
+            The number of records in the file.
+
+        rec_dtype : np.dtype, None
+            The structured dtype of the records, see mpl_record_dtype. None if the file is empty.
+    '''
+    is_gz = (fname[-3:] == '.gz')
+    with gzip.open(fname,'rb') if is_gz else open(fname,'rb') as f:
+        header = f.read(MPL_HEADER_SIZE)
+    if len(header) == 0:
+        return 0, None
+    rec_dtype = header_layout(header)
+    if n_records is not None:
+        return n_records, rec_dtype
+
+    if is_gz:
+        cache = resolve_cache(cache)
+        n_records = None if cache is None else cache.n_records(fname)
+        if n_records is not None:
+            return n_records, rec_dtype
+        size = sum(len(chunk) for chunk in _iter_gunzip(fname))
+    else:
+        size = os.path.getsize(fname)
+    n_records, remainder = divmod(size, rec_dtype.itemsize)
+    if remainder != 0:
+        raise IOError(f'incomplete record: {remainder} trailing bytes for a record size of {rec_dtype.itemsize}')
+    return n_records, rec_dtype
+
+
+def assemble_mpl(paths, workers=None, cache=None, progress=None, fields=None, bins=None, duplicates='hourly', counts=None):
+    '''Function to decode several .mpl.gz files into a single mpl2nc dictionary, without concatenation.
+
+    The record counts and layouts of all of the files are found first with scan_layout. Counting the records of a .gz file means decompressing it, unless it is in the decode cache or its count is given in counts (e.g. from ArchiveIndex.record_counts). The output arrays for every variable are then allocated once, and each file is decoded straight into its slice of them. Finally the profiles of the files are merged into time order, with duplicate times resolved by the duplicates policy (see merge_profiles).
+
+    With workers, the files are decoded in a pool of forked processes. The (profile, range) arrays are then allocated in an anonymous shared memory map, so the workers write the channel data directly into the output and only the header variables are returned through pickling.
+
+    INPUTS:
+        paths : list [string]
+            Full filenames of the files to be decoded, in the order the profiles should appear.
+
+        workers : None, int ; default=None
+            Number of processes used to decode the files. If None or 1, they are decoded in this process.
+
+        cache : None, False, string, DecodeCache ; default=None
+            The decode cache to use, see decode_cache.resolve_cache.
+
+        progress : None, function ; default=None
+            If given, called with the index of each file once it has been decoded.
+
+        fields : None, list [string] ; default=None
+            If given, only these variables (and 'time') are assembled.
+
+        bins : None, slice ; default=None
+            If given, only these range bins of the channel data are assembled.
+
+        duplicates : string ; default='hourly'
+            The policy for profiles with the same time in more than one file, see merge_profiles.
+
+        counts : None, list [None, int] ; default=None
+            The number of records in each file, if known, with None for the files that need to be counted. The number of records decoded from each file is checked against it.
+
+    OUTPUTS:
+        mpl : dictionary
+            Dictionary containing the same variables as mpl2nc.process_mpl would produce for the records of all of the files (or just fields).
+    '''
+    cache = resolve_cache(cache)
+    if counts is None:
+        counts = [None]*len(paths)
+    layouts = [scan_layout(path, cache=cache or False, n_records=n) for path, n in zip(paths, counts)]
+    dtypes = [rec_dtype for n, rec_dtype in layouts if n > 0]
+    if len(dtypes) == 0:
+        raise IOError('no records found in files')
+    number_bins = {rec_dtype['channel_1'].shape[0] for rec_dtype in dtypes}
+    if len(number_bins) != 1:
+        raise IOError(f'files have differing numbers of bins: {number_bins}')
+    number_bins = number_bins.pop()
+    if bins is not None:
+        number_bins = len(range(number_bins)[bins])
+    names = [k for k in dtypes[0].names if all(k in rec_dtype.names for rec_dtype in dtypes)]
+    if fields is not None:
+        names = [k for k in names if k in fields]
+
+    counts = np.array([n for n, _ in layouts], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    n_total = int(starts[-1])
+
+    parallel = workers is not None and workers > 1
+    mpl = {}
+    for k in names:
+        if k in mpl2nc.HEADER_TYPES and k in mpl2nc.FIELDS:
+            mpl[k] = np.empty(n_total, dtype=mpl2nc.HEADER_TYPES[k])
+        elif k[:8] == 'channel_':
+            mpl[k] = _allocate_shared((n_total, number_bins), np.float32) if parallel else np.empty((n_total, number_bins), dtype=np.float32)
+    if fields is None or 'time_utc' in fields:
+        mpl['time_utc'] = np.empty(n_total, dtype='<U19')
+    mpl['time'] = np.empty(n_total, dtype=np.uint64)
+    if fields is None or 'c' in fields:
+        mpl['c'] = mpl2nc.C
+
+    jobs = [(i, path, int(starts[i]), int(counts[i])) for i, path in enumerate(paths) if counts[i] > 0]
+    if not parallel:
+        for job in jobs:
+            _decode_into(mpl, *job, cache=cache, bins=bins)
+            if progress is not None: progress(job[0])
+        return merge_profiles(mpl, counts, paths, policy=duplicates)
+
+    global _SHARED_OUTPUT
+    _SHARED_OUTPUT = {k: v for k, v in mpl.items() if isinstance(v, np.ndarray) and v.ndim == 2}
+    try:
+        # the shared output is inherited by the forked workers, rather than being pickled
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(_decode_into_shared, *job, cache=cache or False, bins=bins, keys=list(mpl)) for job in jobs]
+            for job, future in zip(jobs, futures):
+                i, _, start, n = job
+                for k, v in future.result().items():
+                    if k in mpl:
+                        mpl[k][start:start+n] = v
+                if progress is not None: progress(i)
+    finally:
+        _SHARED_OUTPUT = None
+    return merge_profiles(mpl, counts, paths, policy=duplicates)
+
+
+# policies for resolving duplicate profile times between files, see merge_profiles
+DUPLICATE_POLICIES = ['hourly', 'shots', 'mean']
+
+# number of (profile, range) rows moved at a time by _take_rows
+TAKE_BLOCK_SIZE = 256
+
+
+def merge_profiles(mpl, counts, paths, policy='hourly'):
+    '''Function to merge the profiles of several files, assembled one file after another, into time order, resolving duplicate times.
+
+    Each file is a time-ordered run of profiles. Rather than an explicit k-way merge of the runs, they are merged by a stable np.argsort of the times: for the uint64 times this is a timsort, which finds the presorted runs and merges them, so it scales like a merge of the files without a loop over the profiles in Python. Only the profiles whose time is duplicated are then ordered by the policy, with np.lexsort. Profiles with the same time are resolved by policy:
+        'hourly' : keep the profile from an hourly file (see file_role), or else from the earliest file in paths.
+        'shots' : keep the profile with the most laser shots, with ties resolved as for 'hourly'.
+        'mean' : keep the profile chosen by 'hourly', with its channel data replaced by the shot-weighted mean of the duplicates and shots_sum by their total. If none of the duplicates have any shots, the unweighted mean is used.
+
+    If the profiles are already in order without duplicates, nothing is copied. Otherwise the arrays are reordered in place, only copying the rows that are out of order, and views of the first (kept) rows are returned.
+
+    INPUTS:
+        mpl : dictionary
+            The assembled mpl dictionary, with the profiles of each file contiguous and in the order of paths.
+
+        counts : np.ndarray (file,)
+            The number of profiles from each file.
+
+        paths : list [string]
+            The filenames of the files.
+
+        policy : string ; default='hourly'
+            One of DUPLICATE_POLICIES.
+
+    OUTPUTS:
+        mpl : dictionary
+            The mpl dictionary with the profiles in time order and without duplicate times.
+    '''
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError(f'duplicates policy must be one of {DUPLICATE_POLICIES}, not {policy}')
+    times = mpl['time']
+    if times.size < 2 or np.all(times[1:] > times[:-1]):
+        return mpl
+    if policy != 'hourly' and 'shots_sum' not in mpl:
+        raise ValueError(f'shots_sum must be loaded for the {policy} duplicates policy')
+
+    run = np.repeat(np.arange(len(counts)), counts)
+    priority = np.array([0 if file_role(path) == 'hourly' else 1 for path in paths])[run]
+    order = np.argsort(times, kind='stable')
+    t = times[order]
+    same = t[1:] == t[:-1]
+
+    # within each group of equal times, the preferred profile is sorted first
+    dup = np.zeros(t.size, dtype=bool)
+    dup[1:] |= same
+    dup[:-1] |= same
+    dup = np.flatnonzero(dup)
+    rows = order[dup]
+    keys = [run[rows], priority[rows]]
+    if policy == 'shots':
+        keys.append(-mpl['shots_sum'][rows].astype(np.int64))
+    order[dup] = rows[np.lexsort(keys + [t[dup]])]
+    first = np.concatenate([[True], ~same])
+    keep = order[first]
+
+    n_dropped = times.size - keep.size
+    if n_dropped > 0:
+        print(f'merge_profiles: {n_dropped} duplicate profiles dropped ({policy} policy)')
+
+    if policy == 'mean' and n_dropped > 0:
+        starts = np.flatnonzero(first)
+        sizes = np.diff(np.concatenate([starts, [order.size]]))
+        channels = [k for k, v in mpl.items() if isinstance(v, np.ndarray) and v.ndim == 2]
+        for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+            rows = order[start:start+size]
+            w = mpl['shots_sum'][rows].astype(np.float64)
+            total = w.sum()
+            if total <= 0: # no shots to weight by, so the unweighted mean
+                w = np.ones_like(w)
+            for k in channels:
+                mpl[k][rows[0]] = (w @ mpl[k][rows]) / w.sum()
+            mpl['shots_sum'][rows[0]] = total
+
+    return {k: _take_rows(v, keep) if isinstance(v, np.ndarray) and v.ndim > 0 else v for k, v in mpl.items()}
+
+
+def _take_rows(arr, idx):
+    '''Reorder the rows of arr in place so that arr[:idx.size] holds arr[idx], copying only the rows that move.
+
+    The leading rows that don't move are left alone, and a trailing run of rows that all move by the same (non-negative) offset is shifted in blocks. Only the rows in between are gathered through a temporary copy.
+    '''
+    m = idx.size
+    shift = idx - np.arange(m)
+    moved = np.flatnonzero(shift)
+    if moved.size == 0:
+        return arr[:m]
+    a = moved[0]
+    d = shift[-1]
+    b = m
+    if d >= 0:
+        differs = np.flatnonzero(shift[a:] != d)
+        b = a + (differs[-1] + 1 if differs.size > 0 else 0)
+    if b > a:
+        arr[a:b] = arr[idx[a:b]]
+    for s in range(b, m, TAKE_BLOCK_SIZE):
+        e = min(s + TAKE_BLOCK_SIZE, m)
+        arr[s:e] = arr[s+d:e+d]
+    return arr[:m]
+
+
+# output arrays shared with forked worker processes by assemble_mpl
+_SHARED_OUTPUT = None
+
+
+def _allocate_shared(shape, dtype):
+    '''Allocate a numpy array in an anonymous shared memory map, which remains shared with processes forked after its creation.'''
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buf = mmap.mmap(-1, max(nbytes, 1))
+    return np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _decode_into(out, i, path, start, n, cache=None, bins=None):
+    '''Decode a single file into the slice [start:start+n] of the arrays in out.'''
+    mpl = read_mpl(path, cache=cache or False, bins=bins)
+    if mpl['time'].size != n:
+        raise IOError(f'{path}: expected {n} records from scan_layout, but decoded {mpl["time"].size}')
+    for k, v in out.items():
+        if isinstance(v, np.ndarray):
+            v[start:start+n] = mpl[k]
+
+
+def _decode_into_shared(i, path, start, n, cache=None, bins=None, keys=None):
+    '''Worker function for assemble_mpl. Decodes a file, writing the channel data into the shared output and returning the header variables in keys.'''
+    mpl = read_mpl(path, cache=cache, bins=bins)
+    if mpl['time'].size != n:
+        raise IOError(f'{path}: expected {n} records from scan_layout, but decoded {mpl["time"].size}')
+    header = {}
+    for k, v in mpl.items():
+        if k in _SHARED_OUTPUT:
+            _SHARED_OUTPUT[k][start:start+n] = v
+        elif isinstance(v, np.ndarray) and v.ndim == 1 and (keys is None or k in keys):
+            header[k] = v
+    return header
+
+
+def load_fromglob(globstr, dir_root, workers=None, cache=None, index=None, fields=None, bins=None, duplicates='hourly'):
     '''Function to load multiple .mpl.gz files from a glob string match
     
     The glob string doesn't need to end in '.mpl.gz', as this is checked for before passing the list to load_fomlist.
@@ -175,17 +752,39 @@ def load_fromglob(globstr, dir_root):
         dir_root : string
             The root directory containing the .mpl.gz files to be laoded
 
+        workers : None, int ; default=None
+            Number of processes used to decode the files, see load_fromlist.
+
+        cache : None, False, string, DecodeCache ; default=None
+            The decode cache to use, see decode_cache.resolve_cache.
+
+        index : None, ArchiveIndex ; default=None
+            If given, the files are matched against the archive index of dir_root rather than by globbing the directory, and their record counts are taken from it.
+
+        fields : None, list [string] ; default=None
+            If given, only these variables are loaded and the mpl2nc NRB processing is skipped, see raw_to_ingested.ingest_projection. 'time' is always loaded.
+
+        bins : None, slice ; default=None
+            If given, only these range bins of the channel data are loaded.
+
+        duplicates : string ; default='hourly'
+            The policy for profiles with the same time in more than one file, see merge_profiles.
+
     OUTPUTS:
         ds : xr.Dataset
             xarray Dataset containing the data from the mpl files
     '''
-    fnames = glob.glob(globstr, root_dir=dir_root)
+    if index is None:
+        fnames = glob.glob(globstr, root_dir=dir_root)
+    else:
+        fnames = index.names(pattern=globstr)
     fnames = sorted(fnames)
     fnames = [n for n in fnames if '.mpl' in n] # ensure all files are .mpl, allows for .mpl and .mpl.gz
-    ds = load_fromlist(fnames, dir_root)
+    counts = None if index is None else index.record_counts(fnames)
+    ds = load_fromlist(fnames, dir_root, workers=workers, cache=cache, fields=fields, bins=bins, duplicates=duplicates, counts=counts)
     return ds
 
-def load_fromdate(date, dir_root):
+def load_fromdate(date, dir_root, workers=None, cache=None, index=None, fields=None, bins=None, duplicates='hourly'):
     '''Function to load multiple .mpl.gz files from a given datetime.date(time) object.
     
     Current implementation will load all avaliable files for the 24 hour period containing the given object date.
@@ -194,23 +793,198 @@ def load_fromdate(date, dir_root):
         date : datetime.date, datetime.datetime
             Python datetime object containing the year, month and day attributes. This will be used to select the appropriate files to load.
 
+        dir_root : string
+            The root directory containing the .mpl.gz files to be loaded.
+
+        workers : None, int ; default=None
+            Number of processes used to decode the files, see load_fromlist.
+
+        cache : None, False, string, DecodeCache ; default=None
+            The decode cache to use, see decode_cache.resolve_cache.
+
+        index : None, ArchiveIndex ; default=None
+            If given, the files are selected using the archive index of dir_root (see select_fromdate), and their record counts are taken from it.
+
+        fields : None, list [string] ; default=None
+            If given, only these variables are loaded and the mpl2nc NRB processing is skipped, see raw_to_ingested.ingest_projection. 'time' is always loaded.
+
+        bins : None, slice ; default=None
+            If given, only these range bins of the channel data are loaded.
+
+        duplicates : string ; default='hourly'
+            The policy for profiles with the same time in more than one file, see merge_profiles.
+
     OUTPUTS:
         ds : xarray.Dataset
             xarray dataset object containing the MPL data loaded from the given date.
     '''
-    fname_fmt = f'{date.year:04}{date.month:02}{date.day:02}*.mpl*' # allows for .mpl and .mpl.gz files to be loaded
-    mpl_fnames = sorted(glob.glob(fname_fmt,root_dir=dir_root))
+    mpl_fnames = select_fromdate(date, dir_root, index=index)
+    counts = None if index is None else index.record_counts(mpl_fnames)
+    ds = load_fromlist(mpl_fnames, dir_root, workers=workers, cache=cache, fields=fields, bins=bins, duplicates=duplicates, counts=counts)
+    return ds
+
+
+def select_fromdate(date, dir_root, index=None):
+    '''Function to select the .mpl.gz files that make up the data for a given date.
+
+    If there aren't exactly 24 files for the day, the hourly files are kept along with the last file that isn't on the hour (if there is one), which is assumed not to be a calibration file.
+
+    INPUTS:
+        date : datetime.date, datetime.datetime
+            Python datetime object containing the year, month and day attributes.
 
-    # if not 24 files are found, then the function will break and return None
+        dir_root : string
+            The root directory containing the .mpl.gz files.
+
+        index : None, ArchiveIndex ; default=None
+            If given, the files and their roles are taken from the archive index of dir_root, rather than by globbing the directory and checking the filenames.
+
+    OUTPUTS:
+        mpl_fnames : list [string]
+            Sorted list of filenames, relative to dir_root.
+    '''
+    fname_fmt = f'{date.year:04}{date.month:02}{date.day:02}*.mpl*' # allows for .mpl and .mpl.gz files to be loaded
+    if index is None:
+        mpl_fnames = sorted(glob.glob(fname_fmt,root_dir=dir_root))
+        hourly = [fn for fn in mpl_fnames if fn[-9:-6] == '00.']
+    else:
+        mpl_fnames = index.names(pattern=fname_fmt)
+        hourly = index.names(pattern=fname_fmt, role='hourly')
+
+    # if not 24 files are found, the calibration files are removed
     if len(mpl_fnames) != 24:
         print(f'load_fromdate: For full day, 24 files are expected. {len(mpl_fnames)} files matching date {date} in {dir_root} found.')
-        mpl_fnames_hourly = [fn for fn in mpl_fnames if fn[-9:-6] == '00.'] # extract the hourly files
-        mpl_fnames_notcalib = [fn for fn in mpl_fnames if fn[-9:-6] != '00.'][-1] # extract the not-calibration file
+        mpl_fnames_hourly = [fn for fn in mpl_fnames if fn in hourly] # extract the hourly files
+        mpl_fnames_other = [fn for fn in mpl_fnames if fn not in hourly]
+        if len(mpl_fnames_other) == 0: # a partial day, e.g. the current day, with only hourly files
+            return mpl_fnames_hourly
+        mpl_fnames_notcalib = mpl_fnames_other[-1] # extract the not-calibration file
         mpl_fnames = sorted([*mpl_fnames_hourly, mpl_fnames_notcalib])
         print(f'load_fromdate: {mpl_fnames_notcalib} identified as not-calibration file')
+    return mpl_fnames
 
-    ds = load_fromlist(mpl_fnames, dir_root)
-    return ds
+
+def file_role(name):
+    '''Function to determine the role of a raw file from its name, of the form YYYYMMDDHHMM.mpl.gz.
+
+    Files that start on the hour are the regular 'hourly' files. Any other file is taken to be a 'calibration' file (e.g. an afterpulse or overlap measurement, or the resumed data following one).
+
+    INPUTS:
+        name : string
+            The filename.
+
+    OUTPUTS:
+        role : string
+            'hourly' or 'calibration'.
+    '''
+    stem = os.path.basename(name).split('.')[0]
+    return 'hourly' if stem[-2:] == '00' else 'calibration'
+
+
+def scan_headers(paths):
+    '''Function to read the per-profile metadata of .mpl.gz or .mpl files, without decoding the channel data.
+
+    Only the 128-byte header of each record is parsed. Uncompressed files are memory-mapped, so just the pages holding the headers are read. Compressed files are decompressed as a stream in blocks, and the channel data are discarded as they pass rather than being kept in memory; the whole stream still has to be decompressed, so this saves the memory and decoding of a full load rather than the decompression.
+
+    INPUTS:
+        paths : string, list [string]
+            Full filename(s) of the .mpl.gz or .mpl files.
+
+    OUTPUTS:
+        tables : list [np.ndarray]
+            For each file, a structured array with one element per record, containing the fields 'time' (datetime64[s]) and SCAN_FIELDS. The number of records in a file is the length of its table.
+    '''
+    if isinstance(paths, str):
+        paths = [paths]
+    return [_scan_header_file(path) for path in paths]
+
+
+# header variables included in the tables returned by scan_headers
+SCAN_FIELDS = ['shots_sum', 'trigger_frequency', 'energy_monitor', 'temp_0', 'temp_1', 'temp_2', 'temp_3', 'temp_4', 'background_average', 'background_stddev', 'number_channels', 'number_bins', 'bin_time', 'first_data_bin', 'first_background_bin', 'num_background_bins']
+
+# size in bytes of the compressed blocks read by scan_headers
+SCAN_BLOCK_SIZE = 1 << 20
+
+
+def _scan_header_file(fname):
+    '''Read the headers of every record in a single file into a scan_headers table.'''
+    if fname[-3:] == '.gz':
+        headers = _read_gzip_headers(fname)
+    else:
+        n_records, rec_dtype = scan_layout(fname)
+        if n_records == 0:
+            headers = b''
+        else:
+            mm = np.memmap(fname, dtype=np.uint8, mode='r', shape=(n_records, rec_dtype.itemsize))
+            headers = np.ascontiguousarray(mm[:, :MPL_HEADER_SIZE])
+    rec = np.frombuffer(headers, dtype=mpl_record_dtype(MPL_HEADER_SIZE, 0, 0))
+
+    table = np.empty(rec.size, dtype=[('time', 'datetime64[s]')] + [(k, mpl2nc.HEADER_TYPES[k]) for k in SCAN_FIELDS])
+    table['time'] = header_times(rec['year'], rec['month'], rec['day'], rec['hours'], rec['minutes'], rec['seconds'])
+    for k in SCAN_FIELDS:
+        table[k] = rec[k]
+    return table
+
+
+def _read_gzip_headers(fname):
+    '''Decompress a .mpl.gz file as a stream, keeping only the first 128 bytes of each record.'''
+    headers = bytearray()
+    current = bytearray() # the bytes read so far of the header being read
+    next_start = 0 # offset in the uncompressed stream of the header being read
+    rec_size = None
+    pos = 0 # offset in the uncompressed stream of the start of chunk
+    for chunk in _iter_gunzip(fname):
+        end = pos + len(chunk)
+        while next_start + len(current) < end:
+            a = next_start + len(current) - pos
+            current += chunk[a:a + MPL_HEADER_SIZE - len(current)]
+            if len(current) < MPL_HEADER_SIZE:
+                break
+            if rec_size is None:
+                rec_size = header_layout(current).itemsize
+            headers += current
+            current = bytearray()
+            next_start += rec_size
+        pos = end
+
+    if len(current) > 0:
+        raise IOError('incomplete header')
+    if rec_size is not None and pos != next_start:
+        raise IOError(f'incomplete record: {pos - next_start + rec_size} trailing bytes for a record size of {rec_size}')
+    return bytes(headers)
+
+
+def _iter_gunzip(fname):
+    '''Yield the decompressed contents of a gzip file in chunks, without holding the whole file in memory.'''
+    d = zlib.decompressobj(wbits=31)
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(SCAN_BLOCK_SIZE), b''):
+            while block:
+                yield d.decompress(block)
+                block = d.unused_data if d.eof else b''
+                if d.eof: # concatenated gzip members
+                    d = zlib.decompressobj(wbits=31)
+    yield d.flush()
+
+
+def read_first_time(fname):
+    '''Function to read the time of the first profile in a .mpl.gz or .mpl file, without decoding the rest of the file.
+
+    INPUTS:
+        fname : string
+            Full filename of the .mpl.gz or .mpl file.
+
+    OUTPUTS:
+        time : np.datetime64
+            The collection time of the first record in the file, or NaT if the file is empty.
+    '''
+    is_gz = (fname[-3:] == '.gz')
+    with gzip.open(fname,'rb') if is_gz else open(fname,'rb') as f:
+        buf = f.read(16)
+    if len(buf) < 16:
+        return np.datetime64('NaT', 'ns')
+    fields = np.frombuffer(buf, dtype='<u2', count=6, offset=4).reshape(6,1)
+    return header_times(*fields)[0].astype('datetime64[ns]')
 
 
 #fname = '/home/users/eeasm/_scripts/ICESat2/data/cycle10/mpl/mplraw_zip/202102110000.mpl.gz'
@@ -4,6 +4,10 @@ Creation date: 9/2/23
 Scripts to deal with converting the raw mpl data into the Summit ingested format.
 '''
 
+import collections
+import functools
+import types
+
 import numpy as np
 import datetime
 import xarray as xr
@@ -12,7 +16,7 @@ import glob
 
 # import local packages
 
-def raw_to_ingested(data_loaded, limit_height=True, c=299792458):
+def raw_to_ingested(data_loaded, limit_height=True, c=299792458, base_time=None):
     '''Convert hourly mpl files to the Summit ingested format.
 
     The function will take hourly .nc files (created by mpl2nc) and concatenate them to produce a file matching the Summit ingested mpl format.
@@ -27,7 +31,7 @@ def raw_to_ingested(data_loaded, limit_height=True, c=299792458):
             datetime object for the day the data should belong too. This allows for multiple days of data to be stored in dir_target
 
         limit_height : boolean : default=True
-            If True, limits the output to the first 1200 height bins. 
+            If True, limits the output to the first LIMIT_HEIGHT_BINS (1200) height bins. 
 
         c : float : default=3e8 ; [m/s]
             The speed of light, in m/s, used to calculate the height bins. Summit uses 3e8, but mpl2nc uses the SI defined c=299792458m/s
@@ -35,53 +39,97 @@ def raw_to_ingested(data_loaded, limit_height=True, c=299792458):
         data_loaded : None, xr.Dataset
             If the mpl dataset has already been loaded, we can skip the loading files phase and go straight to the conversion.
 
+        base_time : None, np.datetime64 ; default=None
+            The time that base_time and time_offset are given relative to. If None, the first time in data_loaded is used. Allows parts of a day to be ingested separately but consistently.
+
     OUTPUTS:
         ds : xr.Dataset
             xarray dataset containing the ingested data
     '''
-    # create ingested dataset, with appropriate dimensions and height coordinates
-    ds = xr.Dataset()
-    # set the dimensions for the dataset
-    timeLength = data_loaded.profile.size # in response to failing during calibration loading
-
-    dims = {'time':timeLength, 'height':1999}
-    if limit_height: 
-        dims['height'] = 1200
-    
-    args = {'num_bins': dims['height'], 'bin_time':data_loaded['bin_time'].values[0], 'c':c, 'v_offset':3000}
-    heights = generate_heights(**args)
-    
-    # need to check that all time measurements are unique. Otherwise, will need to subset all subsequent data...
-    times = data_loaded.time.values
-    uniq_times, uniq_ind = np.unique(times,return_index=True)
-    if uniq_times.size != times.size: # if there are duplicate times
-        data_loaded = data_loaded.isel(profile=uniq_ind)
-        times = data_loaded.time.values
+    return compile_ingest_plan().apply(data_loaded, limit_height=limit_height, c=c, base_time=base_time)
+
 
-    ds = ds.assign_coords({'time': times,'height':heights})
+# a single field of an IngestPlan: the entries of VARIABLES_INGESTED, with the dtype resolved and the attributes made read-only
+IngestField = collections.namedtuple('IngestField', ['name', 'dims', 'dtype', 'attrs', 'function', 'fields'])
 
-    # for each variable in VARIABLES_INGESTED, create the appropriate data, and turn it into a DataArray
-    ingest_kwargs = {'limit_height':True}
-    for k,l in VARIABLES_INGESTED.items():
-        # create the data based on the ingestion function
-        if l[3] is None:
-            continue
-        temp = l[3](data_loaded,**ingest_kwargs)
-        if type(temp) == np.ndarray:
-            temp = temp.astype(l[1])
-        else:
-            temp = l[1](temp)
-        attrs = l[2]
-        dims = l[0]
-        da = xr.DataArray(temp,dims=dims,attrs=attrs)
-        ds[k] = da
+class IngestPlan:
+    '''Immutable form of VARIABLES_INGESTED and ATTRIBUTES_INGESTED, used by raw_to_ingested.
 
-    # create the dataset attributes
-    now = datetime.datetime.now(datetime.timezone.utc)
-    ATTRIBUTES_INGESTED['Date_created'] = f'{now.year:04}-{now.month:02}-{now.day:02}T{now.hour:02}:{now.minute:02}:{now.second:02} UTC'
-    ds = ds.assign_attrs(ATTRIBUTES_INGESTED)
+    The dtypes are resolved once (generic datetime64 and timedelta64 become nanosecond precision, as xarray stores them), and apply allocates each (time,) and (time, height) variable in its target dtype and has its ingesting function write straight into it. The Dataset is then built once from the variables. Neither registry is modified.
 
-    return ds
+    INPUTS:
+        variables : dict
+            Dictionary in the format of VARIABLES_INGESTED.
+
+        attributes : dict
+            Dictionary in the format of ATTRIBUTES_INGESTED.
+    '''
+
+    def __init__(self, variables, attributes):
+        fields = []
+        for k, l in variables.items():
+            dtype = np.dtype(l[1])
+            if dtype.kind in 'mM' and np.datetime_data(dtype)[0] == 'generic':
+                dtype = np.dtype(f'{dtype.str[1:3]}[ns]')
+            fields.append(IngestField(k, tuple(l[0]), dtype, types.MappingProxyType(dict(l[2])), l[3], tuple(l[4])))
+        self._fields = tuple(fields)
+        self._attrs = types.MappingProxyType(dict(attributes))
+
+    @property
+    def fields(self):
+        return self._fields
+
+    @property
+    def attrs(self):
+        return self._attrs
+
+    def apply(self, data_loaded, limit_height=True, c=299792458, base_time=None):
+        '''Function to ingest the loaded data, see raw_to_ingested for the inputs and outputs.'''
+        # set the dimensions for the dataset
+        num_bins = data_loaded.channel_1.shape[1] # may already have been limited when loading, see ingest_projection
+        if limit_height:
+            num_bins = min(num_bins, LIMIT_HEIGHT_BINS)
+        heights = generate_heights(num_bins=num_bins, bin_time=data_loaded['bin_time'].values[0], c=c, v_offset=3000)
+
+        # the loaders merge the files into time order without duplicates (see load_raw.merge_profiles), which only needs checking here.
+        times = data_loaded.time.values
+        if np.any(times[1:] <= times[:-1]): # otherwise, will need to subset all subsequent data...
+            uniq_times, uniq_ind = np.unique(times,return_index=True)
+            print(f'raw_to_ingested: profiles not in time order, {times.size - uniq_times.size} duplicate profiles dropped')
+            data_loaded = data_loaded.isel(profile=uniq_ind)
+            times = data_loaded.time.values
+        sizes = {'time': times.size, 'height': num_bins}
+
+        # the coordinates come first, as variables named after their dimensions
+        variables = {'time': times, 'height': heights}
+        ingest_kwargs = {'limit_height':limit_height, 'base_time':base_time}
+        for f in self._fields:
+            if f.function is None:
+                continue
+            if len(f.dims) == 0:
+                data = np.asarray(f.function(data_loaded, **ingest_kwargs)).astype(f.dtype)
+            else:
+                data = f.function(data_loaded, out=np.empty(tuple(sizes[d] for d in f.dims), dtype=f.dtype), **ingest_kwargs)
+            variables[f.name] = xr.Variable(f.dims, data, attrs=dict(f.attrs))
+
+        # create the dataset attributes
+        now = datetime.datetime.now(datetime.timezone.utc)
+        attrs = dict(self._attrs)
+        attrs['Date_created'] = f'{now.year:04}-{now.month:02}-{now.day:02}T{now.hour:02}:{now.minute:02}:{now.second:02} UTC'
+        return xr.Dataset(variables, attrs=attrs)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_ingest_plan():
+    '''Function to compile VARIABLES_INGESTED and ATTRIBUTES_INGESTED into an IngestPlan.
+
+    The plan is compiled on the first call and reused afterwards, so the registries should be changed before the first ingest (or compile_ingest_plan.cache_clear() called).
+
+    OUTPUTS:
+        plan : IngestPlan
+            The compiled ingest plan.
+    '''
+    return IngestPlan(VARIABLES_INGESTED, ATTRIBUTES_INGESTED)
 
 
 def generate_heights(num_bins, bin_time, c, v_offset=3000):
@@ -108,6 +156,26 @@ def generate_heights(num_bins, bin_time, c, v_offset=3000):
     heights = 0.5*bin_time*c*np.arange(num_bins) - v_offset
     return heights
 
+def ingest_projection(limit_height=True):
+    '''Function to determine the raw variables and range bins that raw_to_ingested needs from the loaded data.
+
+    The result can be passed to the loading functions (e.g. load_raw.load_fromlist(..., **ingest_projection())), so that only these variables and bins are decoded and kept, and the mpl2nc NRB processing is skipped.
+
+    INPUTS:
+        limit_height : boolean ; default=True
+            The limit_height argument that will be given to raw_to_ingested.
+
+    OUTPUTS:
+        projection : dict
+            Dictionary with the keys 'fields', the sorted list of raw variables read by the ingesting functions in VARIABLES_INGESTED, and 'bins', the slice of range bins needed (None for all of them).
+    '''
+    fields = {'time', 'bin_time'} # used for the coordinates
+    for l in VARIABLES_INGESTED.values():
+        fields.update(l[4])
+    bins = slice(0, LIMIT_HEIGHT_BINS) if limit_height else None
+    return {'fields': sorted(fields), 'bins': bins}
+
+
 def datetime64_to_datetime(dt64):
     '''Converts a np.datetime64[ns] object to a python datetime.datetime object.
     Taken from https://gist.github.com/blaylockbk/1677b446bc741ee2db3e943ab7e4cabd?permalink_comment_id=3775327
@@ -130,60 +198,83 @@ def datetime64_to_datetime(dt64):
 # format. Each variable will have its own function,  #
 # and the outputs of the function will be parsed     #
 # into the datatype defined in VARIABLES_INGESTED.   #
+# Functions for (time,) and (time, height) variables #
+# accept out, an array of that datatype allocated by #
+# IngestPlan, which the values are written into.     #
 ######################################################
 
-def ingest_base_time(dsl, **kwargs):
+def write_out(values, out=None):
+    '''Write the values of an ingested variable into out (casting as astype does), or return them unchanged if out is None.'''
+    if out is None:
+        return values
+    np.copyto(out, values, casting='unsafe')
+    return out
+
+
+def ingest_base_time(dsl, base_time=None, **kwargs):
     '''Create the ingested base_time variable.
     
     INPUTS:
         dsl : xr.Dataset
             The loaded dataset.
+
+        base_time : None, np.datetime64
+            If given, the base_time to use instead of the first time in dsl.
     
     OUTPUTS:
         base_time : float
             The variable for base_time in the ingested data.
     '''
-    
-    base_time = dsl.time.values[0]
+    if base_time is None:
+        base_time = dsl.time.values[0]
     return base_time
 
-def ingested_time_offset(dsl, **kwargs):
+def ingested_time_offset(dsl, base_time=None, out=None, **kwargs):
     '''Create the ingested time_offset variable.
     
     INPUTS:
         dsl : xr.Dataset
             The loaded dataset.
+
+        base_time : None, np.datetime64
+            If given, the base_time to use instead of the first time in dsl.
             
     OUTPUTS:
         time_offset : np.ndarray (time,)
             The time offset from the base time.
     '''
-    base_time = dsl.time.values[0]
-    time_offset = dsl.time.values - base_time
+    if base_time is None:
+        base_time = dsl.time.values[0]
+    time_offset = np.subtract(dsl.time.values, base_time, out=out)
     return time_offset
 
-def ingested_hour(dsl, **kwargs):
+def ingested_hour(dsl, base_time=None, out=None, **kwargs):
     '''Create the ingested hour variable.
     NOTE: This approach gives a linear error from O(-5e-4) to 0 over 24 hours
 
     INPUTS:
         dsl : xr.Dataset
             raw loaded dataset
+
+        base_time : None, np.datetime64
+            If given, the reference time for the calculation instead of the first time in dsl.
 	    
 	OUTPUTS:
         hour : np.ndarray (time,)
             Array containing the hour values for the measurements.
     '''
     time = dsl.time.values
-    time_init = time[0]
+    time_init = time[0] if base_time is None else base_time
 
-    date = datetime64_to_datetime(time_init)
-    date_delta = date - date.replace(hour=0,minute=0,second=0,microsecond=0)
+    date_delta = (time_init - time_init.astype('datetime64[D]')) / np.timedelta64(1,'s') # seconds since midnight
     
-    delta = (((time - time_init).astype(datetime.datetime) / 1e9 + date_delta.total_seconds()) / 3600 ) % 24 #conversion to hours
+    delta = (time - time_init) / np.timedelta64(1,'s')
+    delta += date_delta
+    delta /= 3600 # conversion to hours
+    delta = np.remainder(delta, 24, out=out, casting='unsafe')
     return delta
 
-def ingested_nshots(dsl, **kwargs):
+def ingested_nshots(dsl, out=None, **kwargs):
 	'''Create the ingested nshots variable.
     
     INPUTS:
@@ -194,10 +285,10 @@ def ingested_nshots(dsl, **kwargs):
         nshots : np.ndarray (time,)
 	        numpy array containing the summed shots per measurement.
 	'''
-	nshots = dsl.shots_sum.values
+	nshots = write_out(dsl.shots_sum.values, out)
 	return nshots
 
-def ingested_rep_rate(dsl, **kwargs):
+def ingested_rep_rate(dsl, out=None, **kwargs):
 	'''Create the ingested rep_rate variable.
     
     INPUTS:
@@ -208,10 +299,10 @@ def ingested_rep_rate(dsl, **kwargs):
         rep_rate : np.ndarray (time,)
 	        numpy array containing the shot frequency data.
 	'''
-	rep_rate = dsl.trigger_frequency.values
+	rep_rate = write_out(dsl.trigger_frequency.values, out)
 	return rep_rate
 
-def ingested_energy(dsl, **kwargs):
+def ingested_energy(dsl, out=None, **kwargs):
 	'''Create the energy ingested variable.
     Note, this formulation doesn't match the ingested value exactly, but the error is O(2e-7) which I deem to be sufficiently small for now.
     
@@ -223,10 +314,10 @@ def ingested_energy(dsl, **kwargs):
         energy : np.ndarray (time,)
 	        np array with the laser energy output.
 	'''
-	energy = dsl.energy_monitor.values / 1000
+	energy = np.divide(dsl.energy_monitor.values, 1000, out=out, casting='unsafe')
 	return energy
 
-def ingested_temp_detector(dsl, **kwargs):
+def ingested_temp_detector(dsl, out=None, **kwargs):
 	'''Create the ingested temP_detector variable.
     NOTE: discrepancies between dsl and the original ingested format are due to float64->float32 conversions.
 	
@@ -238,10 +329,10 @@ def ingested_temp_detector(dsl, **kwargs):
         temp_detector : np.ndarray (time,)
 	        numpy array with the detector temperature values.
 	'''
-	temp_detector = dsl.temp_0.values / 100
+	temp_detector = np.divide(dsl.temp_0.values, 100, out=out, casting='unsafe')
 	return temp_detector
 
-def ingested_temp_telescope(dsl, **kwargs):
+def ingested_temp_telescope(dsl, out=None, **kwargs):
 	'''Create the ingested temp_telescope variable.
     NOTE: discrepancies between dsl and the original ingested format are due to float64->float32 conversions.
 	
@@ -253,10 +344,10 @@ def ingested_temp_telescope(dsl, **kwargs):
         temp_telescope : np.ndarray (time,)
 	        numpy array with the telescope temperature values.
 	'''
-	temp_telescope = dsl.temp_2.values / 100
+	temp_telescope = np.divide(dsl.temp_2.values, 100, out=out, casting='unsafe')
 	return temp_telescope
 
-def ingested_temp_laser(dsl, **kwargs):
+def ingested_temp_laser(dsl, out=None, **kwargs):
 	'''Create the ingested temp_laser variable.
     NOTE: discrepancies between dsl and the original ingested format are due to float64->float32 conversions.
 	
@@ -268,10 +359,10 @@ def ingested_temp_laser(dsl, **kwargs):
         temp_laser : np.ndarray (time,)
 	        numpy array with the laser temperature values.
 	'''
-	temp_laser = dsl.temp_3.values / 100
+	temp_laser = np.divide(dsl.temp_3.values, 100, out=out, casting='unsafe')
 	return temp_laser
 
-def ingested_mn_background_1(dsl, **kwargs):
+def ingested_mn_background_1(dsl, out=None, **kwargs):
 	'''Create the mn_background_1 ingested variable.
     This is the mean background, and is simply taken from the background_average variable in the raw data.
     
@@ -283,10 +374,10 @@ def ingested_mn_background_1(dsl, **kwargs):
         mn_background_1 : np.ndarray (time,)
             numpy array containing the mean background from channel 1
 	'''
-	mn_background_1 = dsl.background_average.values
+	mn_background_1 = write_out(dsl.background_average.values, out)
 	return mn_background_1
 
-def ingested_sd_background_1(dsl, **kwargs):
+def ingested_sd_background_1(dsl, out=None, **kwargs):
 	'''Create the sd_background_1 ingested variable.
 	
 	INPUTS:
@@ -297,10 +388,10 @@ def ingested_sd_background_1(dsl, **kwargs):
         sd_background_1 : np.ndarray (time,)
             Array containing the standard deviation of the background noise values
     '''
-	sd_background_1 = dsl.background_stddev.values
+	sd_background_1 = write_out(dsl.background_stddev.values, out)
 	return sd_background_1
 	
-def ingested_mn_background_2(dsl, **kwargs):
+def ingested_mn_background_2(dsl, out=None, **kwargs):
     '''Create the mn_background_2 ingested variable.
     This is the mean background, and is simply taken from the background_average variable in the raw data.
     
@@ -312,10 +403,10 @@ def ingested_mn_background_2(dsl, **kwargs):
         mn_background_2 : np.ndarray (time,)
             numpy array containing the mean background from channel 2
 	'''
-    mn_background_2 = dsl.background_average_2.values
+    mn_background_2 = write_out(dsl.background_average_2.values, out)
     return mn_background_2
 
-def ingested_sd_background_2(dsl, **kwargs):
+def ingested_sd_background_2(dsl, out=None, **kwargs):
 	'''Create the sd_background_2 ingested variable.
 	
 	INPUTS:
@@ -326,10 +417,10 @@ def ingested_sd_background_2(dsl, **kwargs):
         sd_background_2 : np.ndarray (time,)
             Array containing the standard deviation of the background noise values
     '''
-	sd_background_2 = dsl.background_stddev_2.values
+	sd_background_2 = write_out(dsl.background_stddev_2.values, out)
 	return sd_background_2
 
-def ingested_initial_cbh(dsl, **kwargs):
+def ingested_initial_cbh(dsl, out=None, **kwargs):
 	'''Create the ingested initial_cbh variable.
 	It appears this is uniformly 0 in the files, so an arbitrary choice of (time,) variable can be used.
     
@@ -341,10 +432,10 @@ def ingested_initial_cbh(dsl, **kwargs):
         initial_cbh : np.ndarray (time,)
             numpy array that contains the "lowest detected cloud base height". Will be uniformly 0.
     '''
-	initial_cbh = dsl.bin_time.values * 0
+	initial_cbh = np.multiply(dsl.bin_time.values, 0, out=out, casting='unsafe')
 	return initial_cbh
 
-def ingested_backscatter_1(dsl,limit_height,**kwargs):
+def ingested_backscatter_1(dsl,limit_height,out=None,**kwargs):
     '''Create the backscatter_1 ingested variable.
     
     INPUTS:
@@ -360,10 +451,10 @@ def ingested_backscatter_1(dsl,limit_height,**kwargs):
     '''
     backscatter_1 = dsl.channel_1.values
     if limit_height:
-        backscatter_1 = backscatter_1[:,:1200]
-    return backscatter_1
+        backscatter_1 = backscatter_1[:,:LIMIT_HEIGHT_BINS]
+    return write_out(backscatter_1, out)
 
-def ingested_backscatter_2(dsl,limit_height,**kwargs):
+def ingested_backscatter_2(dsl,limit_height,out=None,**kwargs):
     '''Create the backscatter_2 ingested variable.
     
     INPUTS:
@@ -379,8 +470,8 @@ def ingested_backscatter_2(dsl,limit_height,**kwargs):
     '''
     backscatter_2 = dsl.channel_2.values
     if limit_height:
-        backscatter_2 = backscatter_2[:,:1200]
-    return backscatter_2
+        backscatter_2 = backscatter_2[:,:LIMIT_HEIGHT_BINS]
+    return write_out(backscatter_2, out)
 
 def ingested_lat(dsl, **kwargs):
 	'''Create the lat ingested varibale.
@@ -425,29 +516,35 @@ def ingested_alt(dsl, **kwargs):
 
     [3] : function handle, None
         Function for ingesting the data.
+
+    [4] : tuple of strings
+        The raw (loaded) variables read by the ingesting function, see ingest_projection.
 '''
 VARIABLES_INGESTED = {
-    'base_time': [(), np.datetime64, {'long_name': 'Base time in Epoch'}, ingest_base_time],
-    'time_offset': [('time',), np.timedelta64, {'long_name': 'Time offset from base_time'}, ingested_time_offset],
-    'hour': [('time',), np.float32, {'long_name': 'Hour of the day', 'units': 'hour'}, ingested_hour],
-    'nshots': [('time',), np.int32, {'long_name': 'number of laser shots', 'units': 'counts'}, ingested_nshots],
-    'rep_rate': [('time',), np.int32, {'long_name': 'laser pulse repetition frequency', 'units': 'Hz'}, ingested_rep_rate],
-    'energy': [('time',), np.float32, {'long_name': 'laser energy', 'units': 'microJoules'}, ingested_energy],
-    'temp_detector': [('time',), np.float32, {'long_name': 'detector temperature', 'units': 'degC'}, ingested_temp_detector],
-    'temp_telescope': [('time',), np.float32, {'long_name': 'telescope temperature', 'units': 'degC'}, ingested_temp_telescope],
-    'temp_laser': [('time',), np.float32, {'long_name': 'laser temperature', 'units': 'degC'}, ingested_temp_laser],
-    'mn_background_1': [('time',), np.float32, {'long_name': 'mean background in channel 1', 'units': 'counts / microsecond'}, ingested_mn_background_1],
-    'sd_background_1': [('time',), np.float32, {'long_name': 'standard deviation of the background in channel 1', 'units': 'counts / microsecond'}, ingested_sd_background_1],
-    'mn_background_2': [('time',), np.float32, {'long_name': 'mean background in channel 2', 'units': 'counts / microsecond'}, ingested_mn_background_2],
-    'sd_background_2': [('time',), np.float32, {'long_name': 'standard deviation of the background in channel 2', 'units': 'counts / microsecond'}, ingested_sd_background_2],
-    'initial_cbh': [('time',), np.float32, {'long_name': 'initial cloud base height from MPL software, above ground', 'units': 'km'}, ingested_initial_cbh],
-    'backscatter_1': [('time', 'height'), np.float32, {'long_name': 'attenuated backscatter in channel 1', 'units': 'counts / microsecond', 'channel_interpretation': 'This is the linear cross-polarization channel.  It is sensitive to the depolarized backscatter from the atmosphere', 'comment': 'This field literally contains the counts detected by the detector for each range bin.  No corrections of any kind have been applied to this field.  In order to make proper use of the data, one should correct for detector non-linearity, subtract the afterpulse, subtract background counts, apply a range-squared correction, and correct for optical overlap and collimation effects'}, ingested_backscatter_1],
-    'backscatter_2': [('time', 'height'), np.float32, {'long_name': 'attenuated backscatter in channel 2', 'units': 'counts / microsecond', 'channel_interpretation': 'This is the circular polarization channel.  It is sensitive to the unpolarized backscatter from the atmosphere', 'comment': 'This field literally contains the counts detected by the detector for each range bin.  No corrections of any kind have been applied to this field.  In order to make proper use of the data, one should correct for detector non-linearity, subtract the afterpulse, subtract background counts, apply a range-squared correction, and correct for optical overlap and collimation effects'}, ingested_backscatter_2],
-    'lat': [(), np.float32, {'long_name': 'north latitude', 'units': 'degrees'}, ingested_lat],
-    'lon': [(), np.float32, {'long_name': 'east longitude', 'units': 'degrees'}, ingested_lon],
-    'alt': [(), np.float32, {'long_name': 'altitude above Mean Sea Level', 'units': 'm'}, ingested_alt]
+    'base_time': [(), np.datetime64, {'long_name': 'Base time in Epoch'}, ingest_base_time, ('time',)],
+    'time_offset': [('time',), np.timedelta64, {'long_name': 'Time offset from base_time'}, ingested_time_offset, ('time',)],
+    'hour': [('time',), np.float32, {'long_name': 'Hour of the day', 'units': 'hour'}, ingested_hour, ('time',)],
+    'nshots': [('time',), np.int32, {'long_name': 'number of laser shots', 'units': 'counts'}, ingested_nshots, ('shots_sum',)],
+    'rep_rate': [('time',), np.int32, {'long_name': 'laser pulse repetition frequency', 'units': 'Hz'}, ingested_rep_rate, ('trigger_frequency',)],
+    'energy': [('time',), np.float32, {'long_name': 'laser energy', 'units': 'microJoules'}, ingested_energy, ('energy_monitor',)],
+    'temp_detector': [('time',), np.float32, {'long_name': 'detector temperature', 'units': 'degC'}, ingested_temp_detector, ('temp_0',)],
+    'temp_telescope': [('time',), np.float32, {'long_name': 'telescope temperature', 'units': 'degC'}, ingested_temp_telescope, ('temp_2',)],
+    'temp_laser': [('time',), np.float32, {'long_name': 'laser temperature', 'units': 'degC'}, ingested_temp_laser, ('temp_3',)],
+    'mn_background_1': [('time',), np.float32, {'long_name': 'mean background in channel 1', 'units': 'counts / microsecond'}, ingested_mn_background_1, ('background_average',)],
+    'sd_background_1': [('time',), np.float32, {'long_name': 'standard deviation of the background in channel 1', 'units': 'counts / microsecond'}, ingested_sd_background_1, ('background_stddev',)],
+    'mn_background_2': [('time',), np.float32, {'long_name': 'mean background in channel 2', 'units': 'counts / microsecond'}, ingested_mn_background_2, ('background_average_2',)],
+    'sd_background_2': [('time',), np.float32, {'long_name': 'standard deviation of the background in channel 2', 'units': 'counts / microsecond'}, ingested_sd_background_2, ('background_stddev_2',)],
+    'initial_cbh': [('time',), np.float32, {'long_name': 'initial cloud base height from MPL software, above ground', 'units': 'km'}, ingested_initial_cbh, ('bin_time',)],
+    'backscatter_1': [('time', 'height'), np.float32, {'long_name': 'attenuated backscatter in channel 1', 'units': 'counts / microsecond', 'channel_interpretation': 'This is the linear cross-polarization channel.  It is sensitive to the depolarized backscatter from the atmosphere', 'comment': 'This field literally contains the counts detected by the detector for each range bin.  No corrections of any kind have been applied to this field.  In order to make proper use of the data, one should correct for detector non-linearity, subtract the afterpulse, subtract background counts, apply a range-squared correction, and correct for optical overlap and collimation effects'}, ingested_backscatter_1, ('channel_1',)],
+    'backscatter_2': [('time', 'height'), np.float32, {'long_name': 'attenuated backscatter in channel 2', 'units': 'counts / microsecond', 'channel_interpretation': 'This is the circular polarization channel.  It is sensitive to the unpolarized backscatter from the atmosphere', 'comment': 'This field literally contains the counts detected by the detector for each range bin.  No corrections of any kind have been applied to this field.  In order to make proper use of the data, one should correct for detector non-linearity, subtract the afterpulse, subtract background counts, apply a range-squared correction, and correct for optical overlap and collimation effects'}, ingested_backscatter_2, ('channel_2',)],
+    'lat': [(), np.float32, {'long_name': 'north latitude', 'units': 'degrees'}, ingested_lat, ()],
+    'lon': [(), np.float32, {'long_name': 'east longitude', 'units': 'degrees'}, ingested_lon, ()],
+    'alt': [(), np.float32, {'long_name': 'altitude above Mean Sea Level', 'units': 'm'}, ingested_alt, ()]
 }
 
+# number of range bins kept when limit_height is True, matching the Summit ingested format
+LIMIT_HEIGHT_BINS = 1200
+
 DIMENSIONS_INGESTED = {
       'height': {'long_name': 'height', 'units': 'm'},
       'time': {'long_name': 'time', 'units': ''}
@@ -0,0 +1,137 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Functions to write ingested and calibrated datasets to netcdf, including appending profiles along the time dimension of an existing file.
+'''
+
+import json
+import os
+
+import netCDF4
+import numpy as np
+import xarray as xr
+
+from .encoding import output_encoding
+
+# the global attribute of a product listing the raw files it was made from, see describe_sources
+SOURCES_ATTR = 'source_files'
+
+def write_netcdf(ds, fname, dim='time', encoding=None):
+    '''Function to write a dataset to a new netcdf file, with dim as an unlimited dimension so that further profiles can be appended.
+
+    The units of any datetime or timedelta variables along dim are fixed by this first write, and are reused by append_netcdf.
+
+    INPUTS:
+        ds : xr.Dataset
+            The dataset to be written.
+
+        fname : string
+            Full filename of the netcdf file to be created. Any existing file is overwritten.
+
+        dim : string ; default='time'
+            The dimension that will be appended along.
+
+        encoding : None, string ; default=None
+            The name of the encoding profile the variables are written with (see encoding.output_encoding). The compression, packing and chunks are kept by later appends. If None, the variables are written uncompressed.
+    '''
+    ds.to_netcdf(fname, mode='w', unlimited_dims=[dim], encoding=output_encoding(ds, encoding, dim=dim, unlimited=True))
+
+
+def append_netcdf(ds, fname, dim='time', attrs=None):
+    '''Function to append the profiles of a dataset to an existing netcdf file along dim.
+
+    Only the variables with the dimension dim are appended; all other variables are assumed to be unchanged from the initial write. Each variable is encoded with the units, calendar, dtype and packing stored in the file, and the file's compression and quantization are applied by the netcdf library, so the appended values are identical to those that would be written by a single call to xr.Dataset.to_netcdf.
+
+    INPUTS:
+        ds : xr.Dataset
+            The dataset containing the profiles to be appended.
+
+        fname : string
+            Full filename of the netcdf file, created by write_netcdf.
+
+        dim : string ; default='time'
+            The (unlimited) dimension to append along.
+
+        attrs : None, dict ; default=None
+            If given, global attributes of the file to set or update, e.g. the source_files attribute.
+    '''
+    with netCDF4.Dataset(fname, 'a') as f:
+        if attrs is not None:
+            f.setncatts(attrs)
+        n0 = f.dimensions[dim].size
+        n1 = n0 + ds.sizes[dim]
+        for k in ds.variables:
+            variable = ds[k].variable
+            if dim not in variable.dims:
+                continue
+            ncvar = f.variables[k]
+            ncvar.set_auto_maskandscale(False)
+            values = encode_like(variable, ncvar)
+            index = tuple(slice(n0, n1) if d == dim else slice(None) for d in variable.dims)
+            ncvar[index] = values
+
+
+def encode_like(variable, ncvar):
+    '''Function to encode an xarray Variable in the same way as an existing netcdf variable.
+
+    INPUTS:
+        variable : xr.Variable
+            The (decoded) variable to be encoded.
+
+        ncvar : netCDF4.Variable
+            The variable in the file whose encoding (units, calendar, dtype and _FillValue) should be matched.
+
+    OUTPUTS:
+        values : np.ndarray
+            The encoded values, ready to be written to ncvar.
+    '''
+    variable = variable.copy(deep=False)
+    encoding = {'dtype': ncvar.dtype}
+    for attr in ['units', 'calendar', '_FillValue', 'scale_factor', 'add_offset']:
+        if attr in ncvar.ncattrs():
+            encoding[attr] = ncvar.getncattr(attr)
+    if variable.dtype.kind not in 'mM':
+        encoding.pop('units', None)
+        encoding.pop('calendar', None)
+    variable.attrs = {}
+    variable.encoding = encoding
+    encoded = xr.conventions.encode_cf_variable(variable)
+    return np.asarray(encoded.values)
+
+
+def describe_sources(fnames, dir_root):
+    '''Function to describe the raw files a product is made from, as stored in its source_files attribute.
+
+    INPUTS:
+        fnames : list [string]
+            The filenames of the raw files, relative to dir_root.
+
+        dir_root : string
+            The directory containing the raw files.
+
+    OUTPUTS:
+        sources : string
+            JSON object mapping each filename to its [size, mtime_ns], so that files that have been added or modified since the product was made can be found.
+    '''
+    sources = {}
+    for fname in sorted(fnames):
+        st = os.stat(os.path.join(dir_root, fname))
+        sources[fname] = [st.st_size, st.st_mtime_ns]
+    return json.dumps(sources)
+
+
+def read_sources(fname):
+    '''Function to read the source_files attribute of a netcdf product.
+
+    INPUTS:
+        fname : string
+            Full filename of the netcdf file.
+
+    OUTPUTS:
+        sources : None, dict
+            Dictionary mapping each raw filename to its [size, mtime_ns] when the product was made, as given by describe_sources. None if the file has no source_files attribute.
+    '''
+    with netCDF4.Dataset(fname) as f:
+        if SOURCES_ATTR not in f.ncattrs():
+            return None
+        return json.loads(f.getncattr(SOURCES_ATTR))
@@ -0,0 +1,283 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+A single Zarr store holding calibrated days along the time dimension, as an alternative to one netcdf file per day. Each day is written in place into a fixed slot of profiles, so days can be written in any order, rewritten, and written by several processes at once.
+'''
+
+import fcntl
+import math
+import os
+
+import numpy as np
+import xarray as xr
+
+from .encoding import output_encoding, ENCODING_PROFILES
+
+# the default time between profiles of the raw data [s], the averaging time the MPL is usually run with
+PROFILE_INTERVAL = 5
+
+# the fraction of a day's profiles added to its slot, for the profiles of calibration files (which can be at a different resolution) and jitter in the profile times
+SLOT_MARGIN = 0.04
+
+# the encoded value of NaT in the datetime and timedelta arrays
+NAT_FILL_VALUE = np.iinfo(np.int64).min
+
+def day_slot_size(profile_interval=PROFILE_INTERVAL, encoding='archive', margin=SLOT_MARGIN):
+    '''Function to get the number of profiles in the slot of each day of a ZarrArchive, from the time between the profiles of the instrument.
+
+    The slot holds the 86400/profile_interval profiles of a day, plus a margin, rounded up to a whole number of time chunks of the encoding profile. At the default 5 second resolution this is 18000 profiles.
+
+    INPUTS:
+        profile_interval : float ; default=PROFILE_INTERVAL
+            The time between the profiles of the raw data [s]. If the instrument is run at several resolutions, the shortest should be used.
+
+        encoding : string ; default='archive'
+            The encoding profile of the store, whose time chunk the slot is a multiple of.
+
+        margin : float ; default=SLOT_MARGIN
+            The fraction of the day's profiles added to the slot.
+
+    OUTPUTS:
+        slot_size : int
+            The number of profiles in the slot of each day.
+    '''
+    if profile_interval <= 0:
+        err_msg = f'profile_interval must be positive, not {profile_interval}'
+        raise ValueError(err_msg)
+    time_chunk = ENCODING_PROFILES[encoding]['time_chunk']
+    n_profiles = 86400/profile_interval*(1 + margin)
+    return math.ceil(round(n_profiles/time_chunk, 6))*time_chunk
+
+class ZarrArchive:
+    '''Continuous archive of calibrated days in a single Zarr store, chunked along time.
+
+    Every day has a fixed slot of slot_size profiles along time, counted from the first day of the store (first_day), which is set when the store is created. Days before first_day can't be written, so it should be the earliest day that the store will hold, not the first day to be written: days are often written out of date order, e.g. by calibrate_dates or a SLURM job array. The profiles of a day fill the start of its slot, and the rest of the slot is padding, with NaT times. The variables without the time dimension (base_time, the afterpulse and overlap profiles, the scaling constants, ...) are given a day dimension, so they are kept for every day. The height grid and the set of variables are fixed by the first day written.
+
+    As the slots are a whole number of chunks, writes for different days never touch the same chunk, so several processes can write days at once. Only adding days to the end of the store (which resizes the arrays and updates the consolidated metadata) is done under an exclusive lock, on the file store + '.lock'. Rewriting a day overwrites its whole slot, including any padding.
+
+    INPUTS:
+        store : string
+            The path of the Zarr store. It is created by the first write.
+
+        encoding : string ; default='archive'
+            The encoding profile of the arrays (see encoding.output_encoding), used when the store is created. Unlike for netcdf files, it can't be None, as the slots are made of the profile's chunks.
+
+        slot_size : None, int ; default=None
+            The number of profiles in the slot of each day, used when the store is created. Must be a multiple of the time chunk of the encoding profile. If None, it is given by day_slot_size from profile_interval. For an existing store, the slot size of the store is used.
+
+        first_day : None, datetime.date, datetime.datetime ; default=None
+            The day of the first slot, used when the store is created. It must be given for the store to be created. For an existing store, the first day of the store is used.
+
+        profile_interval : float ; default=PROFILE_INTERVAL
+            The time between the profiles of the raw data [s], which sets the slot size when slot_size is None. A day with more profiles than the slot (e.g. from an instrument run at a higher resolution than this) can't be written, so it should be the shortest averaging time the instrument is run at.
+    '''
+
+    def __init__(self, store, encoding='archive', slot_size=None, first_day=None, profile_interval=PROFILE_INTERVAL):
+        if encoding is None:
+            err_msg = f'a Zarr store needs an encoding profile for its chunks, one of {list(ENCODING_PROFILES)}'
+            raise ValueError(err_msg)
+        if encoding not in ENCODING_PROFILES:
+            err_msg = f'encoding must be one of {list(ENCODING_PROFILES)}, not {encoding!r}'
+            raise ValueError(err_msg)
+        if slot_size is None:
+            slot_size = day_slot_size(profile_interval, encoding)
+        if slot_size % ENCODING_PROFILES[encoding]['time_chunk'] != 0:
+            err_msg = f"slot_size must be a multiple of the time chunk of the {encoding!r} encoding ({ENCODING_PROFILES[encoding]['time_chunk']})"
+            raise ValueError(err_msg)
+        self.store = os.path.abspath(store)
+        self.encoding = encoding
+        self.slot_size = slot_size
+        self.profile_interval = profile_interval
+        self.first_day = None if first_day is None else np.datetime64(first_day, 'D')
+        self.lock_path = self.store + '.lock'
+        if os.path.exists(self.store):
+            self._read_layout()
+
+    def write_day(self, ds, date, start=0, pad=True):
+        '''Function to write the profiles of a calibrated dataset into the slot of a day.
+
+        INPUTS:
+            ds : xr.Dataset
+                The ingested and calibrated dataset for the day, as given by calibrate_ingested.
+
+            date : datetime.date, datetime.datetime
+                The day being written.
+
+            start : int ; default=0
+                The position in the slot of the first profile of ds. Used to write a day in blocks of profiles, e.g. by calibrate_day with stream=True.
+
+            pad : bool ; default=True
+                If True, the rest of the slot after the profiles of ds is overwritten with padding, removing any profiles from a previous write of the day.
+        '''
+        day = np.datetime64(date, 'D')
+        n = ds.sizes['time']
+        if start + n > self.slot_size:
+            err_msg = f'{start + n} profiles for {day} do not fit in the day slots of {self.slot_size} profiles of the store, made for a profile_interval of {self.profile_interval} s. A store for data at a higher resolution needs a smaller profile_interval (or a larger slot_size) when it is created'
+            raise ValueError(err_msg)
+
+        ds = _slot_dataset(ds, day)
+        if pad:
+            ds = _pad_profiles(ds, self.slot_size - start)
+        i = self._ensure_day(day, ds)
+
+        # the height (and other static coordinates) are checked by _ensure_day, and aren't rewritten
+        static = [k for k in ds.variables if 'time' not in ds[k].dims and 'day' not in ds[k].dims]
+        t0 = i*self.slot_size + start
+        region = {'time': slice(t0, t0 + ds.sizes['time']), 'day': slice(i, i+1)}
+        ds.drop_vars(static).drop_indexes(['time', 'day']).to_zarr(self.store, region=region, consolidated=False, safe_chunks=False) # without their indexes, so the time and day coordinates are written
+
+    def has_day(self, date):
+        '''Function to check whether a day has been written to the store.'''
+        return np.datetime64(date, 'D') in self.days()
+
+    def days(self):
+        '''Function to get the days that have been written to the store.
+
+        OUTPUTS:
+            days : np.ndarray
+                The days, as datetime64[D].
+        '''
+        if not os.path.exists(self.store):
+            return np.array([], dtype='datetime64[D]')
+        with xr.open_zarr(self.store, consolidated=True, chunks=None, create_default_indexes=False) as ds:
+            days = ds['day'].values
+        return days[~np.isnat(days)].astype('datetime64[D]')
+
+    def open(self, start=None, end=None, chunks=None):
+        '''Function to open the profiles of the store, with the padding removed.
+
+        Only the time coordinates of the days in [start, end) are read, and the variables are loaded lazily.
+
+        INPUTS:
+            start, end : None, datetime.date, datetime.datetime ; default=None
+                If given, only the days in the range [start, end) are returned.
+
+            chunks : None, dict ; default=None
+                Passed to xr.open_zarr. If None, the variables are lazily loaded numpy arrays; otherwise they are dask arrays.
+
+        OUTPUTS:
+            ds : xr.Dataset
+                The profiles of the days in the range, along time, with the per-day variables along day.
+        '''
+        ds = xr.open_zarr(self.store, consolidated=True, chunks=chunks, create_default_indexes=False)
+        n_days = ds.sizes['day']
+        i0 = 0 if start is None else min(max((np.datetime64(start, 'D') - self.first_day).astype(int), 0), n_days)
+        i1 = n_days if end is None else min(max((np.datetime64(end, 'D') - self.first_day).astype(int), i0), n_days)
+        ds = ds.isel(day=slice(i0, i1), time=slice(i0*self.slot_size, i1*self.slot_size))
+
+        ds = ds.isel(time=np.flatnonzero(~np.isnat(ds['time'].values)), day=np.flatnonzero(~np.isnat(ds['day'].values)))
+        return ds.set_xindex('time').set_xindex('day').set_xindex('height')
+
+    def _ensure_day(self, day, ds):
+        # create the store, or extend it to hold day, returning the index of the day's slot
+        import zarr
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(self.store):
+                    if self.first_day is None:
+                        err_msg = f'first_day must be given to create the store {self.store}'
+                        raise ValueError(err_msg)
+                    if day < self.first_day:
+                        err_msg = f'{day} is before the first day of the store, {self.first_day}'
+                        raise ValueError(err_msg)
+                    self._create(ds)
+                self._read_layout()
+                i = int((day - self.first_day).astype(int))
+                if i < 0:
+                    err_msg = f'{day} is before the first day of the store, {self.first_day}. The store must be written again with an earlier first_day to hold it'
+                    raise ValueError(err_msg)
+
+                group = zarr.open_group(self.store, mode='r+', use_consolidated=False)
+                if not np.array_equal(group['height'][:], ds['height'].values):
+                    err_msg = f'the height grid of {day} is different to the height grid of the store'
+                    raise ValueError(err_msg)
+                missing = set(ds.variables) ^ set(group.array_keys())
+                if missing:
+                    err_msg = f'the variables {sorted(missing)} are not in both the store and the data for {day}'
+                    raise ValueError(err_msg)
+
+                n_days = group['day'].shape[0]
+                if i >= n_days:
+                    for _, array in group.arrays():
+                        dims = _array_dims(array)
+                        shape = tuple((i+1)*self.slot_size if d == 'time' else i+1 if d == 'day' else s for d, s in zip(dims, array.shape))
+                        array.resize(shape)
+                    # the new slots are padding until they are written. Only the times need to be set, as the padding is found from them
+                    group['time'][n_days*self.slot_size:] = group['time'].attrs['_FillValue']
+                    group['day'][n_days:] = group['day'].attrs['_FillValue']
+                    zarr.consolidate_metadata(self.store)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return i
+
+    def _create(self, ds):
+        # write the arrays, attributes and static coordinates, with a single day slot of padding for first_day
+        template = _pad_profiles(ds.isel(time=slice(0, 0)), self.slot_size)
+        template = template.assign_coords(day=('day', np.array(['NaT'], dtype='datetime64[ns]')))
+        template = template.assign_attrs(first_day=str(self.first_day), day_slot_size=self.slot_size, profile_interval=self.profile_interval, encoding_profile=self.encoding)
+        template.to_zarr(self.store, mode='w-', encoding=_zarr_encoding(template, self.encoding, self.slot_size), consolidated=True)
+
+    def _read_layout(self):
+        import zarr
+        attrs = zarr.open_group(self.store, mode='r').attrs
+        self.first_day = np.datetime64(attrs['first_day'], 'D')
+        self.slot_size = int(attrs['day_slot_size'])
+        self.profile_interval = attrs.get('profile_interval')
+        self.encoding = attrs['encoding_profile']
+
+
+def _slot_dataset(ds, day):
+    # give the variables without the time dimension a day dimension
+    ds = ds.copy()
+    for k in list(ds.data_vars):
+        if 'time' not in ds[k].dims:
+            ds[k] = ds[k].expand_dims('day')
+    return ds.assign_coords(day=('day', [day.astype('datetime64[ns]')]))
+
+
+def _pad_profiles(ds, n, dim='time'):
+    # extend the variables along dim to n profiles, with NaT, NaN or 0 depending on their dtype
+    n_pad = n - ds.sizes[dim]
+    if n_pad == 0:
+        return ds
+    variables = {}
+    for k, v in ds.variables.items():
+        if dim in v.dims:
+            axis = v.dims.index(dim)
+            shape = list(v.shape)
+            shape[axis] = n_pad
+            v = xr.Variable(v.dims, np.concatenate([v.values, np.full(shape, _fill_value(v.dtype), dtype=v.dtype)], axis=axis), v.attrs)
+        variables[k] = v
+    return xr.Dataset({k: variables[k] for k in ds.data_vars}, coords={k: variables[k] for k in ds.coords}, attrs=ds.attrs)
+
+
+def _fill_value(dtype):
+    if dtype.kind in 'mM':
+        return np.array('NaT', dtype=dtype)
+    if dtype.kind in 'fc':
+        return np.nan
+    return 0
+
+
+def _zarr_encoding(ds, profile, slot_size):
+    # the encoding profile's 2D chunks and dtypes, with one chunk per slot for the 1D time variables and one chunk per day for the day variables
+    encoding = output_encoding(ds, profile, backend='zarr')
+    for k, variable in ds.variables.items():
+        enc = encoding.setdefault(k, {})
+        if variable.dims == ('time',):
+            enc['chunks'] = (slot_size,)
+        elif 'day' in variable.dims:
+            enc['chunks'] = tuple(1 if d == 'day' else ds.sizes[d] for d in variable.dims)
+        if variable.dtype.kind == 'M':
+            enc.update({'units': 'microseconds since 1970-01-01', 'dtype': 'int64', '_FillValue': NAT_FILL_VALUE})
+        elif variable.dtype.kind == 'm':
+            enc.update({'units': 'microseconds', 'dtype': 'int64', '_FillValue': NAT_FILL_VALUE})
+    return encoding
+
+
+def _array_dims(array):
+    dims = getattr(array.metadata, 'dimension_names', None) # zarr format 3
+    if dims is None:
+        dims = array.attrs['_ARRAY_DIMENSIONS'] # zarr format 2
+    return tuple(dims)
@@ -25,15 +25,62 @@ Class definition for the ARM Micro Pulse Lidar (MPL).
                        header[k] = mpl108.header[k]
 
 """
-import os
 import gzip
-import io
-from struct import unpack
 import numpy as np
 from datetime import datetime
 
 import xarray as xr
 
+# Layout of the 128-byte record header: (key, byte offset, dtype as stored in the file).
+HEADER_FIELDS = [('unitNumber',        0, '<u2'),
+                 ('version',           2, '<u2'),
+                 ('year',              4, '<u2'),
+                 ('month',             6, '<u2'),
+                 ('day',               8, '<u2'),
+                 ('hours',            10, '<u2'),
+                 ('minutes',          12, '<u2'),
+                 ('seconds',          14, '<u2'),
+                 ('shotsSum',         16, '<u4'),
+                 ('triggerFrequency', 20, '<i4'),
+                 ('energyMonitor',    24, '<u4'),
+                 ('temp0',            28, '<u4'),
+                 ('temp1',            32, '<u4'),   # Currently not used.
+                 ('temp2',            36, '<u4'),
+                 ('temp3',            40, '<u4'),
+                 ('temp4',            44, '<u4'),   # Currently not used.
+                 ('backgroundAverage',48, '<f4'),
+                 ('backgroundStdDev', 52, '<f4'),
+                 ('numberChannels',   56, '<u2'),
+                 ('numberBins',       58, '<u4'),
+                 ('binTime',          62, '<f4'),
+                 ('rangeCalibration', 66, '<f4'),
+                 ('numberDataBins',   70, '<u2'),
+                 ('scanScenarioFlag', 72, '<u2'),
+                 ('numberBackgrdBins',74, '<u2'),
+                 ('azimuthAngle',     76, '<f4'),
+                 ('elevationAngle',   80, '<f4'),
+                 ('compassDegrees',   84, '<f4'),
+                 ('polarizationV0',   88, '<f4'),
+                 ('polarizationV1',   92, '<f4'),
+                 ('gpsLatitude',      96, '<f4'),
+                 ('gpsLongitude',    100, '<f4'),
+                 ('cloudBaseHeight', 104, '<f4'),
+                 ('aToDdataBadFlag', 108, 'i1'),
+                 ('dataFileVersion', 109, 'i1'),
+                 ('backgrdAverage2', 110, '<f4'),
+                 ('backgrdStdDev2',  114, '<f4'),
+                 ('mcsMode',         118, 'i1'),
+                 ('firstDataBin',    119, '<u2'),
+                 ('systemType',      121, 'i1'),
+                 ('syncPulsePerSec', 122, '<u2'),
+                 ('firstBackgrdBin', 124, '<u2'),
+                 ('secondaryHdrSize',126, '<u2')]
+
+# Temperatures are stored in hundredths of a degree; temp1 and temp4 are not used.
+TEMPERATURE_FIELDS = {'temp0': 'detectorTemp',
+                      'temp2': 'telescopeTemp',
+                      'temp3': 'laserTemp'}
+
 class MPL:
 
     def __init__(self, filename):
@@ -44,143 +91,44 @@ class MPL:
         
         Written by Von P. Walden
         13 Oct 2014
+
+        Updated to read the whole file in one pass (or memory-map it, if it
+        is not compressed); the records are decoded by readData.
         """
 
         #################################################################################
-        # Open file and read critical parameters for determining header and record sizes.
+        # Read the file and the critical parameters for determining header and record sizes.
         self.filename             = filename
         
         # functionality for opening from the ICECAPSarchive on JASMIN. File size in gzip format will be different too.
+        # Uncompressed files are memory-mapped, rather than being read into memory before they are decoded.
         if filename[-3:] == '.gz':
-            self.fp = gzip.open(filename, 'rb')
-            #self.fileSize = self.fp.size
-            self.fileSize = self.fp.seek(0, io.SEEK_END)
-            self.fp.seek(0,0)
-
+            with open(filename, 'rb') as fp:
+                self.buffer = gzip.decompress(fp.read())
         else:
-            self.fp = open(filename,'rb')
-            self.fileSize = os.path.getsize(filename)
+            self.buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+        self.fileSize = len(self.buffer)
         
-        self.unitNumber           = np.uint16( unpack('<H',self.fp.read(2)))[0]
-        self.fp.seek(56)
-        self.numberChannels       = np.uint16( unpack('<H',self.fp.read(2)))[0]
-        self.numberBins           = np.uint16( unpack('<H',self.fp.read(2)))[0]
-        self.fp.seek(126)
-        secondaryHdrSize          = np.uint16( unpack('<H',self.fp.read(2)))[0]
+        first = np.frombuffer(self.buffer, dtype=self._headerDtype(), count=1)[0]
+        self.unitNumber           = first['unitNumber']
+        self.numberChannels       = first['numberChannels']
+        self.numberBins           = first['numberBins']
+        secondaryHdrSize          = first['secondaryHdrSize']
         if secondaryHdrSize==0:
             self.headerSize       = 128
         else:
-            self.headerSize       = secondaryHdrSize
-        self.numberBytesPerRecord = self.headerSize + (self.numberChannels*self.numberBins*4)
-        
-        # Determine the size of the file and the number of records.
-        self.numberRecords        = (self.fileSize / self.numberBytesPerRecord).astype('int')
+            self.headerSize       = int(secondaryHdrSize)
+        self.numberBytesPerRecord = self.headerSize + (int(self.numberChannels)*int(self.numberBins)*4)
         
-        # Reset the file pointer to the beginning of the file.
-        self.fp.seek(0)
-        
-        #################################################################################
-        # Initialize header.
-        keys = ['unitNumber',
-                'version',
-                'year',
-                'month',
-                'day',
-                'hours',
-                'minutes',
-                'seconds',
-                'Time',
-                'shotsSum',
-                'triggerFrequency',
-                'energyMonitor',
-                'detectorTemp',
-                'telescopeTemp',
-                'laserTemp',
-                'backgroundAverage',
-                'backgroundStdDev',
-                'numberChannels',
-                'numberBins',
-                'binTime',
-                'rangeCalibration',
-                'numberDataBins',
-                'scanScenarioFlag',
-                'numberBackgrdBins',
-                'azimuthAngle',
-                'elevationAngle',
-                'compassDegrees',
-                'polarizationV0',
-                'polarizationV1',
-                'gpsLatitude',
-                'gpsLongitude',
-                'cloudBaseHeight',
-                'aToDdataBadFlag',
-                'dataFileVersion',
-                'backgrdAverage2',
-                'backgrdStdDev2',
-                'mcsMode',
-                'firstDataBin',
-                'systemType',
-                'syncPulsePerSec',
-                'firstBackgrdBin',
-                'secondaryHdrSize']
-        self.header = dict()
-        for key in keys:
-            if key=='unitNumber'          or \
-               key=='version'             or \
-               key=='year'                or \
-               key=='month'               or \
-               key=='day'                 or \
-               key=='hours'               or \
-               key=='minutes'             or \
-               key=='seconds'             or \
-               key=='numberChannels'      or \
-               key=='numberDataBins'      or \
-               key=='scanScenarioFlag'    or \
-               key=='numberBackgrdBins'   or \
-               key=='firstDataBin'        or \
-               key=='syncPulsePerSec'     or \
-               key=='firstBackgrdBin'     or \
-               key=='secondaryHdrSize':
-                self.header[key] = np.array([], dtype='uint16')
-            elif key=='shotsSum'          or \
-                 key=='numberBins':
-                self.header[key] = np.array([], dtype='uint32')
-            elif key=='triggerFrequency':
-                self.header[key] = np.array([], dtype='int32')
-            elif key=='detectorTemp'      or \
-                 key=='telescopeTemp'     or \
-                 key=='laserTemp'         or \
-                 key=='energyMonitor'     or \
-                 key=='backgroundAverage' or \
-                 key=='backgroundStdDev'  or \
-                 key=='binTime'           or \
-                 key=='rangeCalibration'  or \
-                 key=='azimuthAngle'      or \
-                 key=='elevationAngle'    or \
-                 key=='compassDegrees'    or \
-                 key=='polarizationV0'    or \
-                 key=='polarizationV1'    or \
-                 key=='gpsLatitude'       or \
-                 key=='gpsLongitude'      or \
-                 key=='cloudBaseHeight'   or \
-                 key=='backgrdAverage2'   or \
-                 key=='backgrdStdDev2':
-                self.header[key] = np.array([], dtype='float32')
-            elif key=='aToDdataBadFlag'   or \
-                 key=='dataFileVersion'   or \
-                 key=='mcsMode'           or \
-                 key=='systemType':
-                self.header[key] = np.array([], dtype='byte')
-            elif key=='Time':
-                self.header[key] = np.array([], dtype=datetime)
+        # Determine the number of complete records in the file.
+        self.numberRecords        = self.fileSize // self.numberBytesPerRecord
         
-        
-        #################################################################################
-        # Initialize data arrays.
-        self.height  = np.zeros((self.numberRecords,self.numberBins))
-        self.time    = np.zeros((self.numberRecords,self.numberBins))
-        self.dataCh1 = np.zeros((self.numberRecords,self.numberBins))
-        self.dataCh2 = np.zeros((self.numberRecords,self.numberBins))
+        self.header  = dict()
+        self.height  = None
+        self.time    = None
+        self.hours   = None
+        self.dataCh1 = None
+        self.dataCh2 = None
         
         return 
         
@@ -202,85 +150,69 @@ class MPL:
 
         Updated by Von P. Walden
         15 February 2016
+
+        Updated to decode all of the records at once as a structured array.
+        The header, dataCh1 and dataCh2 are the same as from the per-record
+        reader (tests/von_reference.py): the channels are float64 copies, and
+        the secondary header is only skipped for MPL 108.
         """
         
         SOL          = 299792458.      # Speed of light in m s-1
         
-        for rec in range(self.numberRecords):
-            
-            # Read and store the header information.
-                    # Decode the 128-byte header.
-            header                 = self.fp.read(128)
-            self.header['unitNumber']        = np.append(self.header['unitNumber']       , np.uint16( unpack('<H',header[  0:  2])[0]) )
-            self.header['version']           = np.append(self.header['version']          , np.uint16( unpack('<H',header[  2:  4])[0]) )
-            self.header['year']              = np.append(self.header['year']             , np.uint16( unpack('<H',header[  4:  6])[0]) )
-            self.header['month']             = np.append(self.header['month']            , np.uint16( unpack('<H',header[  6:  8])[0]) )
-            self.header['day']               = np.append(self.header['day']              , np.uint16( unpack('<H',header[  8: 10])[0]) )
-            self.header['hours']             = np.append(self.header['hours']            , np.uint16( unpack('<H',header[ 10: 12])[0]) )
-            self.header['minutes']           = np.append(self.header['minutes']          , np.uint16( unpack('<H',header[ 12: 14])[0]) )
-            self.header['seconds']           = np.append(self.header['seconds']          , np.uint16( unpack('<H',header[ 14: 16])[0]) )
-            self.header['Time']              = np.append(self.header['Time']             , datetime(self.header['year'][rec], self.header['month'][rec], self.header['day'][rec], self.header['hours'][rec], self.header['minutes'][rec], self.header['seconds'][rec]) )
-            self.header['shotsSum']          = np.append(self.header['shotsSum']         , np.uint32( unpack('<L',header[ 16: 20])[0]) )
-            self.header['triggerFrequency']  = np.append(self.header['triggerFrequency'] , np.int32(  unpack('<L',header[ 20: 24])[0]) )
-            self.header['energyMonitor']     = np.append(self.header['energyMonitor']    , np.uint32( unpack('<L',header[ 24: 28])[0])/1000. )
-            temp0                            = np.uint32( unpack('<L',header[ 28: 32])[0])
-            temp1                            = np.uint32( unpack('<L',header[ 32: 36])[0])   # Currently not used.
-            temp2                            = np.uint32( unpack('<L',header[ 36: 40])[0])
-            temp3                            = np.uint32( unpack('<L',header[ 40: 44])[0])
-            temp4                            = np.uint32( unpack('<L',header[ 44: 48])[0])   # Currently not used.
-            self.header['detectorTemp']      = np.append(self.header['detectorTemp']     , temp0/100. )
-            self.header['telescopeTemp']     = np.append(self.header['telescopeTemp']    , temp2/100. )
-            self.header['laserTemp']         = np.append(self.header['laserTemp']        , temp3/100. )
-            self.header['backgroundAverage'] = np.append(self.header['backgroundAverage'], np.float32(unpack('<f',header[ 48: 52])[0]) )
-            self.header['backgroundStdDev']  = np.append(self.header['backgroundStdDev'] , np.float32(unpack('<f',header[ 52: 56])[0]) )
-            self.header['numberChannels']    = np.append(self.header['numberChannels']   , np.uint16( unpack('<H',header[ 56: 58])[0]) )
-            self.header['numberBins']        = np.append(self.header['numberBins']       , np.uint32( unpack('<L',header[ 58: 62])[0]) )
-            self.header['binTime']           = np.append(self.header['binTime']          , np.float32(unpack('<f',header[ 62: 66])[0]) )
-            self.header['rangeCalibration']  = np.append(self.header['rangeCalibration'] , np.float32(unpack('<f',header[ 66: 70])[0]) )
-            self.header['numberDataBins']    = np.append(self.header['numberDataBins']   , np.uint16( unpack('<H',header[ 70: 72])[0]) )
-            self.header['scanScenarioFlag']  = np.append(self.header['scanScenarioFlag'] , np.uint16( unpack('<H',header[ 72: 74])[0]) )
-            self.header['numberBackgrdBins'] = np.append(self.header['numberBackgrdBins'], np.uint16( unpack('<H',header[ 74: 76])[0]) )
-            self.header['azimuthAngle']      = np.append(self.header['azimuthAngle']     , np.float32(unpack('<f',header[ 76: 80])[0]) )
-            self.header['elevationAngle']    = np.append(self.header['elevationAngle']   , np.float32(unpack('<f',header[ 80: 84])[0]) )
-            self.header['compassDegrees']    = np.append(self.header['compassDegrees']   , np.float32(unpack('<f',header[ 84: 88])[0]) )
-            self.header['polarizationV0']    = np.append(self.header['polarizationV0']   , np.float32(unpack('<f',header[ 88: 92])[0]) )
-            self.header['polarizationV1']    = np.append(self.header['polarizationV1']   , np.float32(unpack('<f',header[ 92: 96])[0]) )
-            self.header['gpsLatitude']       = np.append(self.header['gpsLatitude']      , np.float32(unpack('<f',header[ 96:100])[0]) )
-            self.header['gpsLongitude']      = np.append(self.header['gpsLongitude']     , np.float32(unpack('<f',header[100:104])[0]) )
-            self.header['cloudBaseHeight']   = np.append(self.header['cloudBaseHeight']  , np.float32(unpack('<f',header[104:108])[0]) )
-            self.header['aToDdataBadFlag']   = np.append(self.header['aToDdataBadFlag']  , np.byte(   unpack('<b',header[108:109])[0]) )
-            self.header['dataFileVersion']   = np.append(self.header['dataFileVersion']  , np.byte(   unpack('<b',header[109:110])[0]) )
-            self.header['backgrdAverage2']   = np.append(self.header['backgrdAverage2']  , np.float32(unpack('<f',header[110:114])[0]) )
-            self.header['backgrdStdDev2']    = np.append(self.header['backgrdStdDev2']   , np.float32(unpack('<f',header[114:118])[0]) )
-            self.header['mcsMode']           = np.append(self.header['mcsMode']          , np.byte(   unpack('<b',header[118:119])[0]) )
-            self.header['firstDataBin']      = np.append(self.header['firstDataBin']     , np.uint16( unpack('<H',header[119:121])[0]) )
-            self.header['systemType']        = np.append(self.header['systemType']       , np.byte(   unpack('<b',header[121:122])[0]) )
-            self.header['syncPulsePerSec']   = np.append(self.header['syncPulsePerSec']  , np.uint16( unpack('<H',header[122:124])[0]) )
-            self.header['firstBackgrdBin']   = np.append(self.header['firstBackgrdBin']  , np.uint16( unpack('<H',header[124:126])[0]) )
-            self.header['secondaryHdrSize']  = np.append(self.header['secondaryHdrSize'] , np.uint16( unpack('<H',header[126:128])[0]) )
-            
-            # Skips the bytes at the end of the header; extra space for secondary header.
-            # This is only true for MPL 108 (ARM MPL for N-ICE 2015), not MPL 107, which
-            #     is being used at Summit Station as part of the ICECAPS experiment.
-            if self.header['unitNumber'][rec]==108:
-                self.fp.read(self.header['secondaryHdrSize'][rec]-128)
-            
-            # Read and store the data records.
-            self.dataCh1[rec,:] = np.fromstring(self.fp.read(4*self.numberBins), dtype='<f4')
-            self.dataCh2[rec,:] = np.fromstring(self.fp.read(4*self.numberBins), dtype='<f4')
-            
+        # Every record has the same size, so the whole file is viewed as an array of records.
+        records = np.frombuffer(self.buffer, dtype=self._recordDtype(), count=self.numberRecords)
+        
+        header = records['header']
+        time = ((header['year'] - 1970).astype('datetime64[Y]') + (header['month'] - 1).astype('timedelta64[M]')).astype('datetime64[D]') \
+               + (header['day'] - 1).astype('timedelta64[D]') \
+               + header['hours'].astype('timedelta64[h]') \
+               + header['minutes'].astype('timedelta64[m]') \
+               + header['seconds'].astype('timedelta64[s]')
+        for key, _, dtype in HEADER_FIELDS:
+            if key[:4] == 'temp':
+                if key in TEMPERATURE_FIELDS:
+                    self.header[TEMPERATURE_FIELDS[key]] = header[key] / 100.
+            elif key == 'energyMonitor':
+                self.header[key] = header[key] / 1000.
+            else:
+                self.header[key] = header[key].astype(dtype[-2:])
+            if key == 'seconds':
+                self.header['Time'] = time.astype('datetime64[s]').astype(object)
+        
+        # The data records, copied to float64.
+        self.dataCh1 = records['channel_1'].astype(np.float64)
+        self.dataCh2 = records['channel_2'].astype(np.float64) if 'channel_2' in records.dtype.names else np.zeros_like(self.dataCh1)
         
         # Calculates the height and time vectors.
         rng         = 0.5 * SOL * self.header['binTime'][0] * 0.001	# Range gate altitude in km
-        self.height = (range(self.header['numberBins'][0]) - self.header['firstDataBin'][0]) * rng
+        self.height = (np.arange(self.header['numberBins'][0]) - self.header['firstDataBin'][0]) * rng
         self.time   = self.header['Time']
-        self.hours  = np.array([])
-        for t in self.time:
-            self.hours = np.append(self.hours, (t - datetime(self.header['year'][0],self.header['month'][0],self.header['day'][0])).total_seconds()/(3600.))
-            
-        self.fp.close()
+        self.hours  = (time - time[0].astype('datetime64[D]')) / np.timedelta64(3600, 's')
         
         return
+
+    def _headerDtype(self):
+        """Structured dtype of the 128-byte record header."""
+        return np.dtype({'names': [f[0] for f in HEADER_FIELDS],
+                         'formats': [f[2] for f in HEADER_FIELDS],
+                         'offsets': [f[1] for f in HEADER_FIELDS],
+                         'itemsize': 128})
+
+    def _recordDtype(self):
+        """Structured dtype of a full record: the header, followed by a float32 block per channel."""
+        # Skips the bytes at the end of the header; extra space for secondary header.
+        # This is only true for MPL 108 (ARM MPL for N-ICE 2015), not MPL 107, which
+        #     is being used at Summit Station as part of the ICECAPS experiment.
+        dataStart = self.headerSize if self.unitNumber==108 else 128
+        names   = ['header']
+        formats = [self._headerDtype()]
+        offsets = [0]
+        for ch in range(int(self.numberChannels)):
+            names.append(f'channel_{ch+1}')
+            formats.append(('<f4', (int(self.numberBins),)))
+            offsets.append(dataStart + ch*int(self.numberBins)*4)
+        return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': dataStart + int(self.numberChannels)*int(self.numberBins)*4})
+    
     
     def to_xarray(self):
         # dictionary of variables to rename from the MPL.header format to one compatible with mplgz2ingested.steps.raw_to_ingested
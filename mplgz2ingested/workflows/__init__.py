@@ -1 +1,3 @@
-from .calibrate_day import calibrate_day
\ No newline at end of file
+from .calibrate_day import calibrate_day
+from .calibrate_days import calibrate_days, calibrate_dates, calibrate_month
+from .schedule import find_pending_days, pack_days, schedule_catchup, run_task, collect_reports, SlurmExecutor, LocalExecutor
@@ -5,12 +5,17 @@ Function to load MPL data for a given date, ingest and calibrate that data.
 '''
 
 import datetime
+import json
+import netCDF4
+import numpy as np
 import xarray as xr
 import os
 
 from mplgz2ingested import steps
+from mplgz2ingested.steps.load_raw import read_mpl, merge_profiles, mpl_dict_to_xarray, read_first_time
+from mplgz2ingested.steps.write_netcdf import SOURCES_ATTR
 
-def calibrate_day(date, dir_target, dir_mpl, overwrite=False, fname_afterpulse=None, fname_overlap=None, fname_save_fmt = 'mpl_calibrated_{:04}{:02}{:02}.nc', afterpulse=None, overlap=None, sources=None):
+def calibrate_day(date, dir_target, dir_mpl, overwrite=False, fname_afterpulse=None, fname_overlap=None, fname_save_fmt = 'mpl_calibrated_{:04}{:02}{:02}.nc', afterpulse=None, overlap=None, sources=None, stream=False, context=None, precision='float64', threads=None, fname_deadtime=None, deadtime=None, encoding='archive', zarr_store=None, zarr_first_day=None, incremental=False, duplicates='hourly', zarr_profile_interval=steps.zarr_archive.PROFILE_INTERVAL):
     '''Function to load .mpl.gz files for a given day, and ingest and calibrate the data.
 
     The afterpulse and overlap data used in the calibration will take on the defauilt values given in the package.
@@ -46,22 +51,58 @@ def calibrate_day(date, dir_target, dir_mpl, overwrite=False, fname_afterpulse=N
         sources : None, dict
             sources for the provided afterpulse and overlap data.
 
+        stream : boolean ; default=False
+            If True, the files are processed one at a time by iter_calibrated_hours and appended to the output file, so that only around an hour of data is held in memory. The output is the same as for the full-day path. 
+
+        context : None, steps.CalibrationContext ; default=None
+            Pre-built calibration context, passed to steps.calibrate_ingested. If None, calibrate_ingested looks up the context for the height grid, afterpulse and overlap, so it is only built once for a run of days.
+
+        precision : string ; default='float64'
+            The floating point type of the calibrated variables, 'float64' or 'float32'. See steps.calibrate_ingested for the error bound of 'float32'.
+
+        threads : None, int ; default=None
+            The number of threads used by steps.calibrate_ingested.
+
+        fname_deadtime : None, string ; default=None
+            If given, the deadtime correction is loaded from this file with steps.load_deadtime. Otherwise no deadtime correction is applied.
+
+        deadtime : None, steps.DeadtimeLUT ; default=None
+            If given, overrides fname_deadtime, so that the deadtime correction can be pre-loaded.
+
+        encoding : None, string ; default='archive'
+            The encoding profile the output file is written with (see steps.output_encoding), 'archive', 'fast-read' or 'minimal'. If None, the file is written uncompressed, with the calibrated variables in the dtype given by precision.
+
+        zarr_store : None, string ; default=None
+            If given, the day is written into the slot for it in this Zarr store (see steps.ZarrArchive), rather than to a netcdf file in dir_target. The store is created with the given encoding profile if it doesn't exist, so encoding can't be None.
+
+        zarr_first_day : None, datetime.date ; default=None
+            The first day of the Zarr store, used if the store is created. Days before it can't be written to the store. If None, date is used.
+
+        zarr_profile_interval : float ; default=steps.zarr_archive.PROFILE_INTERVAL
+            The time between the profiles of the raw data [s], which sets the size of the day slots of the Zarr store if it is created (see steps.day_slot_size).
+
+        incremental : boolean ; default=False
+            If True and the netcdf file for the day exists, only the profiles added to the raw files since it was written (new files, and the growth of the files that were still being written) are loaded and calibrated, and are appended to it (see update_day). If that isn't possible, the whole day is processed again. Netcdf files record the raw files they were made from in their source_files attribute, and files written with an encoding profile have an unlimited time dimension, so that they can be appended to. Not used with zarr_store, where the day's slot is rewritten.
+
+        duplicates : string ; default='hourly'
+            The policy for profiles with the same time in more than one file, see steps.load_raw.merge_profiles. Used by both the full-day and the streaming paths.
+
     
     OUTPUTS:
         ds : xarray.Dataset
             Dataset object containing the ingested and calibrated data for the given date.
     '''
     save_fname = fname_save_fmt.format(date.year, date.month, date.day)
-    if not overwrite:
+    if zarr_store is not None:
+        archive = steps.ZarrArchive(zarr_store, encoding=encoding, first_day=date if zarr_first_day is None else zarr_first_day, profile_interval=zarr_profile_interval)
+        if not overwrite and archive.has_day(date):
+            print(f'{date} already exists in {zarr_store}.')
+            return
+    elif not overwrite and not incremental:
         if os.path.isfile(os.path.join(dir_target,save_fname)):
             print(f'{save_fname} already exists in directory {dir_target}.')
             return
 
-    ds = steps.load_fromdate(date, dir_mpl)
-
-    # apply the raw_to_ingested algorithm on the already-loaded ds
-    ds = steps.raw_to_ingested(data_loaded=ds)
-
     # load the afterpulse and overlap data
     if sources is None:
         sources = {}
@@ -71,15 +112,237 @@ def calibrate_day(date, dir_target, dir_mpl, overwrite=False, fname_afterpulse=N
     if overlap is None:
         overlap,so = steps.load_overlap(fname_overlap)
         sources['overlap'] = so
+    if deadtime is None and fname_deadtime is not None:
+        deadtime,sd = steps.load_deadtime(fname_deadtime)
+        sources['deadtime'] = sd
+
+    if incremental and zarr_store is None and os.path.isfile(os.path.join(dir_target, save_fname)):
+        if update_day(date, os.path.join(dir_target, save_fname), dir_mpl, afterpulse=afterpulse, overlap=overlap, sources=sources, context=context, precision=precision, threads=threads, deadtime=deadtime, duplicates=duplicates):
+            return
+        print(f'{save_fname} will be processed again for the full day.')
+
+    fnames = steps.select_fromdate(date, dir_mpl)
+    source_files = steps.describe_sources(fnames, dir_mpl)
+    if stream:
+        # write to a temporary file, so that an interrupted run doesn't leave a partial day in place. The blocks are written straight into the slot of a Zarr store
+        if zarr_store is None:
+            fname_part = os.path.join(dir_target, save_fname + '.part')
+        n_written = 0
+        for ds in iter_calibrated_hours(fnames, dir_mpl, afterpulse=afterpulse, overlap=overlap, sources=sources, context=context, precision=precision, threads=threads, deadtime=deadtime, duplicates=duplicates):
+            if zarr_store is not None:
+                archive.write_day(ds, date, start=n_written, pad=False)
+            elif n_written == 0:
+                ds.attrs[SOURCES_ATTR] = source_files
+                steps.write_netcdf(ds, fname_part, encoding=encoding)
+            else:
+                steps.append_netcdf(ds, fname_part)
+            n_written += ds.time.size
+        if n_written > 0:
+            if zarr_store is not None: # clear the rest of the day's slot
+                archive.write_day(ds.isel(time=slice(0,0)), date, start=n_written)
+            else:
+                os.replace(fname_part, os.path.join(dir_target, save_fname))
+        return
+
+    # only the variables and range bins used by raw_to_ingested are loaded
+    ds = steps.load_fromlist(fnames, dir_mpl, duplicates=duplicates, **steps.ingest_projection())
+
+    # apply the raw_to_ingested algorithm on the already-loaded ds
+    ds = steps.raw_to_ingested(data_loaded=ds)
 
     # add calibrated variables to the ingested format
-    ds = steps.calibrate_ingested(ds, afterpulse=afterpulse, overlap=overlap, sources=sources)
+    ds = steps.calibrate_ingested(ds, afterpulse=afterpulse, overlap=overlap, deadtime=deadtime, sources=sources, context=context, precision=precision, threads=threads)
+
+    if zarr_store is not None:
+        archive.write_day(ds, date)
+        return
 
-    # now save the dataset as a netcdf file
-    ds.to_netcdf(os.path.join(dir_target, save_fname))
+    # now save the dataset as a netcdf file. With an encoding profile, time is made unlimited so that profiles can be appended by update_day
+    ds.attrs[SOURCES_ATTR] = source_files
+    if encoding is None:
+        ds.to_netcdf(os.path.join(dir_target, save_fname))
+    else:
+        steps.write_netcdf(ds, os.path.join(dir_target, save_fname), encoding=encoding)
     return
 
 
+def update_day(date, fname, dir_mpl, afterpulse=None, overlap=None, sources=None, context=None, precision='float64', threads=None, deadtime=None, duplicates='hourly'):
+    '''Function to bring the netcdf file for a day up to date with the raw files, by loading and calibrating only the profiles added since it was written, and appending them.
+
+    The file's source_files attribute (see steps.describe_sources) lists the raw files it was made from, with their sizes and modification times. The profiles added since are those of the raw files that are new, and those after the file's last profile in the raw files that have grown (e.g. the hourly file that was still being written). The new profiles are ingested with the file's base_time, so time_offset and hour are consistent with the existing profiles, and source_files is updated; the other attributes are kept. As each profile is calibrated independently, the result is the same as processing the whole day again. Raw files without any profiles (e.g. a freshly created hourly file) are recorded in source_files, but nothing is appended for them.
+
+    The file can't be updated, and False is returned without anything being written, if: it has no source_files attribute or no unlimited time dimension; a raw file it was made from has shrunk, been removed, is no longer selected by steps.select_fromdate, or has been rewritten (modified without growing, or with profiles before the file's last profile that aren't in the file); a new raw file has profiles that aren't all later than the file's last profile; or the afterpulse, overlap or other calibration inputs differ from those stored in it.
+
+    INPUTS:
+        date : datetime.date, datetime.datetime
+            The day of the file.
+
+        fname : string
+            Full filename of the netcdf file for the day, written by calibrate_day.
+
+        dir_mpl : string
+            Path name of the directory containing the .mpl.gz files.
+
+        afterpulse, overlap, sources, context, precision, threads, deadtime, duplicates :
+            The calibration inputs and duplicates policy, as for calibrate_day. They must be the same as were used for the existing profiles.
+
+    OUTPUTS:
+        updated : boolean
+            True if the file is up to date with the raw files, False if the whole day needs to be processed again.
+    '''
+    fnames = steps.select_fromdate(date, dir_mpl)
+    source_files = steps.describe_sources(fnames, dir_mpl)
+    current = json.loads(source_files)
+    recorded = steps.read_sources(fname)
+    if recorded is None:
+        print(f'update_day: {fname} has no record of the raw files it was made from.')
+        return False
+    if recorded == current:
+        print(f'update_day: {fname} is up to date.')
+        return True
+    # a file that has grown is still being written, any other change means the existing profiles may be out of date
+    changed = sorted(name for name in recorded if name not in current or (recorded[name] != current[name] and current[name][0] <= recorded[name][0]))
+    if changed:
+        print(f'update_day: the raw files {changed} have been modified, removed or deselected since {fname} was written.')
+        return False
+    grown = [fn for fn in fnames if fn in recorded and recorded[fn] != current[fn]]
+    new_fnames = [fn for fn in fnames if fn not in recorded]
+
+    with netCDF4.Dataset(fname) as f:
+        if not f.dimensions['time'].isunlimited():
+            print(f'update_day: {fname} does not have an unlimited time dimension.')
+            return False
+
+    with xr.open_dataset(fname) as existing:
+        base_time = existing['base_time'].values
+        times = existing['time'].values
+        last_time = times[-1]
+
+        first_times = {fn: read_first_time(os.path.join(dir_mpl, fn)) for fn in grown + new_fnames}
+        if any(first_times[fn] <= last_time for fn in new_fnames):
+            print(f'update_day: the profiles of {new_fnames} are not all after the last profile in {fname}.')
+            return False
+        # raw files without profiles have nothing to append
+        load_fnames = sorted(fn for fn in first_times if not np.isnat(first_times[fn]))
+        ds = None
+        if load_fnames:
+            ds = steps.load_fromlist(load_fnames, dir_mpl, duplicates=duplicates, **steps.ingest_projection())
+            # the profiles of a grown file up to the last profile are already in the file, unless the raw file has been rewritten
+            earlier = ds.time.values <= last_time
+            if not np.all(np.isin(ds.time.values[earlier], times)):
+                print(f'update_day: the raw files {grown} have been rewritten since {fname} was written.')
+                return False
+            ds = ds.isel(profile=np.flatnonzero(~earlier))
+            if ds.sizes['profile'] == 0:
+                ds = None
+    if ds is None:
+        with netCDF4.Dataset(fname, 'a') as f:
+            f.setncatts({SOURCES_ATTR: source_files})
+        print(f'update_day: no new profiles in {load_fnames}, {fname} is up to date.')
+        return True
+
+    with xr.open_dataset(fname) as existing:
+        ds = steps.raw_to_ingested(data_loaded=ds, base_time=base_time)
+        ds = steps.calibrate_ingested(ds, afterpulse=afterpulse, overlap=overlap, deadtime=deadtime, sources=sources, context=context, precision=precision, threads=threads)
+
+        # the variables without the time dimension (e.g. the afterpulse and overlap profiles) must match the existing ones, otherwise the profiles would be calibrated differently
+        for k in ds.data_vars:
+            if 'time' in ds[k].dims:
+                continue
+            if k not in existing or not np.array_equal(ds[k].values, existing[k].values, equal_nan=True):
+                print(f'update_day: {k} is different to the {k} in {fname}.')
+                return False
+
+    steps.append_netcdf(ds, fname, attrs={SOURCES_ATTR: source_files})
+    print(f'update_day: {ds.time.size} profiles from {load_fnames} appended to {fname}.')
+    return True
+
+
+def iter_calibrated_hours(fnames, dir_mpl, afterpulse=None, overlap=None, sources=None, context=None, precision='float64', threads=None, deadtime=None, duplicates='hourly'):
+    '''Generator that loads, ingests and calibrates a day of .mpl.gz files one file at a time.
+
+    The profiles from each file are merged with any profiles carried over from the previous files by steps.load_raw.merge_profiles, with the same duplicates policy and file priorities as the full-day load (the carried profiles keep the file they came from). Only the profiles earlier than the first profile of every remaining file are yielded; the rest are carried over. As each file is time-ordered, the yielded profiles are in time order, and no later file can contain their times, so every duplicate of a profile is merged before it is yielded. base_time is fixed to the first profile of the day, so that time_offset and hour match the full-day ingest.
+
+    INPUTS:
+        fnames : list [string]
+            The filenames for the day, as given by steps.select_fromdate.
+
+        dir_mpl : string
+            Path name of the directory containing the .mpl.gz files.
+
+        afterpulse : None, xarray.Dataset
+            The afterpulse profile passed to steps.calibrate_ingested.
+
+        overlap : None, xr.DataArray, 2xk np.ndarray
+            The overlap function passed to steps.calibrate_ingested.
+
+        sources : None, dict
+            sources for the provided afterpulse and overlap data.
+
+        context : None, steps.CalibrationContext ; default=None
+            Pre-built calibration context passed to steps.calibrate_ingested.
+
+        precision : string ; default='float64'
+            The floating point type of the calibrated variables, passed to steps.calibrate_ingested.
+
+        threads : None, int ; default=None
+            The number of threads used by steps.calibrate_ingested.
+
+        deadtime : None, steps.DeadtimeLUT ; default=None
+            The deadtime correction passed to steps.calibrate_ingested.
+
+        duplicates : string ; default='hourly'
+            The policy for profiles with the same time in more than one file, see steps.load_raw.merge_profiles.
+
+    OUTPUTS:
+        ds : xarray.Dataset
+            Ingested and calibrated dataset for consecutive, non-overlapping blocks of profiles.
+    '''
+    paths = [os.path.join(dir_mpl, fname) for fname in fnames]
+    first_times = np.array([read_first_time(path) for path in paths], dtype='datetime64[ns]')
+    if sources is None:
+        sources = {}
+
+    projection = steps.ingest_projection()
+    base_time = None
+    carry = None
+    for i, path in enumerate(paths):
+        mpl = read_mpl(path, bins=projection['bins'])
+        mpl = {k: v for k, v in mpl.items() if k in projection['fields'] or k == 'time'}
+        mpl[_FILE_INDEX] = np.full(mpl['time'].size, i)
+        mpl = _concat_profiles([mpl] if carry is None else [carry, mpl])
+
+        # the profiles of each file, carried or new, as contiguous time-ordered runs in file order, as merge_profiles expects
+        runs = np.argsort(mpl[_FILE_INDEX], kind='stable')
+        mpl = {k: v[runs] if isinstance(v, np.ndarray) and v.ndim > 0 else v for k, v in mpl.items()}
+        files, counts = np.unique(mpl[_FILE_INDEX], return_counts=True)
+        mpl = merge_profiles(mpl, counts, [paths[f] for f in files], policy=duplicates)
+
+        times = mpl['time'].astype('datetime64[s]').astype('datetime64[ns]')
+        if i+1 < len(paths):
+            n_emit = np.searchsorted(times, first_times[i+1:].min(), side='left')
+        else:
+            n_emit = times.size
+        carry = {k: v[n_emit:] if isinstance(v, np.ndarray) and v.ndim > 0 else v for k, v in mpl.items()}
+        if n_emit == 0:
+            continue
+
+        ds = mpl_dict_to_xarray({k: v[:n_emit] if isinstance(v, np.ndarray) and v.ndim > 0 else v for k, v in mpl.items() if k != _FILE_INDEX})
+        if base_time is None:
+            base_time = ds.time.values[0]
+        ds = steps.raw_to_ingested(data_loaded=ds, base_time=base_time)
+        ds = steps.calibrate_ingested(ds, afterpulse=afterpulse, overlap=overlap, deadtime=deadtime, sources=sources, context=context, precision=precision, threads=threads)
+        yield ds
+
+
+# the key of the file index of each profile, used by iter_calibrated_hours to keep track of the files of the carried profiles
+_FILE_INDEX = '_file_index'
+
+
+def _concat_profiles(mpls):
+    # concatenate mpl dictionaries along the profiles into new (writeable) arrays, as merge_profiles reorders them in place
+    return {k: np.concatenate([m[k] for m in mpls]) if isinstance(v, np.ndarray) and v.ndim > 0 else v for k, v in mpls[0].items()}
+
 
 if __name__=='__main__':
     import argparse
@@ -93,11 +356,23 @@ if __name__=='__main__':
 
     parser.add_argument('-A', '--afterpulse', help='Optional, Full filename for the afterpulse file.')
     parser.add_argument('-O', '--overlap', help='Optional, Full filename for the overlap function file.')
+    parser.add_argument('-D', '--deadtime', help='Optional, Full filename for the deadtime correction file (.csv or the binary polynomial coefficients).')
+    parser.add_argument('-s', '--stream', action='store_true', help='Optional, process the files one at a time to limit memory use.')
+    parser.add_argument('-w', '--workers', type=int, help='Optional, the number of processes the days of a month are shared between. Defaults to the number of CPUs available.')
+    parser.add_argument('-j', '--threads', type=int, help='Optional, the number of threads used to calibrate the data.')
+    parser.add_argument('-p', '--precision', default='float64', choices=['float64', 'float32'], help='Optional, the floating point type of the calibrated variables. Defaults to float64.')
+    parser.add_argument('-i', '--incremental', action='store_true', help='Optional, only process the raw files added since an existing ingested file was written, appending them to it.')
+    parser.add_argument('-z', '--zarr', help='Optional, the path of a Zarr store to write the days into, instead of netcdf files in targetdir.')
+    parser.add_argument('--zarr-first-day', type=datetime.date.fromisoformat, help='Optional, the first day of the Zarr store if it is created, as YYYY-MM-DD. Days before it cannot be written to the store. Defaults to the first day being converted.')
+    parser.add_argument('--zarr-profile-interval', type=float, default=steps.zarr_archive.PROFILE_INTERVAL, help='Optional, the time between the profiles of the raw data in seconds, which sets the size of the day slots of the Zarr store if it is created. Defaults to 5.')
+    parser.add_argument('-e', '--encoding', default='archive', choices=['archive', 'fast-read', 'minimal', 'none'], help='Optional, the encoding profile of the output files. Defaults to archive.')
 
     # an optional argument, if day is passed in then we just do a single day
     parser.add_argument('--day', type=int, help='Optional, specifies a particular day for which the ingestion should be done.')
 
     args = parser.parse_args()
+    if args.zarr is not None and args.encoding == 'none':
+        parser.error('--encoding none can only be used for netcdf files, not with --zarr')
 
     year = args.year
     month = args.month
@@ -109,19 +384,25 @@ if __name__=='__main__':
     fname_overlap = args.overlap
 
     day = args.day
+    stream = args.stream
+    precision = args.precision
+    threads = args.threads
+    encoding = None if args.encoding == 'none' else args.encoding
 
     # pre-load afterpulse and overlap data
     afterpulse, sa = steps.load_afterpulse(fname_afterpulse)
     overlap, so = steps.load_overlap(fname_overlap)
+    deadtime, sd = steps.load_deadtime(args.deadtime)
     sources = {'afterpulse': sa, 'overlap': so}
+    if deadtime is not None:
+        sources['deadtime'] = sd
 
     if day is not None:
         date0 = datetime.date(year=year, month=month, day=day)
-        calibrate_day(date=date0, dir_target=dir_target, dir_mpl=dir_mpl, overwrite=overwrite, afterpulse=afterpulse, overlap=overlap, sources=sources)
+        calibrate_day(date=date0, dir_target=dir_target, dir_mpl=dir_mpl, overwrite=overwrite, afterpulse=afterpulse, overlap=overlap, sources=sources, stream=stream, precision=precision, threads=threads, deadtime=deadtime, encoding=encoding, zarr_store=args.zarr, zarr_first_day=args.zarr_first_day, zarr_profile_interval=args.zarr_profile_interval, incremental=args.incremental)
     else:
-        for day in range(32): # no month has more than 31 days
-            try:
-                date0 = datetime.date(year=year, month=month, day=day)
-                calibrate_day(date=date0, dir_target=dir_target, dir_mpl=dir_mpl, overwrite=overwrite, afterpulse=afterpulse, overlap=overlap, sources=sources)
-            except:
-                break
+        # every day of the month, in parallel, reporting the days that fail rather than stopping at them
+        from mplgz2ingested.workflows.calibrate_days import calibrate_month
+        report = calibrate_month(year, month, dir_target, dir_mpl, workers=args.workers, afterpulse=afterpulse, overlap=overlap, deadtime=deadtime, sources=sources, overwrite=overwrite, stream=stream, precision=precision, threads=threads, encoding=encoding, zarr_store=args.zarr, zarr_first_day=args.zarr_first_day, zarr_profile_interval=args.zarr_profile_interval, incremental=args.incremental)
+        if any(result.status == 'failed' for result in report):
+            raise SystemExit(1)
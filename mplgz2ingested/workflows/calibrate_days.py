@@ -0,0 +1,215 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Batch driver to load, ingest and calibrate a range or list of days in parallel, with the afterpulse, overlap and deadtime data loaded once and shared with the worker processes.
+'''
+
+import calendar
+import collections
+import datetime
+import glob
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from mplgz2ingested import steps
+from mplgz2ingested.workflows.calibrate_day import calibrate_day
+
+# the outcome of calibrating a single day
+DayResult = collections.namedtuple('DayResult', ['date', 'status', 'seconds', 'error'])
+
+# the calibration data and arguments used by the worker processes, set by calibrate_dates before they are forked so that they are inherited rather than pickled
+_SHARED_CALIBRATION = None
+
+def calibrate_days(start, end, dir_target, dir_mpl, **kwargs):
+    '''Function to load, ingest and calibrate every day in a date range, with calibrate_dates.
+
+    INPUTS:
+        start : datetime.date
+            The first day to be calibrated.
+
+        end : datetime.date
+            The last day to be calibrated (inclusive).
+
+        dir_target, dir_mpl, **kwargs :
+            As for calibrate_dates.
+
+    OUTPUTS:
+        report : list [DayResult]
+            As for calibrate_dates.
+    '''
+    dates = [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+    return calibrate_dates(dates, dir_target, dir_mpl, **kwargs)
+
+
+def calibrate_dates(dates, dir_target, dir_mpl, workers=None, fname_afterpulse=None, fname_overlap=None, fname_deadtime=None, afterpulse=None, overlap=None, deadtime=None, sources=None, **kwargs):
+    '''Function to load, ingest and calibrate a list of days, sharing the days between worker processes.
+
+    The afterpulse, overlap and deadtime data are loaded once, before the workers are forked, so each worker reads them from the memory of the parent process (copy-on-write) rather than loading or unpickling its own copy. Each worker builds the calibration context once and reuses it for all of its days (see steps.calibration_context). The days are submitted largest first (by the total size of their raw files), so that the longest days don't start last and leave the other workers idle at the end. Days without raw files are skipped.
+
+    A day that fails doesn't stop the others: the error is printed and returned in the report. If a worker process dies (e.g. killed for running out of memory), its days are reported as failed.
+
+    INPUTS:
+        dates : list [datetime.date]
+            The days to be calibrated.
+
+        dir_target : string
+            Path name for directory to save the datasets to.
+
+        dir_mpl : string
+            Path name of the directory containing the .mpl.gz files.
+
+        workers : None, int ; default=None
+            The number of worker processes. If None, the number of CPUs available to this process is used. If 1, the days are calibrated one after another in this process.
+
+        fname_afterpulse, fname_overlap, fname_deadtime : None, string ; default=None
+            The files to load the afterpulse, overlap and deadtime data from, as for calibrate_day. Not used if the data are given.
+
+        afterpulse, overlap, deadtime : default=None
+            Pre-loaded afterpulse, overlap and deadtime data, as for calibrate_day.
+
+        sources : None, dict ; default=None
+            Sources for the provided afterpulse, overlap and deadtime data.
+
+        **kwargs :
+            Further arguments passed to calibrate_day for every day, e.g. overwrite, stream, precision, threads, encoding, zarr_store or incremental. If a zarr_store is given without zarr_first_day, the earliest of dates is used as the first day of the store, as the days aren't written in date order.
+
+    OUTPUTS:
+        report : list [DayResult]
+            For each day in date order, its date, status ('done', 'failed' or 'no data'), the time taken in seconds, and the error message of a failed day (None otherwise).
+    '''
+    global _SHARED_CALIBRATION
+    sources = {} if sources is None else dict(sources)
+    if afterpulse is None:
+        afterpulse, sources['afterpulse'] = steps.load_afterpulse(fname_afterpulse)
+    if overlap is None:
+        overlap, sources['overlap'] = steps.load_overlap(fname_overlap)
+    if deadtime is None and fname_deadtime is not None:
+        deadtime, sources['deadtime'] = steps.load_deadtime(fname_deadtime)
+
+    dates = sorted(set(dates))
+    if kwargs.get('zarr_store') is not None and kwargs.get('zarr_first_day') is None and dates:
+        kwargs['zarr_first_day'] = dates[0]
+    sizes = {date: raw_size(date, dir_mpl) for date in dates}
+    results = {date: DayResult(date, 'no data', 0., None) for date in dates if sizes[date] == 0}
+    todo = sorted([date for date in dates if sizes[date] > 0], key=lambda date: sizes[date], reverse=True)
+    print(f'calibrate_days: {len(todo)} of {len(dates)} days have raw files.')
+
+    if workers is None:
+        workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    workers = max(1, min(workers, len(todo)))
+
+    _SHARED_CALIBRATION = {'dir_target': dir_target, 'dir_mpl': dir_mpl, 'afterpulse': afterpulse, 'overlap': overlap, 'deadtime': deadtime, 'sources': sources, 'kwargs': kwargs}
+    try:
+        if workers == 1:
+            for date in todo:
+                results[date] = _report(_calibrate_shared(date))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                futures = {executor.submit(_calibrate_shared, date): date for date in todo}
+                for future in as_completed(futures):
+                    date = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as err: # the worker process died
+                        result = DayResult(date, 'failed', float('nan'), repr(err))
+                    results[date] = _report(result)
+    finally:
+        _SHARED_CALIBRATION = None
+
+    report = [results[date] for date in dates]
+    n_failed = sum(result.status == 'failed' for result in report)
+    print(f'calibrate_days: {len(todo) - n_failed} days done, {n_failed} failed, {len(dates) - len(todo)} without raw files.')
+    return report
+
+
+def calibrate_month(year, month, dir_target, dir_mpl, **kwargs):
+    '''Function to calibrate every day of a month with calibrate_days.
+
+    INPUTS:
+        year : int
+            The year of the month.
+
+        month : int
+            The month, as an integer.
+
+        dir_target, dir_mpl, **kwargs :
+            As for calibrate_days.
+
+    OUTPUTS:
+        report : list [DayResult]
+            As for calibrate_days.
+    '''
+    n_days = calendar.monthrange(year, month)[1]
+    return calibrate_days(datetime.date(year, month, 1), datetime.date(year, month, n_days), dir_target, dir_mpl, **kwargs)
+
+
+def raw_size(date, dir_mpl):
+    '''Function to get the total size of the raw files for a day, in bytes. 0 if there are none.'''
+    fnames = glob.glob(f'{date.year:04}{date.month:02}{date.day:02}*.mpl*', root_dir=dir_mpl)
+    return sum(os.path.getsize(os.path.join(dir_mpl, fname)) for fname in fnames)
+
+
+def _calibrate_shared(date):
+    # calibrate a single day using the shared calibration data, catching any error so that the other days continue
+    shared = _SHARED_CALIBRATION
+    t0 = time.perf_counter()
+    try:
+        calibrate_day(date, shared['dir_target'], shared['dir_mpl'], afterpulse=shared['afterpulse'], overlap=shared['overlap'], deadtime=shared['deadtime'], sources=dict(shared['sources']), **shared['kwargs'])
+    except Exception as err:
+        traceback.print_exc()
+        return DayResult(date, 'failed', time.perf_counter() - t0, f'{type(err).__name__}: {err}')
+    return DayResult(date, 'done', time.perf_counter() - t0, None)
+
+
+def _report(result):
+    if result.status == 'failed':
+        print(f'calibrate_days: {result.date} FAILED after {result.seconds:.1f}s: {result.error}')
+    else:
+        print(f'calibrate_days: {result.date} done in {result.seconds:.1f}s')
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Script to convert archived .mpl.gz files to ingested .nc files for a range of dates, or a month, in parallel.')
+
+    parser.add_argument('--start', type=datetime.date.fromisoformat, help='The first date to convert, as YYYY-MM-DD.')
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help='Optional, the last date to convert (inclusive), as YYYY-MM-DD. Defaults to start.')
+    parser.add_argument('--zarr-profile-interval', type=float, default=steps.zarr_archive.PROFILE_INTERVAL, help='Optional, the time between the profiles of the raw data in seconds, which sets the size of the day slots of the Zarr store if it is created. Defaults to 5.')
+    parser.add_argument('-y', '--year', type=int, help='The year of the month to convert, instead of start and end.')
+    parser.add_argument('-m', '--month', type=int, help='The month to convert, instead of start and end.')
+    parser.add_argument('-t', '--targetdir', default='/gws/nopw/j04/ncas_radar_vol2/data/ICECAPSarchive/mpl/leeds_ingested', help='The directory that the ingested files will be saved to. Defaults to /gws/nopw/j04/ncas_radar_vol2/data/ICECAPSarchive/mpl/leeds_ingested')
+    parser.add_argument('-d', '--datadir', default='/gws/nopw/j04/ncas_radar_vol2/data/ICECAPSarchive/mpl/raw', help='The directory from which the raw .mpl.gz data will be extracted. Defaults to /gws/nopw/j04/ncas_radar_vol2/data/ICECAPSarchive/mpl/raw')
+    parser.add_argument('-w', '--workers', type=int, help='Optional, the number of worker processes. Defaults to the number of CPUs available.')
+    parser.add_argument('-o', '--overwrite', action='store_true', help='Optional, Overwrite existing ingested files at targetdir.')
+
+    parser.add_argument('-A', '--afterpulse', help='Optional, Full filename for the afterpulse file.')
+    parser.add_argument('-O', '--overlap', help='Optional, Full filename for the overlap function file.')
+    parser.add_argument('-D', '--deadtime', help='Optional, Full filename for the deadtime correction file (.csv or the binary polynomial coefficients).')
+    parser.add_argument('-s', '--stream', action='store_true', help='Optional, process the files one at a time to limit memory use.')
+    parser.add_argument('-p', '--precision', default='float64', choices=['float64', 'float32'], help='Optional, the floating point type of the calibrated variables. Defaults to float64.')
+    parser.add_argument('-i', '--incremental', action='store_true', help='Optional, only process the raw files added since an existing ingested file was written, appending them to it.')
+    parser.add_argument('-z', '--zarr', help='Optional, the path of a Zarr store to write the days into, instead of netcdf files in targetdir.')
+    parser.add_argument('--zarr-first-day', type=datetime.date.fromisoformat, help='Optional, the first day of the Zarr store if it is created, as YYYY-MM-DD. Days before it cannot be written to the store. Defaults to start.')
+    parser.add_argument('--zarr-profile-interval', type=float, default=steps.zarr_archive.PROFILE_INTERVAL, help='Optional, the time between the profiles of the raw data in seconds, which sets the size of the day slots of the Zarr store if it is created. Defaults to 5.')
+    parser.add_argument('-e', '--encoding', default='archive', choices=['archive', 'fast-read', 'minimal', 'none'], help='Optional, the encoding profile of the output files. Defaults to archive.')
+
+    args = parser.parse_args()
+    if args.zarr is not None and args.encoding == 'none':
+        parser.error('--encoding none can only be used for netcdf files, not with --zarr')
+
+    if args.year is not None and args.month is not None:
+        start = datetime.date(args.year, args.month, 1)
+        end = datetime.date(args.year, args.month, calendar.monthrange(args.year, args.month)[1])
+    elif args.start is not None:
+        start = args.start
+        end = start if args.end is None else args.end
+    else:
+        parser.error('either --start or both --year and --month are required')
+
+    report = calibrate_days(start, end, args.targetdir, args.datadir, workers=args.workers, fname_afterpulse=args.afterpulse, fname_overlap=args.overlap, fname_deadtime=args.deadtime, overwrite=args.overwrite, stream=args.stream, precision=args.precision, incremental=args.incremental, zarr_store=args.zarr, zarr_first_day=args.zarr_first_day, zarr_profile_interval=args.zarr_profile_interval, encoding=None if args.encoding == 'none' else args.encoding)
+    if any(result.status == 'failed' for result in report):
+        raise SystemExit(1)
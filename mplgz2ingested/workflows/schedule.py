@@ -0,0 +1,431 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Scheduler for catching up the calibrated archive: finds every day whose output is missing or older than its raw files, packs the days into tasks, and runs the tasks as a single SLURM job array, or in local processes with the same interface.
+'''
+
+import collections
+import datetime
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+# a day that needs to be (re)processed, with the total size of its raw files in bytes
+PendingDay = collections.namedtuple('PendingDay', ['date', 'reason', 'size'])
+
+# the module run by each task, see run_task
+TASK_MODULE = 'mplgz2ingested.workflows.schedule'
+
+def find_pending_days(dir_mpl, dir_target, fname_save_fmt='mpl_calibrated_{:04}{:02}{:02}.nc', start=None, end=None, index=None):
+    '''Function to compare the raw files with the calibrated outputs, to find every day that needs to be processed.
+
+    A day is pending if it has raw files and either its output doesn't exist ('missing'), or one of its raw files was modified after its output was written ('stale'), e.g. a day that was processed while its files were still arriving. Gaps anywhere in the archive are found, not just the days after the latest output.
+
+    INPUTS:
+        dir_mpl : string
+            The directory containing the .mpl.gz files.
+
+        dir_target : string
+            The directory containing the calibrated outputs.
+
+        fname_save_fmt : string ; default='mpl_calibrated_{:04}{:02}{:02}.nc'
+            The format of the output filenames, with the year, month and day imposed in order, as for calibrate_day.
+
+        start, end : None, datetime.date ; default=None
+            If given, only days in the range [start, end] are considered.
+
+        index : None, steps.ArchiveIndex ; default=None
+            If given, the raw files and their sizes and modification times are taken from the archive index of dir_mpl (which should be refreshed first), rather than by listing the directory.
+
+    OUTPUTS:
+        pending : list [PendingDay]
+            The pending days in date order, with the reason they are pending and the total size of their raw files.
+    '''
+    if index is not None:
+        files = [(row['name'], int(row['size']), int(row['mtime_ns'])) for row in index.table()]
+    else:
+        files = []
+        for entry in os.scandir(dir_mpl):
+            if '.mpl' in entry.name and entry.is_file():
+                st = entry.stat()
+                files.append((entry.name, st.st_size, st.st_mtime_ns))
+
+    # the total size and latest modification time of the raw files of each day
+    raw = {}
+    for name, size, mtime_ns in files:
+        try:
+            date = datetime.datetime.strptime(name[:8], '%Y%m%d').date()
+        except ValueError:
+            continue
+        if (start is not None and date < start) or (end is not None and date > end):
+            continue
+        total, latest = raw.get(date, (0, 0))
+        raw[date] = (total + size, max(latest, mtime_ns))
+
+    pending = []
+    for date in sorted(raw):
+        size, latest = raw[date]
+        try:
+            output_mtime = os.stat(os.path.join(dir_target, fname_save_fmt.format(date.year, date.month, date.day))).st_mtime_ns
+        except FileNotFoundError:
+            pending.append(PendingDay(date, 'missing', size))
+            continue
+        if latest > output_mtime:
+            pending.append(PendingDay(date, 'stale', size))
+    return pending
+
+
+def pack_days(pending, days_per_task):
+    '''Function to pack days into tasks of at most days_per_task days, balancing the total raw size of the tasks.
+
+    The fewest tasks are used, and the days are assigned largest first, each to the task with the smallest total size that still has room.
+
+    INPUTS:
+        pending : list [PendingDay]
+            The days to be packed, as given by find_pending_days.
+
+        days_per_task : int
+            The maximum number of days in a task.
+
+    OUTPUTS:
+        tasks : list [list [datetime.date]]
+            The days of each task, in date order.
+    '''
+    if days_per_task < 1:
+        err_msg = f'days_per_task must be at least 1, not {days_per_task}'
+        raise ValueError(err_msg)
+    n_tasks = -(-len(pending) // days_per_task)
+    tasks = [[] for _ in range(n_tasks)]
+    totals = [0]*n_tasks
+    for day in sorted(pending, key=lambda day: day.size, reverse=True):
+        i = min((i for i in range(n_tasks) if len(tasks[i]) < days_per_task), key=lambda i: totals[i])
+        tasks[i].append(day.date)
+        totals[i] += day.size
+    return [sorted(task) for task in tasks]
+
+
+def schedule_catchup(dir_mpl, dir_target, executor, work_dir, days_per_task=7, workers_per_task=1, fname_save_fmt='mpl_calibrated_{:04}{:02}{:02}.nc', start=None, end=None, index=None, **kwargs):
+    '''Function to find the pending days of the archive, pack them into tasks and submit the tasks with an executor.
+
+    The tasks are written to a manifest file in work_dir, which each task reads to find its days (see run_task). Each task writes a report of its days next to the manifest, which can be read with collect_reports.
+
+    INPUTS:
+        dir_mpl : string
+            The directory containing the .mpl.gz files.
+
+        dir_target : string
+            The directory the calibrated outputs are written to.
+
+        executor : SlurmExecutor, LocalExecutor
+            The executor the tasks are submitted with.
+
+        work_dir : string
+            The directory the manifest, reports and logs are written to, in a new subdirectory for each run. It is created if it doesn't exist.
+
+        days_per_task : int ; default=7
+            The maximum number of days in a task.
+
+        workers_per_task : int ; default=1
+            The number of processes each task shares its days between (see calibrate_days.calibrate_dates). Should match the CPUs given to each task.
+
+        fname_save_fmt : string ; default='mpl_calibrated_{:04}{:02}{:02}.nc'
+            The format of the output filenames, as for calibrate_day.
+
+        start, end, index :
+            As for find_pending_days.
+
+        **kwargs :
+            Further arguments passed to calibrate_day (or the task's calibrate function, see run_task) for every day. They must be JSON serialisable, so the afterpulse, overlap and deadtime are given as filenames (fname_afterpulse, fname_overlap, fname_deadtime). Pending days are always overwritten. A zarr_store isn't supported, as the pending days are found from the daily output files.
+
+    OUTPUTS:
+        job_id : None, string
+            The id of the submitted job, as given by the executor. None if there are no pending days.
+
+        manifest : None, string
+            Full filename of the manifest.
+    '''
+    if kwargs.get('zarr_store') is not None:
+        err_msg = 'schedule_catchup finds the pending days from the daily output files in dir_target, so it cannot be used with a zarr_store'
+        raise ValueError(err_msg)
+    pending = find_pending_days(dir_mpl, dir_target, fname_save_fmt=fname_save_fmt, start=start, end=end, index=index)
+    n_stale = sum(day.reason == 'stale' for day in pending)
+    print(f'schedule_catchup: {len(pending) - n_stale} missing and {n_stale} stale days in {dir_target}')
+    if len(pending) == 0:
+        return None, None
+
+    tasks = pack_days(pending, days_per_task)
+    os.makedirs(work_dir, exist_ok=True)
+    run_dir = tempfile.mkdtemp(prefix=time.strftime('%Y%m%dT%H%M%S_'), dir=os.path.abspath(work_dir)) # so the reports and logs of separate runs don't mix
+    manifest = os.path.join(run_dir, 'manifest.json')
+    contents = {
+        'dir_mpl': os.path.abspath(dir_mpl),
+        'dir_target': os.path.abspath(dir_target),
+        'workers_per_task': workers_per_task,
+        'kwargs': dict(kwargs, fname_save_fmt=fname_save_fmt, overwrite=True),
+        'tasks': [[date.isoformat() for date in task] for task in tasks],
+    }
+    with open(manifest, 'w') as f:
+        json.dump(contents, f, indent=1)
+
+    print(f'schedule_catchup: {len(pending)} days packed into {len(tasks)} tasks, see {manifest}')
+    job_id = executor.submit(manifest, len(tasks))
+    return job_id, manifest
+
+
+def run_task(manifest, task_id, calibrate=None):
+    '''Function to calibrate the days of a single task of a manifest written by schedule_catchup, and write the task's report.
+
+    INPUTS:
+        manifest : string
+            Full filename of the manifest.
+
+        task_id : int
+            The index of the task in the manifest (e.g. the SLURM array task id).
+
+        calibrate : None, function ; default=None
+            If given, the function used to calibrate each day, called as calibrate(date, dir_target, dir_mpl, **kwargs) with the kwargs of the manifest, in place of calibrate_days.calibrate_dates. The days are then calibrated one after another, and a day that raises an error is reported as failed without stopping the others.
+
+    OUTPUTS:
+        report : list [calibrate_days.DayResult]
+            The outcome of each day of the task, also written to task_<task_id>.json next to the manifest.
+    '''
+    from mplgz2ingested.workflows.calibrate_days import calibrate_dates
+
+    with open(manifest) as f:
+        contents = json.load(f)
+    dates = [datetime.date.fromisoformat(date) for date in contents['tasks'][task_id]]
+    if calibrate is None:
+        report = calibrate_dates(dates, contents['dir_target'], contents['dir_mpl'], workers=contents['workers_per_task'], **contents['kwargs'])
+    else:
+        report = [_calibrate_with(calibrate, date, contents) for date in dates]
+
+    with open(_report_path(manifest, task_id), 'w') as f:
+        json.dump([{'date': r.date.isoformat(), 'status': r.status, 'seconds': r.seconds, 'error': r.error} for r in report], f, indent=1)
+    return report
+
+
+def collect_reports(manifest):
+    '''Function to read the reports of the tasks of a manifest.
+
+    INPUTS:
+        manifest : string
+            Full filename of the manifest.
+
+    OUTPUTS:
+        reports : dict
+            For each task, the list of day reports (dictionaries with the keys date, status, seconds and error), or None if the task hasn't written its report (it is still running, or failed before finishing).
+    '''
+    with open(manifest) as f:
+        n_tasks = len(json.load(f)['tasks'])
+    reports = {}
+    for task_id in range(n_tasks):
+        try:
+            with open(_report_path(manifest, task_id)) as f:
+                reports[task_id] = json.load(f)
+        except FileNotFoundError:
+            reports[task_id] = None
+    return reports
+
+
+class SlurmExecutor:
+    '''Executor that submits the tasks of a manifest as a single SLURM job array, with sbatch.
+
+    Each array task runs the task command (see task_command) for the manifest and its SLURM_ARRAY_TASK_ID, and writes its stdout and stderr to task_<id>.out and task_<id>.err next to the manifest.
+
+    INPUTS:
+        partition : string
+            The SLURM partition (queue) to submit to.
+
+        time_limit : string
+            The time limit of each task, in hh:mm:ss format. Should allow for all of the days of a task.
+
+        mem : string
+            The memory of each task, e.g. '8G'.
+
+        cpus_per_task : int ; default=1
+            The number of CPUs of each task.
+
+        max_parallel : None, int ; default=None
+            If given, the most array tasks that run at once.
+
+        job_name : string ; default='mpl_calibrate'
+            The name of the job.
+
+        setup : None, string ; default=None
+            Shell commands run before each task, e.g. to activate the python environment.
+
+        dry_run : bool ; default=False
+            If True, the sbatch command is printed but not run.
+
+        command : None, list [string] ; default=None
+            The command run by each task, before the manifest and task id, as for task_command. If None, run_task is run by this module.
+    '''
+
+    def __init__(self, partition, time_limit, mem, cpus_per_task=1, max_parallel=None, job_name='mpl_calibrate', setup=None, dry_run=False, command=None):
+        self.partition = partition
+        self.time_limit = time_limit
+        self.mem = mem
+        self.cpus_per_task = cpus_per_task
+        self.max_parallel = max_parallel
+        self.job_name = job_name
+        self.setup = setup
+        self.dry_run = dry_run
+        self.task = command
+
+    def command(self, manifest, n_tasks):
+        '''Function to build the sbatch command for the tasks of a manifest, as a list of arguments.'''
+        log = os.path.join(os.path.dirname(manifest), 'task_%a')
+        array = f'0-{n_tasks-1}' if self.max_parallel is None else f'0-{n_tasks-1}%{self.max_parallel}'
+        task = ' '.join(shlex.quote(arg) for arg in task_command(manifest, self.task)) + ' $SLURM_ARRAY_TASK_ID'
+        if self.setup is not None:
+            task = f'{self.setup} && {task}'
+        return ['sbatch', '--parsable', f'--array={array}', '-p', self.partition, '-t', self.time_limit, f'--mem={self.mem}', f'--cpus-per-task={self.cpus_per_task}', f'--job-name={self.job_name}', '-o', f'{log}.out', '-e', f'{log}.err', '--wrap', task]
+
+    def submit(self, manifest, n_tasks):
+        '''Function to submit the tasks of a manifest.
+
+        OUTPUTS:
+            job_id : None, string
+                The SLURM job id of the array. None for a dry run.
+        '''
+        cmd = self.command(manifest, n_tasks)
+        print(' '.join(shlex.quote(arg) for arg in cmd))
+        if self.dry_run:
+            return None
+        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        return result.stdout.strip().split(';')[0]
+
+
+class LocalExecutor:
+    '''Executor that runs the tasks of a manifest as local processes, with the same interface as SlurmExecutor, so that the catch-up can be run and tested on a single machine without SLURM.
+
+    Each task runs the same command as a SLURM array task, in its own python process, with its stdout and stderr written to task_<id>.out and task_<id>.err next to the manifest. submit waits for every task to finish.
+
+    INPUTS:
+        workers : None, int ; default=None
+            The most tasks that run at once. If None, the number of CPUs available to this process.
+
+        command : None, list [string] ; default=None
+            The command run by each task, as for SlurmExecutor.
+    '''
+
+    def __init__(self, workers=None, command=None):
+        if workers is None:
+            workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        self.workers = workers
+        self.task = command
+
+    def submit(self, manifest, n_tasks):
+        '''Function to run the tasks of a manifest, returning once they have all finished.
+
+        OUTPUTS:
+            job_id : string
+                An id for the run, 'local-<pid>'.
+        '''
+        log = os.path.join(os.path.dirname(manifest), 'task_{}')
+        queue = list(range(n_tasks))
+        running = {}
+        failed = []
+        while queue or running:
+            while queue and len(running) < self.workers:
+                task_id = queue.pop(0)
+                with open(log.format(task_id) + '.out', 'w') as out, open(log.format(task_id) + '.err', 'w') as err:
+                    running[task_id] = subprocess.Popen(task_command(manifest, self.task) + [str(task_id)], stdout=out, stderr=err)
+            for task_id, process in list(running.items()):
+                if process.poll() is not None:
+                    del running[task_id]
+                    if process.returncode != 0:
+                        failed.append(task_id)
+            time.sleep(0.1)
+        if failed:
+            print(f'LocalExecutor: tasks {sorted(failed)} exited with an error, see {log.format("<id>")}.err')
+        return f'local-{os.getpid()}'
+
+
+def task_command(manifest, command=None):
+    '''Function to get the command that runs a task of a manifest, without the task id, as a list of arguments.
+
+    INPUTS:
+        manifest : string
+            Full filename of the manifest.
+
+        command : None, list [string] ; default=None
+            The command that runs a task when given the manifest and task id as its last two arguments, e.g. a script that calls run_task with its own calibrate function. If None, run_task is run by this module.
+
+    OUTPUTS:
+        command : list [string]
+            The command, followed by the manifest.
+    '''
+    if command is None:
+        command = [sys.executable, '-m', TASK_MODULE, 'run-task']
+    return list(command) + [manifest]
+
+
+def _calibrate_with(calibrate, date, contents):
+    # calibrate a single day of a task with the given function, catching any error so that the other days continue
+    from mplgz2ingested.workflows.calibrate_days import DayResult, _report
+
+    t0 = time.perf_counter()
+    try:
+        calibrate(date, contents['dir_target'], contents['dir_mpl'], **contents['kwargs'])
+    except Exception as err:
+        traceback.print_exc()
+        return _report(DayResult(date, 'failed', time.perf_counter() - t0, f'{type(err).__name__}: {err}'))
+    return _report(DayResult(date, 'done', time.perf_counter() - t0, None))
+
+
+def _report_path(manifest, task_id):
+    return os.path.join(os.path.dirname(manifest), f'task_{task_id}.json')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Scheduler to catch up the calibrated MPL archive: find the missing and stale days and process them as a SLURM job array, or locally.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    submit = subparsers.add_parser('submit', help='Find the pending days and submit them.')
+    submit.add_argument('-d', '--datadir', default='/gws/nopw/j04/ncas_radar_vol2/data/ICECAPSarchive/mpl/raw', help='The directory containing the raw .mpl.gz files.')
+    submit.add_argument('-t', '--targetdir', default='/gws/nopw/j04/ncas_radar_vol2/data/ICECAPSarchive/mpl/leeds_ingested', help='The directory containing the ingested files.')
+    submit.add_argument('-w', '--workdir', required=True, help='The directory for the manifest, task reports and logs.')
+    submit.add_argument('--fname-fmt', default='mpl_calibrated_{:04}{:02}{:02}.nc', help='Optional, the format of the ingested filenames, with the year, month and day imposed in order.')
+    submit.add_argument('--start', type=datetime.date.fromisoformat, help='Optional, the first date to consider, as YYYY-MM-DD.')
+    submit.add_argument('--end', type=datetime.date.fromisoformat, help='Optional, the last date to consider, as YYYY-MM-DD.')
+    submit.add_argument('-n', '--days-per-task', type=int, default=7, help='Optional, the most days in each task. Defaults to 7.')
+    submit.add_argument('-c', '--cpus-per-task', type=int, default=1, help='Optional, the CPUs (and worker processes) of each task. Defaults to 1.')
+    submit.add_argument('--local', action='store_true', help='Optional, run the tasks as local processes instead of submitting them to SLURM.')
+    submit.add_argument('-p', '--partition', default='short-serial', help='Optional, the SLURM partition. Defaults to short-serial.')
+    submit.add_argument('--time', default='01:00:00', help='Optional, the SLURM time limit of each task. Defaults to 01:00:00.')
+    submit.add_argument('--mem', default='8G', help='Optional, the SLURM memory of each task. Defaults to 8G.')
+    submit.add_argument('--max-parallel', type=int, help='Optional, the most SLURM array tasks that run at once.')
+    submit.add_argument('--setup', help='Optional, shell commands run before each SLURM task, e.g. to activate the environment.')
+    submit.add_argument('--dry-run', action='store_true', help='Optional, print the sbatch command without running it.')
+    submit.add_argument('-e', '--encoding', default='archive', choices=['archive', 'fast-read', 'minimal'], help='Optional, the encoding profile of the output files. Defaults to archive.')
+    submit.add_argument('-i', '--incremental', action='store_true', help='Optional, append new raw files to stale outputs where possible, see calibrate_day.')
+
+    task = subparsers.add_parser('run-task', help='Run a single task of a manifest.')
+    task.add_argument('manifest')
+    task.add_argument('task_id', type=int)
+
+    args = parser.parse_args()
+
+    if args.command == 'run-task':
+        report = run_task(args.manifest, args.task_id)
+        if any(result.status == 'failed' for result in report):
+            raise SystemExit(1)
+    else:
+        if args.local:
+            executor = LocalExecutor(workers=None)
+        else:
+            executor = SlurmExecutor(args.partition, args.time, args.mem, cpus_per_task=args.cpus_per_task, max_parallel=args.max_parallel, setup=args.setup, dry_run=args.dry_run)
+        job_id, manifest = schedule_catchup(args.datadir, args.targetdir, executor, args.workdir, days_per_task=args.days_per_task, workers_per_task=args.cpus_per_task, fname_save_fmt=args.fname_fmt, start=args.start, end=args.end, encoding=args.encoding, incremental=args.incremental)
+        if manifest is not None:
+            print(f'job {job_id}, manifest {manifest}')
+            if args.local:
+                for task_id, report in collect_reports(manifest).items():
+                    for day in report or []:
+                        print(f'{day["date"]}: {day["status"]}' + (f' ({day["error"]})' if day['error'] else ''))
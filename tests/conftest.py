@@ -0,0 +1,85 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Synthetic raw .mpl files and ingested datasets shared by the tests.
+'''
+
+import datetime
+import gzip
+
+import numpy as np
+import pytest
+
+from mplgz2ingested.steps.load_raw import mpl_record_dtype
+
+# a 200 ns bin time, giving 30 m range bins and 100 bins beneath the ground
+BIN_TIME = 2e-7
+GROUND_BIN = 100
+
+# the size of the full header read by mpl2nc.read_mpl_profile, including the weather station fields
+HEADER_SIZE = 163
+
+def mpl_records(start, n_profiles, number_bins=1300, step=5, seed=0, shots=12500, header_size=HEADER_SIZE):
+    '''Function to create n_profiles synthetic .mpl records, step seconds apart from start, with a signal decaying from the ground plus noise in both channels.'''
+    rng = np.random.default_rng(seed)
+    rec = np.zeros(n_profiles, dtype=mpl_record_dtype(header_size, number_bins))
+    times = np.datetime64(start, 's') + np.arange(n_profiles) * np.timedelta64(step, 's')
+    for k, unit in zip(['year', 'month', 'day', 'hours', 'minutes', 'seconds'], ['Y', 'M', 'D', 'h', 'm', 's']):
+        rec[k] = _time_field(times, unit)
+    rec['unit'] = 1
+    rec['version'] = 300
+    rec['shots_sum'] = shots
+    rec['trigger_frequency'] = 2500
+    rec['energy_monitor'] = rng.integers(7000, 9000, n_profiles)
+    rec['temp_0'] = 2500
+    rec['temp_2'] = 2600
+    rec['temp_3'] = 2700
+    rec['background_average'] = 0.05
+    rec['background_stddev'] = 0.01
+    rec['background_average_2'] = 0.06
+    rec['background_stddev_2'] = 0.01
+    rec['number_channels'] = 2
+    rec['number_bins'] = number_bins
+    rec['bin_time'] = BIN_TIME
+    rec['header_size'] = header_size
+    bins = np.arange(number_bins) - GROUND_BIN
+    profile = np.where(bins > 0, 5 * np.exp(-bins / 300), 0) # only background beneath the ground
+    for channel in ['channel_1', 'channel_2']:
+        rec[channel] = profile + rng.gamma(2, 0.03, (n_profiles, number_bins))
+    return rec
+
+
+def write_mpl(path, start, n_profiles, members=1, written=None, **kwargs):
+    '''Function to write synthetic records to a .mpl.gz (or .mpl) file, optionally as several concatenated gzip members. If written is given, only the first written of the n_profiles records are written, as in a file that is still being written.'''
+    records = mpl_records(start, n_profiles, **kwargs)
+    n_profiles = n_profiles if written is None else written
+    buf = records[:n_profiles].tobytes()
+    path = str(path)
+    if path[-3:] != '.gz':
+        with open(path, 'wb') as f:
+            f.write(buf)
+        return path
+    edges = np.linspace(0, n_profiles, members + 1).astype(int) * (len(buf) // max(n_profiles, 1))
+    with open(path, 'wb') as f:
+        for a, b in zip(edges[:-1], edges[1:]):
+            f.write(gzip.compress(buf[a:b]))
+    return path
+
+
+def _time_field(times, unit):
+    if unit == 'Y':
+        return times.astype('datetime64[Y]').astype(int) + 1970
+    if unit == 'M':
+        return times.astype('datetime64[M]').astype(int) % 12 + 1
+    if unit == 'D':
+        return (times.astype('datetime64[D]') - times.astype('datetime64[M]')).astype(int) + 1
+    return ((times - times.astype('datetime64[D]')).astype(int) // {'h': 3600, 'm': 60, 's': 1}[unit]) % {'h': 24, 'm': 60, 's': 60}[unit]
+
+
+@pytest.fixture
+def raw_day(tmp_path):
+    '''A directory of synthetic hourly files for 2021-02-11 (the first 3 hours, 60 profiles each), and a calibration file at 01:34 that overlaps the 02:00 file.'''
+    for hour in range(3):
+        write_mpl(tmp_path / f'20210211{hour:02}00.mpl.gz', datetime.datetime(2021, 2, 11, hour), 60, seed=hour)
+    write_mpl(tmp_path / '202102110134.mpl.gz', datetime.datetime(2021, 2, 11, 1, 34), 360, seed=10, shots=25000)
+    return tmp_path
@@ -0,0 +1,52 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the index of the raw archive.
+'''
+
+import datetime
+import os
+
+from conftest import write_mpl
+
+from mplgz2ingested.steps import ArchiveIndex
+
+START = datetime.datetime(2021, 2, 11)
+
+def _rewrite(path, n_profiles, mtime_ns=None):
+    # rewrite a file in place, as the instrument does while it writes an hour, without changing the directory's mtime
+    dir_mtime = os.stat(path.parent).st_mtime_ns
+    mtime_ns = os.stat(path).st_mtime_ns + 10**9 if mtime_ns is None else mtime_ns
+    write_mpl(path, START, n_profiles, number_bins=10)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    assert os.stat(path.parent).st_mtime_ns == dir_mtime
+
+
+def test_growing_file_is_read_again(tmp_path):
+    path = tmp_path / 'raw' / '202102110000.mpl.gz'
+    path.parent.mkdir()
+    write_mpl(path, START, 30, number_bins=10)
+    index = ArchiveIndex(tmp_path / 'index.sqlite', path.parent)
+    assert index.refresh() == 1
+
+    _rewrite(path, 60)
+    assert index.refresh() == 1
+    row = index.table()[0]
+    assert row['n_profiles'] == 60
+    assert row['size'] == os.path.getsize(path)
+
+
+def test_complete_file_only_read_again_by_full_refresh(tmp_path):
+    # a file last modified long ago is complete, whatever its number of profiles
+    path = tmp_path / 'raw' / '202102110000.mpl.gz'
+    path.parent.mkdir()
+    written = int(datetime.datetime(2021, 2, 11, 1).timestamp()) * 10**9
+    write_mpl(path, START, 30, number_bins=10)
+    os.utime(path, ns=(written, written))
+    index = ArchiveIndex(tmp_path / 'index.sqlite', path.parent)
+    index.refresh()
+
+    _rewrite(path, 31, mtime_ns=written + 10**9)
+    assert index.refresh() == 0
+    assert index.refresh(full=True) == 1
+    assert index.table()[0]['n_profiles'] == 31
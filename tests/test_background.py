@@ -0,0 +1,44 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the background estimators.
+'''
+
+import numpy as np
+import pytest
+
+from mplgz2ingested.steps import BackgroundEstimator
+from mplgz2ingested.steps.background import running_mean
+from mplgz2ingested.steps.raw_to_ingested import LIMIT_HEIGHT_BINS
+
+HEIGHT = 30. * np.arange(LIMIT_HEIGHT_BINS) - 3000
+
+@pytest.mark.parametrize('method, kwargs', [('below_ground', {}), ('header', {'first_bin': 10, 'num_bins': 50})])
+def test_mean_ignores_nan(method, kwargs):
+    rng = np.random.default_rng(0)
+    backscatter = rng.random((4, HEIGHT.size)).astype(np.float32)
+    estimator = BackgroundEstimator(HEIGHT, method=method, **kwargs)
+    expected = estimator(backscatter)
+
+    backscatter[1, estimator.bins.start + 3] = np.nan
+    background = estimator(backscatter)
+    assert np.all(np.isfinite(background))
+    np.testing.assert_array_equal(background[[0, 2, 3]], expected[[0, 2, 3]])
+    bins = np.delete(backscatter[1, estimator.bins], 3).astype(np.float64)
+    np.testing.assert_allclose(background[1], bins.mean() * 1e6)
+
+
+def test_header_bins_beyond_limit_height():
+    with pytest.raises(ValueError, match='limit_height=False'):
+        BackgroundEstimator(HEIGHT, method='header', first_bin=1900, num_bins=100)
+
+
+def test_running_mean_skips_nan():
+    rng = np.random.default_rng(1)
+    x = rng.random(50)
+    x[[10, 30, 31, 32, 33, 34]] = np.nan
+    mean = running_mean(x, 5)
+    expected = np.array([np.nanmean(x[max(i - 2, 0):i + 3]) if np.isfinite(x[max(i - 2, 0):i + 3]).any() else np.nan for i in range(x.size)])
+    np.testing.assert_allclose(mean, expected)
+    # only the window centred in the run of 5 NaN profiles is NaN
+    np.testing.assert_array_equal(np.flatnonzero(np.isnan(mean)), [32])
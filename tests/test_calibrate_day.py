@@ -0,0 +1,101 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the calibrate_day workflow.
+'''
+
+import datetime
+
+import numpy as np
+import pytest
+import xarray as xr
+from conftest import write_mpl
+
+from mplgz2ingested import steps
+from mplgz2ingested.steps.load_raw import DUPLICATE_POLICIES
+from mplgz2ingested.steps.write_netcdf import SOURCES_ATTR
+from mplgz2ingested.workflows.calibrate_day import calibrate_day, iter_calibrated_hours
+
+DATE = datetime.date(2021, 2, 11)
+
+@pytest.mark.parametrize('duplicates', DUPLICATE_POLICIES)
+def test_stream_matches_full_day(raw_day, duplicates):
+    fnames = steps.select_fromdate(DATE, raw_day)
+    full = steps.load_fromlist(fnames, raw_day, duplicates=duplicates, **steps.ingest_projection())
+    full = steps.calibrate_ingested(steps.raw_to_ingested(data_loaded=full))
+
+    streamed = list(iter_calibrated_hours(fnames, raw_day, duplicates=duplicates))
+    assert len(streamed) > 1
+    streamed = xr.concat(streamed, dim='time', data_vars='minimal', coords='minimal', compat='override')
+
+    for k in ['time', 'time_offset', 'nshots', 'backscatter_1', 'backscatter_2', 'NRB_1', 'NRB_2', 'depol_linear']:
+        np.testing.assert_array_equal(streamed[k].values, full[k].values, err_msg=k)
+
+
+def _calibrated(raw, target, **kwargs):
+    calibrate_day(DATE, str(target), str(raw), **kwargs)
+    with xr.open_dataset(target / 'mpl_calibrated_20210211.nc') as ds:
+        return ds.load()
+
+
+def _assert_same_day(updated, full):
+    assert updated.attrs[SOURCES_ATTR] == full.attrs[SOURCES_ATTR]
+    for k in full.variables:
+        np.testing.assert_array_equal(updated[k].values, full[k].values, err_msg=k)
+
+
+@pytest.fixture
+def hours(tmp_path):
+    '''A directory for the raw files of the first hours of the day, with one written for each hour given to the returned function.'''
+    raw = tmp_path / 'raw'
+    raw.mkdir()
+    def write_hour(hour, **kwargs):
+        write_mpl(raw / f'20210211{hour:02}00.mpl.gz', datetime.datetime(2021, 2, 11, hour), 60, seed=hour, **kwargs)
+    return raw, write_hour
+
+
+def test_incremental_appends_new_hour(tmp_path, hours, capsys):
+    raw, write_hour = hours
+    for hour in range(2):
+        write_hour(hour)
+    _calibrated(raw, tmp_path)
+    write_hour(2)
+    updated = _calibrated(raw, tmp_path, incremental=True)
+    assert 'appended' in capsys.readouterr().out
+
+    (tmp_path / 'full').mkdir()
+    _assert_same_day(updated, _calibrated(raw, tmp_path / 'full'))
+
+
+def test_incremental_appends_growing_file(tmp_path, hours, capsys):
+    raw, write_hour = hours
+    write_hour(0)
+    write_hour(1, written=30)
+    _calibrated(raw, tmp_path)
+    write_hour(1)
+    updated = _calibrated(raw, tmp_path, incremental=True)
+    assert 'appended' in capsys.readouterr().out
+    assert updated.sizes['time'] == 120
+
+    (tmp_path / 'full').mkdir()
+    _assert_same_day(updated, _calibrated(raw, tmp_path / 'full'))
+
+
+def test_incremental_empty_new_file(tmp_path, hours):
+    raw, write_hour = hours
+    write_hour(0)
+    _calibrated(raw, tmp_path)
+    (raw / '202102110100.mpl.gz').write_bytes(b'') # created, but nothing written yet
+    updated = _calibrated(raw, tmp_path, incremental=True)
+    assert updated.sizes['time'] == 60
+    assert '202102110100.mpl.gz' in steps.read_sources(str(tmp_path / 'mpl_calibrated_20210211.nc'))
+
+
+def test_incremental_rewritten_file(tmp_path, hours, capsys):
+    raw, write_hour = hours
+    write_hour(0)
+    write_hour(1, written=30)
+    _calibrated(raw, tmp_path)
+    write_mpl(raw / '202102110100.mpl.gz', datetime.datetime(2021, 2, 11, 1, 0, 2), 60, seed=1) # different times before the last profile
+    _calibrated(raw, tmp_path, incremental=True)
+    assert 'processed again for the full day' in capsys.readouterr().out
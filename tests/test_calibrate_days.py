@@ -0,0 +1,41 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the calibrate_dates workflow over several days and worker processes.
+'''
+
+import datetime
+import gzip
+
+import numpy as np
+import xarray as xr
+from conftest import mpl_records, write_mpl
+
+from mplgz2ingested.workflows.calibrate_day import calibrate_day
+from mplgz2ingested.workflows.calibrate_days import calibrate_dates
+
+DATES = [datetime.date(2021, 2, 11) + datetime.timedelta(days=i) for i in range(3)]
+
+def test_failed_and_missing_days(tmp_path):
+    raw, out, serial = tmp_path / 'raw', tmp_path / 'out', tmp_path / 'serial'
+    for d in [raw, out, serial]:
+        d.mkdir()
+    write_mpl(raw / '202102110000.mpl.gz', datetime.datetime(2021, 2, 11), 60)
+    # a file ending part way through a record, which can't be decoded
+    records = mpl_records(datetime.datetime(2021, 2, 12), 60)
+    with open(raw / '202102120000.mpl.gz', 'wb') as f:
+        f.write(gzip.compress(records.tobytes()[:-100]))
+    # no raw files for the last day
+
+    report = calibrate_dates(DATES, str(out), str(raw), workers=2)
+    assert [result.date for result in report] == DATES
+    assert [result.status for result in report] == ['done', 'failed', 'no data']
+    assert report[0].error is None and report[2].error is None
+    assert 'incomplete record' in report[1].error
+    assert sorted(p.name for p in out.iterdir()) == ['mpl_calibrated_20210211.nc']
+
+    # the day done by a worker process is the same as when it is calibrated on its own
+    calibrate_day(DATES[0], str(serial), str(raw))
+    with xr.open_dataset(out / 'mpl_calibrated_20210211.nc') as ds, xr.open_dataset(serial / 'mpl_calibrated_20210211.nc') as expected:
+        for k in expected.variables:
+            np.testing.assert_array_equal(ds[k].values, expected[k].values, err_msg=k)
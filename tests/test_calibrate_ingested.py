@@ -0,0 +1,125 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the calibration of the ingested data.
+'''
+
+import datetime
+
+import numpy as np
+import pytest
+
+from mplgz2ingested import steps
+from mplgz2ingested.steps.calibration_context import calibration_context
+from mplgz2ingested.steps.calibrate_ingested import CALIBRATION_BLOCK_SIZE, xarray_calibration
+
+CALIBRATED = ['NRB_1', 'NRB_2', 'depol_mpl', 'depol_linear', 'NRB_total']
+
+@pytest.fixture
+def ingested(raw_day):
+    fnames = steps.select_fromdate(datetime.date(2021, 2, 11), raw_day)
+    return steps.raw_to_ingested(data_loaded=steps.load_fromlist(fnames, raw_day, **steps.ingest_projection()))
+
+
+@pytest.fixture(scope='module')
+def corrections():
+    afterpulse, _ = steps.load_afterpulse(None)
+    overlap, _ = steps.load_overlap(None)
+    return {'afterpulse': afterpulse, 'overlap': overlap}
+
+
+def test_float32_error_bound(ingested, corrections):
+    ds64 = steps.calibrate_ingested(ingested.copy(), precision='float64', **corrections)
+    ds32 = steps.calibrate_ingested(ingested.copy(), precision='float32', **corrections)
+
+    # the bound documented in calibrate_ingested: 8 * 2^-24 * (|P| + |A| + |B|) * height_factor * time_factor
+    context = calibration_context(ingested['height'].values, **corrections)
+    energy = ingested['energy'].values.astype(np.float64)
+    time_factor = 1 / (energy / 1e6) / ingested['rep_rate'].values
+    for channel in [1, 2]:
+        assert ds32[f'NRB_{channel}'].dtype == np.float32
+        backscatter = ingested[f'backscatter_{channel}'].values
+        P = backscatter.astype(np.float64) * 1e6
+        A = np.multiply.outer(energy, context.afterpulse[channel]) / context.E0 * 1e6
+        B = context.background(backscatter)[:, None]
+        bound = 8 * 2.**-24 * (np.abs(P) + np.abs(A) + np.abs(B)) * context.height_factor * time_factor[:, None]
+
+        nrb64 = ds64[f'NRB_{channel}'].values
+        nrb32 = ds32[f'NRB_{channel}'].values.astype(np.float64)
+        both = np.isfinite(nrb64) & np.isfinite(nrb32)
+        assert both.mean() > 0.5
+        assert np.all(np.abs(nrb32 - nrb64)[both] <= bound[both])
+
+        # a bin can only be NaN in one precision if it is within the bound of zero
+        one = np.isfinite(nrb64) != np.isfinite(nrb32)
+        assert np.all(np.fmax(nrb64, nrb32)[one] <= bound[one])
+
+
+@pytest.mark.parametrize('precision', ['float64', 'float32'])
+def test_threads_bit_identical(ingested, corrections, precision):
+    assert ingested.sizes['time'] > 2 * CALIBRATION_BLOCK_SIZE # so that the blocks are shared between the threads
+    serial = steps.calibrate_ingested(ingested.copy(), precision=precision, **corrections)
+    threaded = steps.calibrate_ingested(ingested.copy(), precision=precision, threads=4, **corrections)
+    for k in CALIBRATED:
+        np.testing.assert_array_equal(threaded[k].values, serial[k].values, err_msg=k)
+
+
+@pytest.mark.parametrize('precision', ['float64', 'float32'])
+def test_lazy_bit_identical(ingested, corrections, precision):
+    pytest.importorskip('dask')
+    eager = steps.calibrate_ingested(ingested.copy(), precision=precision, **corrections)
+    lazy = steps.calibrate_ingested(ingested.copy().chunk({'time': 50}), precision=precision, **corrections)
+    for k in CALIBRATED:
+        assert lazy[k].chunks is not None
+        np.testing.assert_array_equal(lazy[k].values, eager[k].values, err_msg=k)
+
+
+def test_deadtime_with_nan_backscatter(ingested, corrections):
+    ingested['backscatter_1'][:5, 500:510] = np.nan # e.g. masked fill values
+    deadtime = steps.DeadtimeLUT(np.array([0., 50.]), np.array([1., 1.2]))
+    ds = steps.calibrate_ingested(ingested, deadtime=deadtime, **corrections)
+    assert np.all(np.isnan(ds['NRB_1'].values[:5, 500:510]))
+    assert np.isfinite(ds['NRB_1'].values[5:, 500:510]).any()
+
+
+def test_deadtime_applied_to_every_term(ingested, corrections):
+    # as in mpl2nc, the backscatter, afterpulse and background are all corrected, so a constant factor of 2 doubles the NRB exactly
+    deadtime = steps.DeadtimeLUT(np.array([-100., 100.]), np.array([2., 2.]))
+    ds = steps.calibrate_ingested(ingested.copy(), **corrections)
+    corrected = steps.calibrate_ingested(ingested.copy(), deadtime=deadtime, **corrections)
+    for channel in [1, 2]:
+        np.testing.assert_array_equal(corrected[f'NRB_{channel}'].values, 2 * ds[f'NRB_{channel}'].values)
+    assert corrected['deadtime'].size == 2
+
+
+def test_matches_xarray_reference(ingested, corrections):
+    # the only difference from the xarray implementation is the background, now a float64 rather than a float32 mean, so each NRB differs by at most the change in its background times height_factor * time_factor (plus float64 rounding)
+    reference = xarray_calibration(ingested, **corrections)
+    ds = steps.calibrate_ingested(ingested.copy(), **corrections)
+
+    context = calibration_context(ingested['height'].values, **corrections)
+    time_factor = 1 / (ingested['energy'].values.astype(np.float64) / 1e6) / ingested['rep_rate'].values
+    factor = context.height_factor * time_factor[:, None]
+    bound = {}
+    for channel in [1, 2]:
+        background = context.background(ingested[f'backscatter_{channel}'].values)
+        change = np.abs(background - reference[f'background_{channel}'].values)
+        assert np.all(change <= 1e-6 * np.abs(background))
+        signal = np.abs(ingested[f'backscatter_{channel}'].values) * 1e6 + np.abs(background)[:, None]
+        bound[f'NRB_{channel}'] = (change[:, None] + 1e-12 * signal) * factor
+    bound['NRB_total'] = 2 * bound['NRB_1'] + bound['NRB_2']
+
+    for k, b in bound.items():
+        new, ref = ds[k].values, reference[k].values
+        both = np.isfinite(new) & np.isfinite(ref)
+        assert both.mean() > 0.5
+        assert np.all(np.abs(new - ref)[both] <= b[both]), k
+        one = np.isfinite(new) != np.isfinite(ref) # only within the bound of zero
+        assert np.all(np.fmax(new, ref)[one] <= b[one]), k
+
+    # the ratios, where both NRB are well away from zero, to the sum of the relative errors of the NRB
+    rel = bound['NRB_1'] / np.abs(reference['NRB_1'].values) + bound['NRB_2'] / np.abs(reference['NRB_2'].values)
+    valid = rel < 1e-3
+    assert valid.mean() > 0.5
+    for k in ['depol_mpl', 'depol_linear']:
+        np.testing.assert_array_less(np.abs(ds[k].values - reference[k].values)[valid], 2.5 * rel[valid] * np.abs(reference[k].values)[valid] + 1e-15, err_msg=k)
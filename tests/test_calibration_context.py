@@ -0,0 +1,95 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the reuse and invalidation of the calibration contexts.
+'''
+
+import collections
+import datetime
+import sys
+
+import numpy as np
+import pytest
+
+from mplgz2ingested import steps
+from mplgz2ingested.steps.calibration_context import CONTEXT_CACHE_SIZE, CalibrationContext, calibration_context, context_key
+from mplgz2ingested.steps.deadtime import DeadtimeLUT
+
+HEIGHT = 30. * np.arange(1200) - 3000
+
+@pytest.fixture(scope='module')
+def corrections():
+    afterpulse, _ = steps.load_afterpulse(None)
+    overlap, _ = steps.load_overlap(None)
+    return {'afterpulse': afterpulse, 'overlap': overlap}
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    '''An empty context cache, and the list of the height grids of the contexts built.'''
+    context_module = sys.modules['mplgz2ingested.steps.calibration_context']
+    built = []
+    class CountedContext(CalibrationContext):
+        def __init__(self, height, **kwargs):
+            built.append(height)
+            super().__init__(height, **kwargs)
+    monkeypatch.setattr(context_module, '_CONTEXT_CACHE', collections.OrderedDict())
+    monkeypatch.setattr(context_module, 'CalibrationContext', CountedContext)
+    return built
+
+
+def test_reused_for_equal_inputs(raw_day, corrections, builds):
+    # days with the same height grid and corrections share one context, even when the inputs are different objects
+    fnames = steps.select_fromdate(datetime.date(2021, 2, 11), raw_day)
+    ingested = steps.raw_to_ingested(data_loaded=steps.load_fromlist(fnames, raw_day, **steps.ingest_projection()))
+    first = steps.calibrate_ingested(ingested.copy(deep=True), **corrections)
+    second = steps.calibrate_ingested(ingested.copy(deep=True), afterpulse=corrections['afterpulse'].copy(deep=True), overlap=corrections['overlap'].copy())
+    assert len(builds) == 1
+    for k in ['NRB_1', 'NRB_2', 'depol_linear']:
+        np.testing.assert_array_equal(second[k].values, first[k].values)
+
+    context = calibration_context(ingested['height'].values.copy(), **corrections)
+    assert len(builds) == 1
+    explicit = steps.calibrate_ingested(ingested.copy(deep=True), context=context)
+    np.testing.assert_array_equal(explicit['NRB_1'].values, first['NRB_1'].values)
+
+
+def test_invalidated_by_changed_inputs(corrections, builds):
+    afterpulse, overlap = corrections['afterpulse'], corrections['overlap']
+    context = calibration_context(HEIGHT, **corrections)
+    changed_overlap = overlap.copy() # the (height, overlap) array
+    changed_overlap[1, 5] *= 1.01
+    changed_afterpulse = afterpulse.copy(deep=True)
+    changed_afterpulse['E0'] = changed_afterpulse['E0'] + 1
+    deadtime = DeadtimeLUT(np.array([0., 10.]), np.array([1., 1.5]))
+    variants = [
+        dict(height=HEIGHT + 1, **corrections),
+        dict(height=HEIGHT, afterpulse=afterpulse, overlap=changed_overlap),
+        dict(height=HEIGHT, afterpulse=changed_afterpulse, overlap=overlap),
+        dict(height=HEIGHT, afterpulse=afterpulse, overlap=None),
+        dict(height=HEIGHT, c=3e8, **corrections),
+        dict(height=HEIGHT, deadtime=deadtime, **corrections),
+    ]
+    keys = {context_key(**kwargs) for kwargs in variants} | {context.key}
+    assert len(keys) == len(variants) + 1
+    for kwargs in variants:
+        assert calibration_context(**kwargs) is not context
+    assert len(builds) == len(variants) + 1
+    assert calibration_context(HEIGHT, deadtime=DeadtimeLUT(np.array([0., 10.]), np.array([1., 1.5])), **corrections) is calibration_context(HEIGHT, deadtime=deadtime, **corrections)
+
+
+def test_least_recently_used_evicted(builds):
+    contexts = [calibration_context(HEIGHT + i) for i in range(CONTEXT_CACHE_SIZE)]
+    assert calibration_context(HEIGHT) is contexts[0] # now the most recently used
+    calibration_context(HEIGHT + CONTEXT_CACHE_SIZE) # evicts HEIGHT + 1
+    assert calibration_context(HEIGHT) is contexts[0]
+    assert calibration_context(HEIGHT + 1) is not contexts[1]
+    assert len(builds) == CONTEXT_CACHE_SIZE + 2
+
+
+def test_context_for_other_height_grid(raw_day, corrections):
+    fnames = steps.select_fromdate(datetime.date(2021, 2, 11), raw_day)
+    ingested = steps.raw_to_ingested(data_loaded=steps.load_fromlist(fnames, raw_day, **steps.ingest_projection()))
+    context = calibration_context(ingested['height'].values[:-1], **corrections)
+    with pytest.raises(ValueError, match='different height grid'):
+        steps.calibrate_ingested(ingested, context=context)
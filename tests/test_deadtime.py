@@ -0,0 +1,36 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the deadtime correction lookup table.
+'''
+
+import numpy as np
+import pytest
+
+from mplgz2ingested.steps import DeadtimeLUT
+from mplgz2ingested.steps.deadtime import deadtime_lut
+
+def test_factor_of_nan_signal():
+    lut = DeadtimeLUT(np.array([0., 10., 20.]), np.array([1., 1.5, 3.]))
+    signal = np.array([[0., np.nan, 10.], [np.nan, 20., -1.]], dtype=np.float32)
+    factor = lut.factor(signal)
+    np.testing.assert_array_equal(np.isnan(factor), np.isnan(signal))
+    np.testing.assert_allclose(factor[~np.isnan(signal)], [1., 1.5, 3., 1.], rtol=1e-4)
+
+
+def test_signal_above_table():
+    lut = DeadtimeLUT(np.array([0., 10.]), np.array([1., 1.5]))
+    with pytest.warns(UserWarning, match='largest signal'):
+        factor = lut.factor(np.array([5., 20.]))
+    np.testing.assert_allclose(factor, [1.25, 1.5], rtol=1e-4)
+
+
+@pytest.mark.parametrize('source', ['table', 'coefficients'])
+def test_stored_source_rebuilds_table(source):
+    if source == 'table':
+        lut = DeadtimeLUT(np.array([0., 10., 20.]), np.array([1., 1.5, 3.]))
+    else:
+        lut = DeadtimeLUT.from_coefficients(np.array([1e-9, 2e-5, 1.]))
+    stored = lut.to_xarray()
+    assert stored.size <= 3
+    np.testing.assert_array_equal(deadtime_lut(stored).table, lut.table)
@@ -0,0 +1,34 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the on-disk cache of decoded .mpl files.
+'''
+
+import numpy as np
+
+from mplgz2ingested.steps import decode_cache
+from mplgz2ingested.steps.decode_cache import CACHE_DIR_ENV, resolve_cache
+from mplgz2ingested.steps.load_raw import read_mpl
+
+def test_resolve_cache_reuses_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv(CACHE_DIR_ENV, str(tmp_path / 'cache'))
+    cache = resolve_cache(None)
+    assert resolve_cache(None) is cache
+    assert resolve_cache(str(tmp_path / 'cache')) is cache
+    assert resolve_cache(False) is None
+
+
+def test_miss_hashes_file_once(raw_day, tmp_path, monkeypatch):
+    hashed = []
+    file_hash = decode_cache.file_hash
+    monkeypatch.setattr(decode_cache, 'file_hash', lambda fname: hashed.append(fname) or file_hash(fname))
+    fname = str(raw_day / '202102110000.mpl.gz')
+    cache = str(tmp_path / 'cache')
+
+    mpl = read_mpl(fname, cache=cache)
+    assert hashed == [fname]
+    cached = read_mpl(fname, cache=cache) # found by its key, without hashing
+    assert hashed == [fname]
+    assert resolve_cache(cache)._total_bytes is not None
+    for k in ['time', 'channel_1', 'channel_2']:
+        np.testing.assert_array_equal(cached[k], mpl[k], err_msg=k)
@@ -0,0 +1,222 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the loading of the raw .mpl files.
+'''
+
+import datetime
+import sys
+import warnings
+
+import mpl2nc
+import numpy as np
+import pytest
+import xarray as xr
+from conftest import HEADER_SIZE, mpl_records, write_mpl
+
+from mplgz2ingested import steps
+from mplgz2ingested.steps.load_raw import read_mpl, scan_layout, mpl_record_dtype, mpl2nc_read_mpl_gzip, merge_profiles, mpl_dict_to_xarray, memmap_mpl_records, SCAN_FIELDS
+
+FIELDS = ['shots_sum', 'channel_1', 'channel_2']
+START = datetime.datetime(2021, 2, 11)
+
+@pytest.fixture
+def overlapping(raw_day):
+    '''The calibration file and the hourly file it overlaps, with the profiles of each, and the times they share.'''
+    fnames = ['202102110134.mpl.gz', '202102110200.mpl.gz']
+    calibration, hourly = [read_mpl(str(raw_day / fname), cache=False) for fname in fnames]
+    shared = np.intersect1d(calibration['time'], hourly['time'])
+    assert shared.size > 0
+    return fnames, calibration, hourly, shared
+
+
+def _rows(mpl, times):
+    return np.searchsorted(mpl['time'], times)
+
+
+@pytest.mark.parametrize('duplicates', ['hourly', 'shots', 'mean'])
+def test_duplicate_policies(raw_day, overlapping, duplicates):
+    fnames, calibration, hourly, shared = overlapping
+    ds = steps.load_fromlist(fnames, raw_day, fields=FIELDS, duplicates=duplicates)
+    times = ds['time'].values.astype('datetime64[s]').astype(np.uint64)
+    np.testing.assert_array_equal(times, np.union1d(calibration['time'], hourly['time']))
+
+    rows = _rows({'time': times}, shared)
+    c, h = _rows(calibration, shared), _rows(hourly, shared)
+    if duplicates == 'hourly':
+        expected, shots = hourly['channel_1'][h], hourly['shots_sum'][h]
+    elif duplicates == 'shots': # the calibration file has the most shots
+        assert np.all(calibration['shots_sum'][c] > hourly['shots_sum'][h])
+        expected, shots = calibration['channel_1'][c], calibration['shots_sum'][c]
+    else:
+        w_c, w_h = calibration['shots_sum'][c, None].astype(np.float64), hourly['shots_sum'][h, None].astype(np.float64)
+        expected = ((w_c * calibration['channel_1'][c] + w_h * hourly['channel_1'][h]) / (w_c + w_h)).astype(np.float32)
+        shots = calibration['shots_sum'][c] + hourly['shots_sum'][h]
+    if duplicates == 'mean':
+        np.testing.assert_allclose(ds['channel_1'].values[rows], expected, rtol=1e-6)
+    else:
+        np.testing.assert_array_equal(ds['channel_1'].values[rows], expected)
+    np.testing.assert_array_equal(ds['shots_sum'].values[rows], shots)
+
+
+def _assembled(times, shots):
+    # an assembled mpl dictionary of several files, with one value per profile in the channel data
+    counts = np.array([len(t) for t in times])
+    channel = np.concatenate([np.arange(len(t)) + 10.*i for i, t in enumerate(times)]).astype(np.float32)
+    mpl = {'time': np.concatenate(times).astype(np.uint64), 'shots_sum': np.concatenate(shots).astype(np.uint32), 'channel_1': channel[:, None].copy()}
+    return mpl, counts, channel
+
+
+def test_mean_policy_without_shots():
+    mpl, counts, channel = _assembled([[0, 5, 10], [5, 10, 15]], [[0, 0, 0], [0, 0, 0]])
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        merged = merge_profiles(mpl, counts, ['202102110000.mpl.gz', '202102110005.mpl.gz'], policy='mean')
+    np.testing.assert_array_equal(merged['time'], [0, 5, 10, 15])
+    np.testing.assert_array_equal(merged['channel_1'][:, 0], [channel[0], (channel[1] + channel[3])/2, (channel[2] + channel[4])/2, channel[5]])
+    np.testing.assert_array_equal(merged['shots_sum'], 0)
+
+
+@pytest.mark.parametrize('policy', ['hourly', 'shots'])
+def test_merge_interleaved_runs(policy):
+    # the runs of three files interleave, with a time shared by all of them
+    times = [[0, 10, 20, 30], [5, 10, 25], [10, 15, 35]]
+    shots = [[1, 1, 1, 1], [1, 3, 1], [1, 2, 1]]
+    paths = ['202102110000.mpl.gz', '202102110005.mpl.gz', '202102110100.mpl.gz']
+    mpl, counts, channel = _assembled(times, shots)
+    merged = merge_profiles(mpl, counts, paths, policy=policy)
+    np.testing.assert_array_equal(merged['time'], [0, 5, 10, 15, 20, 25, 30, 35])
+    # at time 10, 'hourly' prefers the earliest hourly file, and 'shots' the profile with the most shots
+    expected = channel[[0, 4, 1 if policy == 'hourly' else 5, 8, 2, 6, 3, 9]]
+    np.testing.assert_array_equal(merged['channel_1'][:, 0], expected)
+
+
+def test_scan_layout_multi_member_gzip(tmp_path, capsys):
+    path = tmp_path / '202102110000.mpl.gz'
+    write_mpl(path, START, 30, number_bins=10, members=3)
+    n_records, rec_dtype = scan_layout(str(path))
+    assert n_records == 30
+    assert rec_dtype == mpl_record_dtype(HEADER_SIZE, 10)
+
+    ds = steps.load_fromlist([str(path)], '', fields=FIELDS) # a full path, so the progress shows the time from the filename
+    assert ds.sizes['profile'] == 30
+    assert capsys.readouterr().out.endswith('|0000|\n')
+
+
+def test_scan_layout_counts_without_decompressing(raw_day, tmp_path, monkeypatch):
+    # the counts come from the decode cache or the archive index when they are known, and the files are then only decompressed to be decoded
+    fnames = ['202102110000.mpl.gz', '202102110100.mpl.gz']
+    cache = str(tmp_path / 'cache')
+    for fname in fnames:
+        read_mpl(str(raw_day / fname), cache=cache)
+    index = steps.ArchiveIndex(tmp_path / 'index.sqlite', raw_day)
+    index.refresh()
+    expected = steps.load_fromlist(fnames, raw_day, cache=False, fields=FIELDS)
+
+    monkeypatch.setattr(sys.modules['mplgz2ingested.steps.load_raw'], '_iter_gunzip', lambda fname: pytest.fail(f'{fname} was decompressed to count its records'))
+    assert scan_layout(str(raw_day / fnames[0]), cache=cache)[0] == 60
+    assert index.record_counts(fnames) == [60, 60]
+    for ds in [steps.load_fromlist(fnames, raw_day, cache=cache, fields=FIELDS), steps.load_fromglob('202102110[01]00.mpl.gz', raw_day, cache=False, index=index, fields=FIELDS)]:
+        np.testing.assert_array_equal(ds['channel_1'].values, expected['channel_1'].values)
+
+
+def test_stale_record_count(raw_day, tmp_path):
+    index = steps.ArchiveIndex(tmp_path / 'index.sqlite', raw_day)
+    index.refresh()
+    path = raw_day / '202102110000.mpl.gz'
+    write_mpl(path, START, 90)
+    assert index.record_counts(['202102110000.mpl.gz', '202102110500.mpl.gz']) == [None, None]
+    with pytest.raises(IOError, match='expected 60 records'):
+        steps.load_fromlist([path.name], raw_day, cache=False, fields=FIELDS, counts=[60])
+
+
+@pytest.mark.parametrize('members', [1, 3])
+def test_read_mpl_matches_mpl2nc(tmp_path, members):
+    path = write_mpl(tmp_path / '202102110000.mpl.gz', START, 30, number_bins=50, members=members)
+    reference = mpl2nc_read_mpl_gzip(path)
+    mpl = read_mpl(path, cache=False)
+    assert set(mpl) == set(reference)
+    for k in reference:
+        if k == 'time_utc': # the same strings, in a string dtype of a different width
+            assert mpl[k].tolist() == reference[k].tolist()
+        else:
+            np.testing.assert_array_equal(mpl[k], reference[k], err_msg=k)
+            assert np.asarray(mpl[k]).dtype == np.asarray(reference[k]).dtype, k
+
+
+def test_dataset_matches_mpl2nc_netcdf(tmp_path):
+    # the Dataset built from the mpl dictionary has the values, dims and attributes of the netcdf file mpl2nc writes, read back with xarray
+    path = write_mpl(tmp_path / '202102110000.mpl.gz', START, 20, number_bins=50)
+    mpl = {k: v.copy() if isinstance(v, np.ndarray) else v for k, v in mpl2nc.process_nrb(read_mpl(path, cache=False)).items()}
+    mpl['temp_0'][3] = mpl2nc.FILL_VALUE[mpl2nc.NC_HEADER['temp_0']['dtype']]
+    mpl['background_average'][4] = mpl2nc.FILL_VALUE[mpl2nc.NC_HEADER['background_average']['dtype']]
+    mpl2nc.write(mpl, str(tmp_path / 'mpl2nc.nc'))
+    with xr.open_dataset(tmp_path / 'mpl2nc.nc') as expected:
+        expected = expected.load()
+    ds = mpl_dict_to_xarray(mpl)
+
+    assert set(ds.variables) == set(expected.variables)
+    for k, v in expected.variables.items():
+        assert ds[k].dims == v.dims, k
+        assert ds[k].attrs == v.attrs, k
+        if v.dtype.kind == 'O':
+            np.testing.assert_array_equal(ds[k].values.astype(str), v.values.astype(str), err_msg=k)
+        else:
+            np.testing.assert_array_equal(ds[k].values, v.values, err_msg=k)
+    # the variables holding a fill value are masked as when they are read from the file; the others keep their dtype, where xarray promotes every integer variable with a _FillValue
+    for k in ['temp_0', 'background_average', 'time', 'nrb_copol']:
+        assert ds[k].dtype == expected[k].dtype, k
+    assert np.isnan(ds['temp_0'].values[3]) and np.isnan(ds['background_average'].values[4])
+    assert ds['shots_sum'].dtype == np.uint32
+
+
+@pytest.mark.parametrize('projection', [False, True])
+def test_parallel_matches_serial(raw_day, projection):
+    # the files are decoded in worker processes into shared memory, in the same profile order as when decoded one after another
+    fnames = sorted(p.name for p in raw_day.iterdir())
+    kwargs = steps.ingest_projection() if projection else {}
+    serial = steps.load_fromlist(fnames, raw_day, cache=False, **kwargs)
+    parallel = steps.load_fromlist(fnames, raw_day, workers=3, cache=False, **kwargs)
+    assert set(parallel.variables) == set(serial.variables)
+    for k, v in serial.variables.items():
+        assert parallel[k].dtype == v.dtype, k
+        np.testing.assert_array_equal(parallel[k].values, v.values, err_msg=k)
+
+
+def test_memmap_uncompressed_file(tmp_path):
+    # an uncompressed file decodes as its compressed copy, with the channel data (and selections of them) as views of the mapped file
+    records = dict(number_bins=50, seed=3)
+    path = write_mpl(tmp_path / '202102110000.mpl', START, 30, **records)
+    reference = read_mpl(write_mpl(tmp_path / '202102110000.mpl.gz', START, 30, **records), cache=False)
+    rec = memmap_mpl_records(path)
+    assert isinstance(rec, np.memmap) and rec.shape == (30,)
+
+    mpl = read_mpl(path)
+    assert set(mpl) == set(reference)
+    for k, v in reference.items():
+        np.testing.assert_array_equal(mpl[k], v, err_msg=k)
+
+    selected = read_mpl(path, profiles=slice(5, 25, 2), bins=slice(10, 40))
+    for k in ['channel_1', 'channel_2']:
+        assert isinstance(selected[k], np.memmap)
+        assert not selected[k].flags.owndata
+        np.testing.assert_array_equal(selected[k], reference[k][5:25:2, 10:40])
+    np.testing.assert_array_equal(selected['time'], reference['time'][5:25:2])
+
+
+@pytest.mark.parametrize('suffix, members', [('.mpl.gz', 1), ('.mpl.gz', 3), ('.mpl', 1)])
+def test_scan_headers_matches_read_mpl(tmp_path, suffix, members):
+    paths = [write_mpl(tmp_path / f'20210211{hour:02}00{suffix}', START + datetime.timedelta(hours=hour), 30 + hour, number_bins=50, members=members, seed=hour) for hour in range(2)]
+    open(tmp_path / f'202102110200{suffix}', 'wb').close()
+    tables = steps.scan_headers(paths + [str(tmp_path / f'202102110200{suffix}')])
+    assert len(tables[2]) == 0
+
+    for hour, (table, path) in enumerate(zip(tables, paths)):
+        records = mpl_records(START + datetime.timedelta(hours=hour), 30 + hour, number_bins=50, seed=hour)
+        mpl = read_mpl(path, cache=False)
+        assert len(table) == records.size
+        np.testing.assert_array_equal(table['time'].astype(np.int64).astype(np.uint64), mpl['time'])
+        for k in SCAN_FIELDS:
+            np.testing.assert_array_equal(table[k], records[k], err_msg=k)
+            if k in mpl:
+                np.testing.assert_array_equal(table[k], mpl[k], err_msg=k)
@@ -0,0 +1,36 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the ingest plan against the registry loop it replaced.
+'''
+
+import numpy as np
+import pytest
+import raw_to_ingested_reference as reference
+
+from mplgz2ingested import steps
+from mplgz2ingested.steps.raw_to_ingested import ATTRIBUTES_INGESTED, compile_ingest_plan
+
+@pytest.mark.parametrize('projection', [False, True])
+@pytest.mark.parametrize('limit_height', [True, False])
+@pytest.mark.parametrize('base_time', [None, np.datetime64('2021-02-11T00:30:00', 'ns')])
+def test_plan_matches_registry_loop(raw_day, projection, limit_height, base_time):
+    fnames = sorted(p.name for p in raw_day.iterdir())
+    kwargs = steps.ingest_projection(limit_height=limit_height) if projection else {}
+    loaded = steps.load_fromlist(fnames, raw_day, cache=False, **kwargs)
+    attributes = {k: dict(v) if isinstance(v, dict) else v for k, v in ATTRIBUTES_INGESTED.items()}
+
+    expected = reference.raw_to_ingested(loaded, limit_height=limit_height, base_time=base_time)
+    ds = steps.raw_to_ingested(loaded, limit_height=limit_height, base_time=base_time)
+
+    assert set(ds.variables) == set(expected.variables)
+    assert ds.sizes == expected.sizes
+    for k, v in expected.variables.items():
+        assert ds[k].dims == v.dims, k
+        assert ds[k].dtype == v.dtype, k
+        assert ds[k].attrs == v.attrs, k
+        np.testing.assert_array_equal(ds[k].values, v.values, err_msg=k)
+    assert {k: v for k, v in ds.attrs.items() if k != 'Date_created'} == {k: v for k, v in expected.attrs.items() if k != 'Date_created'}
+    # the plan is compiled once, and the registry's attributes aren't changed by ingesting
+    assert compile_ingest_plan() is compile_ingest_plan()
+    assert ATTRIBUTES_INGESTED == attributes
@@ -0,0 +1,49 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the scheduler for catching up the calibrated archive.
+'''
+
+import datetime
+import shlex
+import sys
+
+import pytest
+
+from mplgz2ingested.workflows import schedule_catchup, run_task, collect_reports, SlurmExecutor
+from mplgz2ingested.workflows.schedule import task_command
+
+class RecordingExecutor:
+    '''Executor that records the tasks it is given without running them.'''
+
+    def submit(self, manifest, n_tasks):
+        self.n_tasks = n_tasks
+        return 'recorded'
+
+
+def test_run_task_with_calibrate(raw_day, tmp_path):
+    executor = RecordingExecutor()
+    job_id, manifest = schedule_catchup(raw_day, tmp_path / 'target', executor, tmp_path / 'work', encoding='minimal')
+    assert (job_id, executor.n_tasks) == ('recorded', 1)
+
+    calls = []
+    def calibrate(date, dir_target, dir_mpl, **kwargs):
+        calls.append((date, kwargs['encoding'], kwargs['overwrite']))
+        raise RuntimeError('no calibration files')
+
+    report = run_task(manifest, 0, calibrate=calibrate)
+    assert calls == [(datetime.date(2021, 2, 11), 'minimal', True)]
+    assert [r.status for r in report] == ['failed']
+    assert collect_reports(manifest)[0][0]['error'] == 'RuntimeError: no calibration files'
+
+
+def test_zarr_store_rejected(raw_day, tmp_path):
+    with pytest.raises(ValueError, match='zarr_store'):
+        schedule_catchup(raw_day, tmp_path, RecordingExecutor(), tmp_path / 'work', zarr_store=str(tmp_path / 'store.zarr'))
+
+
+def test_task_command():
+    assert task_command('manifest.json')[-2:] == ['run-task', 'manifest.json']
+    script = [sys.executable, 'ingest_calibrate_day.py', '--task']
+    executor = SlurmExecutor('short-serial', '00:10:00', '1G', command=script)
+    assert executor.command('manifest.json', 3)[-1] == f'{shlex.quote(sys.executable)} ingest_calibrate_day.py --task manifest.json $SLURM_ARRAY_TASK_ID'
@@ -0,0 +1,42 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the vectorised reader of von.MPL against the per-record reader it replaced.
+'''
+
+import datetime
+import gzip
+
+import numpy as np
+import pytest
+from conftest import mpl_records
+from von_reference import MPL as ReferenceMPL
+
+from mplgz2ingested import von
+
+START = datetime.datetime(2021, 2, 11, 23, 59, 40)
+
+# the secondary header is only skipped for MPL 108, so the files of other units are read with the 128-byte header
+@pytest.mark.parametrize('unit, header_size', [(108, 163), (108, 128), (107, 128)])
+@pytest.mark.parametrize('suffix', ['.mpl.gz', '.mpl'])
+def test_matches_per_record_reader(tmp_path, unit, header_size, suffix):
+    rec = mpl_records(START, 8, number_bins=300, header_size=header_size)
+    rec['unit'] = unit
+    path = str(tmp_path / f'202102112359{suffix}')
+    with open(path, 'wb') as f:
+        f.write(gzip.compress(rec.tobytes()) if suffix == '.mpl.gz' else rec.tobytes())
+
+    expected = ReferenceMPL(path)
+    expected.readData()
+    mpl = von.MPL(path)
+    mpl.readData()
+
+    assert mpl.numberRecords == expected.numberRecords == 8
+    assert list(mpl.header) == list(expected.header)
+    for k, v in expected.header.items():
+        assert mpl.header[k].dtype == v.dtype, k
+        np.testing.assert_array_equal(mpl.header[k], v, err_msg=k)
+    for k in ['dataCh1', 'dataCh2', 'height', 'hours']:
+        assert getattr(mpl, k).dtype == getattr(expected, k).dtype, k
+        np.testing.assert_array_equal(getattr(mpl, k), getattr(expected, k), err_msg=k)
+    np.testing.assert_array_equal(mpl.dataCh1, rec['channel_1'])
@@ -0,0 +1,83 @@
+'''Author: Andrew Martin
+Creation Date: 18/10/26
+
+Tests of the Zarr archive backend.
+'''
+
+import datetime
+
+import numpy as np
+import pytest
+import xarray as xr
+
+pytest.importorskip('zarr')
+
+from mplgz2ingested.steps import ZarrArchive, day_slot_size
+
+def calibrated_day(date, n_profiles=10, n_height=20):
+    '''A small dataset with the layout of a calibrated day: profiles along time, a height grid, and variables without time.'''
+    rng = np.random.default_rng(date.toordinal())
+    day = np.datetime64(date, 'ns')
+    times = day + np.arange(n_profiles) * np.timedelta64(5, 's')
+    height = 30. * np.arange(n_height) - 3000
+    return xr.Dataset(
+        {
+            'base_time': ((), day),
+            'time_offset': (('time',), times - day),
+            'NRB_1': (('time', 'height'), rng.random((n_profiles, n_height))),
+            'overlap': (('height',), np.linspace(0.5, 1, n_height)),
+        },
+        coords={'time': times, 'height': height},
+    )
+
+
+def test_days_written_in_reverse_order(tmp_path):
+    dates = [datetime.date(2021, 2, 11) + datetime.timedelta(days=i) for i in range(4)]
+    archive = ZarrArchive(tmp_path / 'store.zarr', slot_size=720, first_day=dates[0])
+    for date in reversed(dates):
+        archive.write_day(calibrated_day(date), date)
+
+    assert list(archive.days()) == [np.datetime64(date, 'D') for date in dates]
+    ds = ZarrArchive(tmp_path / 'store.zarr').open().load()
+    expected = [calibrated_day(date) for date in dates]
+    np.testing.assert_array_equal(ds['time'].values, np.concatenate([e['time'].values for e in expected]))
+    np.testing.assert_array_equal(ds['NRB_1'].values, np.concatenate([e['NRB_1'].values for e in expected]).astype(np.float32))
+    np.testing.assert_array_equal(ds['base_time'].values, [e['base_time'].values for e in expected])
+
+
+def test_first_day_required_to_create(tmp_path):
+    date = datetime.date(2021, 2, 11)
+    with pytest.raises(ValueError, match='first_day'):
+        ZarrArchive(tmp_path / 'store.zarr', slot_size=720).write_day(calibrated_day(date), date)
+
+
+def test_day_before_first_day(tmp_path):
+    date = datetime.date(2021, 2, 11)
+    archive = ZarrArchive(tmp_path / 'store.zarr', slot_size=720, first_day=date)
+    archive.write_day(calibrated_day(date), date)
+    earlier = date - datetime.timedelta(days=1)
+    with pytest.raises(ValueError, match='before the first day'):
+        archive.write_day(calibrated_day(earlier), earlier)
+
+
+def test_no_encoding_profile(tmp_path):
+    with pytest.raises(ValueError, match='encoding profile'):
+        ZarrArchive(tmp_path / 'store.zarr', encoding=None)
+
+
+@pytest.mark.parametrize('profile_interval, slot_size', [(5, 18000), (10, 9360), (30, 3600), (1, 90000)])
+def test_slot_size_from_profile_interval(profile_interval, slot_size):
+    assert day_slot_size(profile_interval) == slot_size
+    assert slot_size >= 86400/profile_interval
+
+
+def test_day_over_slot(tmp_path):
+    # a store made for 1 minute profiles can't hold a day of 5 second profiles
+    date = datetime.date(2021, 2, 11)
+    archive = ZarrArchive(tmp_path / 'store.zarr', first_day=date, profile_interval=60)
+    assert archive.slot_size == 2160
+    with pytest.raises(ValueError, match='profile_interval of 60 s'):
+        archive.write_day(calibrated_day(date, n_profiles=17280, n_height=2), date)
+    archive = ZarrArchive(tmp_path / 'store.zarr', first_day=date, profile_interval=60)
+    archive.write_day(calibrated_day(date), date)
+    assert ZarrArchive(tmp_path / 'store.zarr').profile_interval == 60